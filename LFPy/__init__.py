@@ -22,23 +22,48 @@ GNU General Public License for more details.
   * Synapse - Convenience class for inserting synapses onto Cell objects
   * StimIntraElectrode - Convenience class for inserting electrodes onto Cell objects
   * RecExtElectrode - Class for performing simulations of extracellular potentials
+  * LazyLFP - Array like LFP calculated on indexing, see RecExtElectrode.calc_lfp
+  * FourSphereVolumeConductor - Class for EEG from current dipole moments
+  * MultipoleLFP - Class for LFPs of populations with multipole expansions
+  * LineSourceTable - Class for line-source mappings from a lookup table
 
 :Modules:
   * lfpcalc - functions used by RecExtElectrode class
   * tools - some convenient functions
   * inputgenerators - functions for synaptic input time generation
+  * read_swc - reading of .swc morphology files without NEURON's Import3d
+  * eegmegcalc - EEG and MEG signals of current dipole moments and axial currents
+  * csdcalc - coefficients of the current source density of voxels
+  * multipolecalc - LFPs of populations with hierarchical multipole expansions
+  * lfptable - tabulated potential of line sources
+  * backends - registry of the numpy, cython and numba compute backends
+
+:Functions:
+  * set_backend - choose the compute backend of the lfpcalc, run_simulation
+    and alias_method kernels
+  * get_backend - name of the active compute backend
+  * available_backends - names of the usable compute backends
 '''
 
 __version__ = "1.1.3"
 
 from .pointprocess import Synapse, PointProcess, StimIntElectrode
-from .recextelectrode import RecExtElectrode, RecExtElectrodeSetup
+from .recextelectrode import RecExtElectrode, RecExtElectrodeSetup, LazyLFP
 from .cell import Cell
 from .templatecell import TemplateCell
+from .eegmegcalc import FourSphereVolumeConductor
+from .multipolecalc import MultipoleLFP
+from .lfptable import LineSourceTable
 from .testing import test
 
 from . import lfpcalc
 from . import tools
 from . import inputgenerators
 from . import run_simulation
+from . import eegmegcalc
+from . import csdcalc
+from . import multipolecalc
+from . import lfptable
+from . import backends
+from .backends import set_backend, get_backend, available_backends
 
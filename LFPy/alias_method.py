@@ -73,12 +73,12 @@ def alias_setup(probs):
     '''        
     K = probs.size
     q = probs*K
-    J = np.zeros(K, dtype=int)
+    J = np.zeros(K, dtype=np.intp)
 
     # Sort the data into the outcomes with probabilities
     # that are larger and smaller than 1/K.
-    smaller = np.zeros(K, dtype=int)
-    larger = np.zeros(K, dtype=int)
+    smaller = np.zeros(K, dtype=np.intp)
+    larger = np.zeros(K, dtype=np.intp)
     s_i = 0
     l_i = 0
     for kk in range(K):
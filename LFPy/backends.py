@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+'''Copyright (C) 2012 Computational Neuroscience Group, NMBU.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Registry of the compute backends of the kernel modules lfpcalc,
+run_simulation and alias_method. The backends are
+
+    'numpy' : the pure Python/NumPy modules LFPy/*.py, always available
+    'cython' : the modules compiled from LFPy/*.pyx by setup.py into the
+        LFPy.cythonkernels package
+    'numba' : the NumPy modules with the elementwise geometry kernels of
+        lfpcalc and alias_method.alias_setup compiled by numba.njit,
+        available if numba can be imported. The mappings of lfpcalc are
+        still filled row by row in Python, so only the cython backend
+        scales with the n_threads of RecExtElectrode
+
+The default backend is 'cython' if compiled, otherwise 'numpy', unless the
+environment variable LFPY_BACKEND names another. Cell, TemplateCell and
+RecExtElectrode look up their kernels here at call time, so the backend may
+be changed between simulations with LFPy.set_backend(name), and
+LFPy.get_backend() reports the active one.
+'''
+
+import os
+import types
+from LFPy import lfpcalc, run_simulation, alias_method
+
+
+_numpy_modules = {
+    'lfpcalc' : lfpcalc,
+    'run_simulation' : run_simulation,
+    'alias_method' : alias_method,
+}
+
+#functions of the NumPy modules compiled by the numba backend
+_numba_kernels = {
+    'lfpcalc' : ['_deltaS_calc', '_h_calc', '_r2_calc', '_r_soma_calc'],
+    'alias_method' : ['alias_setup'],
+}
+
+#loaded backends, name : {module name : module}
+_backends = {}
+_active = [None]
+
+
+def _load_numpy():
+    '''the pure Python/NumPy modules'''
+    return dict(_numpy_modules)
+
+
+def _load_cython():
+    '''the compiled Cython modules, ImportError if not built'''
+    from LFPy.cythonkernels import lfpcalc, run_simulation, alias_method
+    return {
+        'lfpcalc' : lfpcalc,
+        'run_simulation' : run_simulation,
+        'alias_method' : alias_method,
+    }
+
+
+def _load_numba():
+    '''copies of the NumPy modules where the functions listed in
+    _numba_kernels are compiled by numba, ImportError if numba is missing'''
+    import numba
+    modules = dict(_numpy_modules)
+    for name, kernels in _numba_kernels.items():
+        source = _numpy_modules[name]
+        module = types.ModuleType('LFPy.numba.' + name, source.__doc__)
+        module.__dict__.update(source.__dict__)
+        module.__name__ = 'LFPy.numba.' + name
+        #rebind the module functions so that they call the compiled kernels
+        for key, value in source.__dict__.items():
+            if isinstance(value, types.FunctionType) and \
+                    value.__module__ == source.__name__:
+                func = types.FunctionType(value.__code__, module.__dict__,
+                                          value.__name__, value.__defaults__,
+                                          value.__closure__)
+                func.__doc__ = value.__doc__
+                setattr(module, key, func)
+        for kernel in kernels:
+            #without the GIL, but calc_mapping still runs the rows in
+            #Python and thus only scales with threads in the cython backend
+            setattr(module, kernel,
+                    numba.njit(nogil=True)(getattr(source, kernel)))
+        modules[name] = module
+    return modules
+
+
+_loaders = {
+    'numpy' : _load_numpy,
+    'cython' : _load_cython,
+    'numba' : _load_numba,
+}
+
+
+def _load(name):
+    '''load backend name once, ImportError if it is not available'''
+    if name not in _loaders:
+        raise ValueError('unknown backend %s, choose among %s' %
+                         (name, ', '.join(sorted(_loaders.keys()))))
+    if name not in _backends:
+        _backends[name] = _loaders[name]()
+    return _backends[name]
+
+
+def available_backends():
+    '''
+    Return the names of the backends that can be used in this installation
+
+    Returns
+    ::
+
+        names : list of str
+    '''
+    names = []
+    for name in ['numpy', 'cython', 'numba']:
+        try:
+            _load(name)
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
+
+def set_backend(name=None):
+    '''
+    Set the compute backend of the lfpcalc, run_simulation and alias_method
+    kernels used by Cell, TemplateCell and RecExtElectrode
+
+    Arguments
+    ::
+
+        name : None or str
+            'numpy', 'cython' or 'numba'. If None, the environment variable
+            LFPY_BACKEND, or 'cython' if compiled, otherwise 'numpy'
+    '''
+    if name is None:
+        name = os.environ.get('LFPY_BACKEND')
+    if name is None:
+        try:
+            _load('cython')
+            name = 'cython'
+        except ImportError:
+            name = 'numpy'
+    try:
+        _load(name)
+    except ImportError as ie:
+        raise ImportError('backend %s is not available: %s' % (name, ie))
+    _active[0] = name
+
+
+def get_backend():
+    '''
+    Return the name of the active compute backend
+
+    Returns
+    ::
+
+        name : str
+            'numpy', 'cython' or 'numba'
+    '''
+    if _active[0] is None:
+        set_backend()
+    return _active[0]
+
+
+def get_module(module, backend=None):
+    '''
+    Return a kernel module of the active or a given backend
+
+    Arguments
+    ::
+
+        module : str
+            'lfpcalc', 'run_simulation' or 'alias_method'
+        backend : None or str
+            backend name, if None the active backend
+    '''
+    if backend is None:
+        backend = get_backend()
+    return _load(backend)[module]
@@ -14,13 +14,17 @@ GNU General Public License for more details.
 '''
 
 import os
+import gc
 import neuron
 import numpy as np
+import scipy.sparse as sparse
 import pickle
+import hashlib
 from LFPy import RecExtElectrode
-from LFPy.run_simulation import _run_simulation, _run_simulation_with_electrode
-from LFPy.run_simulation import _collect_geometry_neuron
-from LFPy.alias_method import alias_method
+from LFPy import backends
+from LFPy.eegmegcalc import get_biot_savart_coeffs
+from LFPy.read_swc import read_swc
+from LFPy.tools import _atomic_savez
 import sys
 from warnings import warn
 
@@ -28,10 +32,18 @@ class Cell(object):
     '''
     The main cell class used in LFPy.
     
+    The cell consists of the sections created while it is initialized, so
+    several cells may coexist in NEURON if created with
+    delete_sections=False. Sections of .swc morphologies (and cached
+    morphologies) are then created as python sections owned by the cell,
+    while .hoc morphologies must not reuse section names of other cells,
+    an Exception is raised if they replace sections of other cells.
+    
     Arguments:
     ::
         
-        morphology : [str]: path/to/morphology/file
+        morphology : [str]: path/to/morphology/file, or a
+            neuron.h.SectionList with the sections of the cell
     
         v_init: [-65.]: initial potential
         passive: [True]/False: passive mechs are initialized if True
@@ -39,7 +51,10 @@ class Cell(object):
         rm: [30000]: membrane resistivity
         cm: [1.0]: membrane capacitance
         e_pas: [-65.]: passive mechanism reversal potential
-        extracellular: [True]/False: switch for NEURON's extracellular mechanism
+        extracellular: [True]/False: switch for NEURON's extracellular mechanism.
+                        If False, membrane currents are taken from
+                        i_membrane_ of CVode.use_fast_imem, which allows
+                        simulations with threads > 1
     
         timeres_NEURON: [0.1]: internal dt for NEURON simulation
         timeres_python: [0.1]: overall dt for python simulation
@@ -52,13 +67,18 @@ class Cell(object):
         lambda_f: [100]: AC frequency for method 'lambda_f'
         d_lambda: [0.1]: parameter for d_lambda rule
         
-        delete_sections: [True]: delete pre-existing section-references
+        delete_sections: [True]: delete pre-existing section-references,
+            set to False for several coexisting cells
         
         custom_code: [None]: list of model-specific code files ([.py/.hoc])
         custom_fun: [None]: list of model-specific functions with args
         custom_fun_args: [None]: list of args passed to custom_fun functions
         pt3d: True/[False]: use pt3d-info of the cell geometries switch
         celsius: [None]: Temperature in celsius. If nothing is specified here or in custom code it is 6.3 C
+        morphology_cache: [None]/True/'path/to/dir': cache the parsed
+            morphology, nseg of each section and the segment geometry in a
+            binary file next to the morphology file (True) or in the given
+            directory, reused by later constructions with same arguments
         verbose: True/[False]: verbose output switch
     
     Usage of cell class:
@@ -78,6 +98,11 @@ class Cell(object):
         cell = LFPy.Cell(**cellParameters)
         cell.simulate()
     '''
+    #segment geometry attributes stored in the morphology cache
+    _cache_geometry_attrs = ['xstart', 'ystart', 'zstart',
+                             'xend', 'yend', 'zend',
+                             'area', 'diam', 'length']
+    
     def __init__(self, morphology,
                     v_init=-65.,
                     passive = True,
@@ -100,12 +125,14 @@ class Cell(object):
                     custom_fun_args=None,
                     pt3d=False,
                     celsius=None,
+                    morphology_cache=None,
                     verbose=False):
         '''
         Initialization of the Cell object.
         '''
         self.verbose = verbose
         self.pt3d = pt3d
+        self._cache = None
         
         if not hasattr(neuron.h, 'd_lambda'):
             neuron.h.load_file('stdlib.hoc')    #NEURON std. library
@@ -117,21 +144,40 @@ class Cell(object):
                 pass
             if numsec > 0 and self.verbose:
                 print('%s existing sections deleted from memory' % numsec)
+            #free the point processes of unreferenced cells, e.g., in
+            #reference cycles of cells and synapses, before their sections,
+            #NEURON crashes in later simulations if they outlive them
+            gc.collect()
             neuron.h('forall delete_section()')
 
-        #print a warning if neuron have existing sections
-        numsec = 0
-        for numsec, sec in enumerate(neuron.h.allsec()):
-            pass
-        if numsec > 0 and self.verbose:
-            mssg = "%s sections detected! " % numsec + \
-                   "Consider setting 'delete_sections=True'"
-            warn(mssg)
-                
+        #sections existing now belong to other cells, the sections created
+        #from here on belong to this cell
+        self._foreign_sections = set(neuron.h.allsec())
+        self._sections = []
+        if len(self._foreign_sections) > 0 and self.verbose:
+            print('%i sections of other cells detected' 
+                  % len(self._foreign_sections))
+        
         #load morphology
         self.morphology = morphology
-        if self.morphology is not None:
+        if type(self.morphology) == type(neuron.h.SectionList()):
+            #the cell consists of the sections in the given SectionList
+            self._foreign_sections = set(neuron.h.allsec()) - \
+                set(self.morphology)
+            neuron.h.define_shape()
+            self._create_sectionlists()
+        elif self.morphology is not None:
             if os.path.isfile(self.morphology):
+                if morphology_cache:
+                    self._load_cache(morphology_cache, 
+                        dict(passive=passive, Ra=Ra, cm=cm,
+                             nsegs_method=nsegs_method, lambda_f=lambda_f,
+                             d_lambda=d_lambda,
+                             max_nsegs_length=max_nsegs_length,
+                             custom_code=custom_code,
+                             custom_fun=custom_fun is not None))
+                    #custom functions may do anything with the sections
+                    self._cache_discretization = custom_fun is None
                 self._load_geometry()
             else:
                 raise Exception('non-existent file %s' % self.morphology)
@@ -139,6 +185,7 @@ class Cell(object):
             try:
                 #will try to import top level cell and create sectionlist,
                 #in case there were no morphology file loaded
+                self._foreign_sections = set()
                 neuron.h.define_shape()
                 self._create_sectionlists()
             except:
@@ -186,16 +233,36 @@ class Cell(object):
         if custom_code is not None or custom_fun is not None:
             self._run_custom_codes(custom_code, custom_fun, custom_fun_args)
         
+        #parameters of the model, identifying states cached by simulate
+        self._model_params = dict(passive=passive, Ra=Ra, rm=rm, cm=cm,
+            e_pas=e_pas, extracellular=extracellular,
+            nsegs_method=nsegs_method, lambda_f=lambda_f, d_lambda=d_lambda,
+            max_nsegs_length=max_nsegs_length, custom_code=custom_code,
+            custom_fun=None if custom_fun is None else
+                [fun.__name__ for fun in custom_fun],
+            custom_fun_args=repr(custom_fun_args), celsius=celsius)
+        
         #Insert extracellular mech on all segments
         self.extracellular = extracellular
         if self.extracellular:
             self._set_extracellular()
+            self._imemvar = 'i_membrane'
         else:
-            if self.verbose:
-                print("no extracellular mechanism inserted, can't access imem!")
+            #CVode.use_fast_imem is enabled during simulations
+            self._imemvar = 'i_membrane_'
         
         #set number of segments accd to rule, and calculate the number
-        self._set_nsegs(nsegs_method, lambda_f, d_lambda, max_nsegs_length)
+        if self._cache is not None and 'nseg' in self._cache and \
+                list(self._cache['allsecnames']) != self.allsecnames:
+            #sections changed by custom code, discretization is not reused
+            self._cache_discretization = False
+            for key in ['nseg'] + self._cache_geometry_attrs:
+                self._cache.pop(key, None)
+        if self._cache is not None and 'nseg' in self._cache:
+            for sec, nseg in zip(self.allseclist, self._cache['nseg']):
+                sec.nseg = int(nseg)
+        else:
+            self._set_nsegs(nsegs_method, lambda_f, d_lambda, max_nsegs_length)
         self.totnsegs = self._calc_totnsegs()
         if self.verbose:
             print("Total number of segments: %i" % self.totnsegs)
@@ -211,6 +278,11 @@ class Cell(object):
             self._update_pt3d()
         else: # self._update_pt3d itself makes a call to self._collect_geometry()
             self._collect_geometry()
+        if self._cache is not None:
+            self._save_cache()
+            self._cache = None
+        #do not keep sections of other cells alive
+        del self._foreign_sections
         if hasattr(self, 'somapos'):
             self.set_pos()
         else:
@@ -236,14 +308,16 @@ class Cell(object):
         fileEnding = self.morphology.split('.')[-1]
         if fileEnding == 'hoc' or fileEnding == 'HOC':
             neuron.h.load_file(1, self.morphology)
+        elif self._cache is not None and 'secnames' in self._cache:
+            self._instantiate_morphology(self._cache)
+        elif fileEnding == 'swc' or fileEnding == 'SWC':
+            self._instantiate_morphology(read_swc(self.morphology))
         else:
             neuron.h('objref this')
             if fileEnding == 'asc' or fileEnding == 'ASC':
                 Import = neuron.h.Import3d_Neurolucida3()
                 if not self.verbose:
                     Import.quiet = 1
-            elif fileEnding == 'swc' or fileEnding == 'SWC':
-                Import = neuron.h.Import3d_SWC_read()
             elif fileEnding == 'xml' or fileEnding == 'XML':
                 Import = neuron.h.Import3d_MorphML()
             else:
@@ -269,6 +343,163 @@ class Cell(object):
             
         neuron.h.define_shape()
         self._create_sectionlists()
+        
+        #hoc files may contain any code, so only parsed files are cached
+        if self._cache is not None and 'secnames' not in self._cache and \
+                fileEnding not in ['hoc', 'HOC']:
+            self._collect_topology()
+    
+    def _load_cache(self, morphology_cache, params):
+        '''Load the cache file of the morphology from the folder
+        morphology_cache (or the folder of the morphology if True). The file
+        is identified by the content of the morphology and custom code files
+        and by the arguments in params affecting the discretization'''
+        sha = hashlib.sha1()
+        with open(self.morphology, 'rb') as f:
+            sha.update(f.read())
+        if params['custom_code'] is not None:
+            for code in params['custom_code']:
+                with open(code, 'rb') as f:
+                    sha.update(f.read())
+        sha.update(repr(sorted(params.items())).encode('utf-8'))
+        
+        if morphology_cache is True:
+            morphology_cache = os.path.dirname(os.path.abspath(
+                                                        self.morphology))
+        self._cache_file = os.path.join(morphology_cache, '%s.%s.npz' % (
+            os.path.basename(self.morphology), sha.hexdigest()[:16]))
+        self._cache_updated = False
+        self._cache = {}
+        if os.path.isfile(self._cache_file):
+            try:
+                with np.load(self._cache_file) as f:
+                    for key in f.files:
+                        self._cache[key] = f[key]
+                if self.verbose:
+                    print('loaded morphology cache %s' % self._cache_file)
+            except Exception:
+                warn('could not read morphology cache %s' % self._cache_file)
+                self._cache = {}
+    
+    def _save_cache(self):
+        '''Add nseg and segment geometry to the cache, and write the cache
+        file if anything is new'''
+        if self._cache_discretization and 'nseg' not in self._cache:
+            self._cache['allsecnames'] = np.array(self.allsecnames)
+            self._cache['nseg'] = np.array([sec.nseg
+                                            for sec in self.allseclist])
+            self._cache_updated = True
+        #in pt3d mode the geometry is shifted with the pt3d points
+        if self._cache_discretization and not self.pt3d and \
+                'xstart' not in self._cache:
+            for attr in self._cache_geometry_attrs:
+                self._cache[attr] = getattr(self, attr).copy()
+            self._cache_updated = True
+        if not self._cache_updated:
+            return
+        
+        try:
+            _atomic_savez(self._cache_file, **self._cache)
+            if self.verbose:
+                print('saved morphology cache %s' % self._cache_file)
+        except (IOError, OSError):
+            warn('could not write morphology cache %s' % self._cache_file)
+    
+    def _collect_topology(self):
+        '''Store the names, connections and pt3d info of all sections in 
+        the cache'''
+        index = dict((name, i) for i, name in enumerate(self.allsecnames))
+        parent = np.zeros(len(self.allsecnames), dtype=int) - 1
+        parentx = np.zeros(len(self.allsecnames))
+        childx = np.zeros(len(self.allsecnames))
+        #logical connection points, as set by import3d for soma children
+        logical = np.zeros((len(self.allsecnames), 3)) + np.nan
+        xl, yl, zl = neuron.h.ref(0.), neuron.h.ref(0.), neuron.h.ref(0.)
+        for i, sec in enumerate(self.allseclist):
+            secref = neuron.h.SectionRef(sec=sec)
+            if secref.has_parent():
+                parent[i] = index[secref.parent.name()]
+                parentx[i] = neuron.h.parent_connection(sec=sec)
+                childx[i] = neuron.h.section_orientation(sec=sec)
+            if neuron.h.pt3dstyle(sec=sec):
+                neuron.h.pt3dstyle(1, xl, yl, zl, sec=sec)
+                logical[i] = xl[0], yl[0], zl[0]
+        run_simulation = backends.get_module('run_simulation')
+        n3d, arc3d, x3d, y3d, z3d, diam3d = \
+            run_simulation._get_pt3d_vectors(self.allseclist)
+        
+        self._cache['secnames'] = np.array(self.allsecnames)
+        self._cache['parent'] = parent
+        self._cache['parentx'] = parentx
+        self._cache['childx'] = childx
+        self._cache['logical'] = logical
+        self._cache['n3d'] = n3d
+        self._cache['x3d'] = x3d
+        self._cache['y3d'] = y3d
+        self._cache['z3d'] = z3d
+        self._cache['diam3d'] = diam3d
+        self._cache_updated = True
+    
+    def _create_hoc_sections(self, secnames, parent, parentx, childx):
+        '''Create and connect top-level hoc sections with the given names'''
+        #section arrays are created in order of appearance, like import3d
+        bases = []
+        sizes = {}
+        for name in secnames:
+            base = name.split('[')[0]
+            if base not in sizes:
+                bases.append(base)
+                sizes[base] = 0
+            if name.find('[') >= 0:
+                sizes[base] = max(sizes[base],
+                                  int(name.split('[')[1].rstrip(']')) + 1)
+        code = []
+        for base in bases:
+            if sizes[base] > 0:
+                code.append('create %s[%i]' % (base, sizes[base]))
+            else:
+                code.append('create %s' % base)
+        for i, j in enumerate(parent):
+            if j >= 0:
+                code.append('connect %s(%r), %s(%r)' % (secnames[i],
+                                float(childx[i]), secnames[j],
+                                float(parentx[i])))
+            else:
+                root = secnames[i]
+        #the root section is the default section, like with import3d
+        code.append('access %s' % root)
+        neuron.h('\n'.join(code))
+    
+    def _instantiate_morphology(self, morphology):
+        '''Create, connect and shape the sections of a morphology given as a
+        dict of arrays, see LFPy.read_swc.read_swc()'''
+        secnames = [str(name) for name in morphology['secnames']]
+        if len(self._foreign_sections) > 0:
+            #top-level hoc names may be taken by other cells, so this cell
+            #keeps its own python sections
+            self._sections = [neuron.h.Section(name=name) for name in secnames]
+            for i, j in enumerate(morphology['parent']):
+                if j >= 0:
+                    self._sections[i].connect(self._sections[j],
+                                              float(morphology['parentx'][i]),
+                                              float(morphology['childx'][i]))
+        else:
+            self._create_hoc_sections(secnames, morphology['parent'],
+                                      morphology['parentx'],
+                                      morphology['childx'])
+        
+        self._create_sectionlists()
+        if self.allsecnames != secnames:
+            raise Exception('sections created do not match %s' 
+                            % self.morphology)
+        run_simulation = backends.get_module('run_simulation')
+        run_simulation._add_pt3d_vectors(self.allseclist, morphology['n3d'],
+                                         morphology['x3d'], morphology['y3d'],
+                                         morphology['z3d'],
+                                         morphology['diam3d'])
+        for sec, (xl, yl, zl) in zip(self.allseclist, morphology['logical']):
+            if not np.isnan(xl):
+                neuron.h.pt3dstyle(1, xl, yl, zl, sec=sec)
 
         
     def _run_custom_codes(self, custom_code, custom_fun, custom_fun_args):
@@ -320,7 +551,7 @@ class Cell(object):
     def _get_rotation(self):
         '''Check if there exists a corresponding file
         with rotation angles'''
-        if self.morphology is not None:
+        if type(self.morphology) == str:
             base = os.path.splitext(self.morphology)[0]        
             if os.path.isfile(base+'.rot'):
                 rotation_file = base+'.rot'
@@ -339,26 +570,38 @@ class Cell(object):
 
     def _create_sectionlists(self):
         '''Create section lists for different kinds of sections'''
-        #list with all sections
+        #list with all sections of this cell, i.e., all sections in NEURON
+        #except those of other cells
         self.allsecnames = []
         self.allseclist = neuron.h.SectionList()
+        nforeign = 0
         for sec in neuron.h.allsec():
+            if sec in self._foreign_sections:
+                nforeign += 1
+                continue
             self.allsecnames.append(sec.name())
             self.allseclist.append(sec=sec)
+        #hoc code creating sections with the names of sections of other
+        #cells deletes those sections
+        nreplaced = len(self._foreign_sections) - nforeign
+        if nreplaced > 0:
+            raise Exception('%s replaced %i sections of other cells, the '
+                            'section names of the cells must differ'
+                            % (self.morphology, nreplaced))
         
         #list of soma sections, assuming it is named on the format "soma*"
         self.nsomasec = 0
         self.somalist = neuron.h.SectionList()
-        for sec in neuron.h.allsec():
+        for sec in self.allseclist:
             if sec.name().find('soma') >= 0:
                 self.somalist.append(sec=sec)
                 self.nsomasec += 1
             
     def _get_idx(self, seclist):
         '''Return boolean vector which indexes where segments in seclist 
-        matches segments in neuron.h.allsec(), rewritten from 
+        matches segments in self.allseclist, rewritten from 
         LFPy.hoc function get_idx()'''
-        if neuron.h.allsec() == seclist:
+        if seclist is self.allseclist:
             return np.ones(self.totnsegs, dtype=bool)
         else:
             idxvec = np.zeros(self.totnsegs, dtype=bool)
@@ -431,6 +674,17 @@ class Cell(object):
         to access i_membrane'''
         for sec in self.allseclist:
             sec.insert('extracellular')
+    
+    def _get_imem_factors(self):
+        '''
+        Return the factors converting the membrane currents recorded from
+        each segment to units of nA, i.e., the segment areas times 1E-2 for
+        i_membrane (mA/cm2), or ones for i_membrane_ (nA)
+        '''
+        if self.extracellular:
+            return self.area * 1E-2
+        else:
+            return np.ones(self.totnsegs)
             
     def set_synapse(self, idx, syntype,
                     record_current=False, record_potential=False,
@@ -568,7 +822,13 @@ class Cell(object):
             self.diam = None
             self.length = None
 
-        _collect_geometry_neuron(self)
+        if self._cache is not None and 'xstart' in self._cache \
+                and not self.pt3d:
+            for attr in self._cache_geometry_attrs:
+                setattr(self, attr, self._cache[attr].copy())
+        else:
+            run_simulation = backends.get_module('run_simulation')
+            run_simulation._collect_geometry_neuron(self)
         self._calc_midpoints()
 
         self.somaidx = self.get_idx(section='soma')
@@ -628,7 +888,7 @@ class Cell(object):
             
         '''
         if section == 'allsec': 
-            seclist = neuron.h.allsec()
+            seclist = self.allseclist
         else:
             seclist = neuron.h.SectionList()
             if type(section) == str:
@@ -692,7 +952,8 @@ class Cell(object):
         else:
             area = self.area[poss_idx]
             area /= area.sum()
-            idx = alias_method(poss_idx, area, nidx)
+            alias_method = backends.get_module('alias_method')
+            idx = alias_method.alias_method(poss_idx, area, nidx)
 
             return idx
     
@@ -701,7 +962,11 @@ class Cell(object):
                  rec_isyn=False, rec_vmemsyn=False, rec_istim=False,
                  rec_variables=[], variable_dt=False, atol=0.001,
                  to_memory=True, to_file=False, file_name=None,
-                 dotprodcoeffs=None):
+                 dotprodcoeffs=None, cells=None, warmup_cache=None,
+                 checkpoint_file=None, checkpoint_interval=1000.,
+                 resume_from=None, threads=1,
+                 rec_current_dipole_moment=False, rec_magnetic_field=None,
+                 spike_window=None, spike_threshold=-20.):
         '''
         This is the main function running the simulation of the NEURON model.
         Start NEURON simulation and record variables specified by arguments.
@@ -724,61 +989,697 @@ class Cell(object):
             rec_vmemsyn:    record membrane voltage of segments with Synapse(mV)
             rec_istim:  record currents of StimIntraElectrode (nA)
             rec_variables: list of variables to record, i.e arg=['cai', ]
-            variable_dt: boolean, using variable timestep in NEURON
+            variable_dt: boolean, using variable timestep in NEURON. With an
+                        electrode, the LFPs are calculated from membrane
+                        currents recorded every timeres_python, i.e., on
+                        the time axis of cell.tvec
             atol:       absolute tolerance used with NEURON variable timestep 
             to_memory:  only valid with electrode, store lfp in -> electrode.LFP 
             to_file:    only valid with electrode, save LFPs in hdf5 file format 
             file_name:  name of hdf5 file, '.h5' is appended if it doesnt exist
             dotprodcoeffs :  list of N x Nseg np.ndarray. These arrays will at
                         every timestep be multiplied by the membrane currents.
-                        Presumably useful for memory efficient csd or lfp calcs
+                        Presumably useful for memory efficient csd or lfp calcs,
+                        see LFPy.csdcalc for coefficients of the CSD
+            cells:      list of other Cell objects with equal time parameters,
+                        simulated together with this cell in the same NEURON
+                        loop. All cells get the same recordings, electrode.LFP
+                        and dotprodresults are then the sum over all cells
+                        (dotprodcoeffs must have the columns of this cell
+                        followed by those of the other cells in order).
+            warmup_cache: [None]/True/path to folder: with tstartms < 0, the
+                        state at t = 0 is saved to a file in this folder (the
+                        folder of the morphology if True), and restored
+                        instead of simulated from tstartms in later
+                        simulations of the same model and input before
+                        t = 0. Changes to the model not made by the Cell
+                        arguments or custom_code must change the morphology
+                        or custom_code files to be detected.
+            checkpoint_file: [None]: path to file where the state of the
+                        simulation is saved periodically. The recorded
+                        values and LFPs kept in memory are appended to the
+                        files checkpoint_file + '.rec' and + '.lfp', only
+                        the samples since the previous checkpoint are
+                        written. LFPs written to file_name are flushed
+            checkpoint_interval: [1000.]: ms of simulated time between
+                        checkpoints
+            resume_from: [None]: path to checkpoint file, the simulation
+                        continues from there. Cells, inputs and arguments of
+                        simulate must be the same as in the interrupted
+                        simulation, the LFP is written to the same file_name
+            threads:    [1]: number of threads used by NEURON, cells are
+                        split into subtrees distributed among the threads.
+                        threads > 1 requires that all cells are created
+                        with extracellular=False, and is not possible with
+                        rec_imem or variable_dt, or after simulations using
+                        the extracellular mechanism
+            rec_current_dipole_moment: [False]: calculate the current dipole
+                        moment (nA mum) of each cell on every time step,
+                        stored in cell.current_dipole_moment, shape (3, T),
+                        also with to_memory=False or spike_window
+            rec_magnetic_field: [None]: np.ndarray, shape (n_sensors, 3),
+                        sensor locations (mum). The magnetic field (nT) of
+                        the axial currents of all cells is calculated from
+                        the intracellular potentials on every time step
+                        (see get_axial_current_coeffs), stored
+                        in cell.magnetic_field, shape (n_sensors, 3, T).
+                        Requires fixed time steps, see
+                        LFPy.eegmegcalc.get_biot_savart_coeffs
+            spike_window: [None]: (tpre, tpost), with electrode or
+                        dotprodcoeffs only the LFPs in windows from tpre ms
+                        before to tpost ms after each somatic spike of the
+                        cells are kept, stored in electrode.spike_snippets
+                        and cell.dotprodresults with shape (n_spikes,
+                        n_contacts, n_samples of a window) instead of the
+                        full LFPs. The times of the spikes, the index in
+                        cells of the spiking cell and the time axis of the
+                        windows are in cell.snippet_times,
+                        cell.snippet_cells and cell.snippet_tvec, and all
+                        spike times of a cell in cell.spiketimes. Windows
+                        beyond t = 0 or tstopms are skipped. Requires fixed
+                        time steps and to_memory=False, and is not possible
+                        with checkpoints
+            spike_threshold: [-20.]: threshold (mV) of the membrane
+                        potential in the middle of the first soma section
+                        for detecting spikes with spike_window. NetCons
+                        watching this potential share their threshold in
+                        NEURON, an existing threshold is kept with a warning
             '''
-        self._set_soma_volt_recorder()
-        self._collect_tvec()
-        
-        if rec_imem:
-            self._set_imem_recorders()
-        if rec_vmem:
-            self._set_voltage_recorders()
-        if rec_ipas:
-            self._set_ipas_recorders()
-        if rec_icap:
-            self._set_icap_recorders()
-        if len(rec_variables) > 0:
-            self._set_variable_recorders(rec_variables)
-        
-        #run fadvance until t >= tstopms, and calculate LFP if asked for
-        if electrode is None and dotprodcoeffs is None:
-            if not rec_imem:
-                print(("rec_imem = %s, membrane currents will not be recorded!" \
-                                  % str(rec_imem)))
-            _run_simulation(self, variable_dt, atol)
+        if cells is None:
+            cells = [self]
+        else:
+            cells = [self] + list(cells)
+            for cell in cells[1:]:
+                for attr in ['timeres_NEURON', 'timeres_python', 'tstartms',
+                             'tstopms', 'v_init']:
+                    if getattr(cell, attr) != getattr(self, attr):
+                        raise ValueError('%s of cells differ' % attr)
+        
+        if threads > 1 and (rec_imem or variable_dt):
+            #NEURON can not record i_membrane_ with more than one thread
+            raise ValueError('threads > 1 not possible with rec_imem '
+                             'or variable_dt')
+        
+        #i_membrane_ of cells without the extracellular mechanism requires
+        #CVode.use_fast_imem, the NEURON settings are restored afterwards
+        cvode = neuron.h.CVode()
+        fast_imem = cvode.use_fast_imem()
+        if not all(cell.extracellular for cell in cells):
+            cvode.use_fast_imem(1)
+        nthread = int(neuron.h.ParallelContext().nthread())
+        try:
+            for cell in cells:
+                cell._set_soma_volt_recorder()
+                cell._collect_tvec()
+                
+                if rec_imem:
+                    cell._set_imem_recorders()
+                if rec_vmem:
+                    cell._set_voltage_recorders()
+                if rec_ipas:
+                    cell._set_ipas_recorders()
+                if rec_icap:
+                    cell._set_icap_recorders()
+                if len(rec_variables) > 0:
+                    cell._set_variable_recorders(rec_variables)
+            
+            if spike_window is not None and electrode is None and \
+                    dotprodcoeffs is None:
+                raise ValueError('spike_window requires electrode or '
+                                 'dotprodcoeffs')
+            
+            if warmup_cache and self.tstartms < 0:
+                warmup_file = self._get_warmup_file(warmup_cache, cells,
+                                                    spike_window is not None)
+            else:
+                warmup_file = None
+            
+            if rec_current_dipole_moment:
+                #dipole moments are products of the membrane currents with
+                #the segment midpoints, kept in memory independent of
+                #to_memory
+                imemcoeffs = [self._get_current_dipole_coeffs(cells)]
+            else:
+                imemcoeffs = None
+            
+            if rec_magnetic_field is not None:
+                vmemcoeffs = [self._get_magnetic_field_coeffs(
+                    cells, rec_magnetic_field)]
+            else:
+                vmemcoeffs = None
+            
+            #run fadvance until t >= tstopms, and calculate LFP if asked for
+            if electrode is None and dotprodcoeffs is None and \
+                    vmemcoeffs is None and imemcoeffs is None:
+                if not rec_imem:
+                    print(("rec_imem = %s, membrane currents will not be recorded!" \
+                                      % str(rec_imem)))
+                run_simulation = backends.get_module('run_simulation')
+                run_simulation._run_simulation(cells, variable_dt, atol,
+                                               warmup_file, checkpoint_file,
+                                               checkpoint_interval,
+                                               resume_from, threads)
+            else:
+                #allow using both electrode and additional coefficients:
+                run_simulation = backends.get_module('run_simulation')
+                run_simulation._run_simulation_with_electrode(
+                    cells, electrode, variable_dt, atol, to_memory, to_file,
+                    file_name, dotprodcoeffs, warmup_file, checkpoint_file,
+                    checkpoint_interval, resume_from, threads, vmemcoeffs,
+                    spike_window, spike_threshold, imemcoeffs)
+        finally:
+            cvode.use_fast_imem(fast_imem)
+            if threads > 1:
+                run_simulation = backends.get_module('run_simulation')
+                run_simulation._reset_threads(nthread)
+        
+        for cell in cells:
+            #somatic trace
+            cell.somav = np.array(cell.somav)
+            
+            if rec_imem:
+                cell._calc_imem()        
+            if rec_ipas:
+                cell._calc_ipas()        
+            if rec_icap:
+                cell._calc_icap()        
+            if rec_vmem:
+                cell._collect_vmem()        
+            if rec_isyn:
+                cell._collect_isyn()        
+            if rec_vmemsyn:
+                cell._collect_vsyn()        
+            if rec_istim:
+                cell._collect_istim()
+            if len(rec_variables) > 0:
+                cell._collect_rec_variables(rec_variables)
+            if hasattr(cell, 'netstimlist'):
+                del cell.netstimlist
+        
+        if rec_current_dipole_moment:
+            P = self.imemdotprodresults[0]
+            for k, cell in enumerate(cells):
+                cell.current_dipole_moment = P[3 * k:3 * k + 3]
+                del cell.imemdotprodresults
+        
+        if rec_magnetic_field is not None:
+            B = self.vmemdotprodresults[0]
+            for cell in cells:
+                cell.magnetic_field = B.reshape(-1, 3, B.shape[-1])
+                del cell.vmemdotprodresults
+    
+    def _get_current_dipole_coeffs(self, cells):
+        '''
+        Return the block diagonal scipy.sparse.csr_matrix, shape (3 * number
+        of cells, total number of segments of all cells), mapping the
+        membrane currents to the current dipole moments of the cells, i.e.,
+        rows 3k to 3k + 3 hold the segment midpoints of cell k in its own
+        columns
+        '''
+        return sparse.block_diag([np.array([cell.xmid, cell.ymid, cell.zmid])
+                                  for cell in cells], format='csr')
+    
+    def _get_magnetic_field_coeffs(self, cells, r_sensors):
+        '''
+        Return the tuple (G, M) of the axial current coefficients of all
+        cells in cells, block diagonal in the membrane voltages, and the
+        Biot-Savart coefficients of the half segments of all cells at the
+        sensor locations r_sensors
+        '''
+        Gs = []
+        rstarts = []
+        rends = []
+        for cell in cells:
+            G, rstart, rend = cell.get_axial_current_coeffs()
+            Gs.append(G)
+            rstarts.append(rstart)
+            rends.append(rend)
+        G = sparse.block_diag(Gs, format='csr')
+        M = get_biot_savart_coeffs(np.concatenate(rstarts),
+                                   np.concatenate(rends), r_sensors)
+        return G, M
+
+    def get_axial_current_coeffs(self):
+        '''
+        Coefficients of the axial currents along the lower and upper half of
+        each segment, from the intracellular potentials of the segments. The
+        currents follow from the axial resistances of NEURON (seg.ri())
+        between the nodes of the cable, where the voltages of the nodes at
+        the ends of sections, which have no membrane, are eliminated by
+        Kirchhoff's current law. Sections must be connected with their
+        0-end to the parent section. With the extracellular mechanism the
+        intracellular potentials are seg.v + seg.vext[0], which simulate
+        uses for rec_magnetic_field, while cell.vmem only holds seg.v.
+
+        Returns:
+        ::
+
+            G : scipy.sparse.csr_matrix, shape (2 * totnsegs, totnsegs),
+                multiplied with the intracellular potentials (mV) gives the
+                axial currents (nA) of the lower and upper half of segment i
+                in rows 2 * i and 2 * i + 1, positive from start to end point
+            rstart, rend : np.ndarray, shape (2 * totnsegs, 3), start and end
+                points of the half segments (mum)
+        '''
+        #index of the first segment of each section
+        firstidx = {}
+        i = 0
+        for sec in self.allseclist:
+            firstidx[sec.name()] = i
+            i += sec.nseg
+
+        def get_node(sec, x):
+            '''segment index of the node at x of sec, or a key of the nodes
+            at the ends of sections'''
+            if x == 1:
+                return ('end', sec.name())
+            elif x == 0:
+                sref = neuron.h.SectionRef(sec=sec)
+                if sref.has_parent():
+                    return get_node(sref.parent,
+                                    neuron.h.parent_connection(sec=sec))
+                return ('root', sec.name())
+            return firstidx[sec.name()] + min(int(x * sec.nseg), sec.nseg - 1)
+
+        #axial conductances (muS) between the nodes, and the conductances
+        #to the segments of each node at an end of a section
+        links = []
+        endnodes = {}
+        for sec in self.allseclist:
+            if neuron.h.section_orientation(sec=sec) != 0:
+                raise ValueError('section %s is not connected with its 0-end'
+                                 % sec.name())
+            i = firstidx[sec.name()]
+            g = [1. / seg.ri() for seg in sec] + [1. / sec(1).ri()]
+            nodes = [get_node(sec, 0)] + list(range(i, i + sec.nseg)) + \
+                [get_node(sec, 1)]
+            for j in range(sec.nseg + 1):
+                #rows of the upper half of the lower segment and the lower
+                #half of the upper segment carrying the current
+                rows = [2 * (i + j) - 1, 2 * (i + j)]
+                if j == 0:
+                    rows = rows[1:]
+                elif j == sec.nseg:
+                    rows = rows[:1]
+                links.append((rows, nodes[j], nodes[j + 1], g[j]))
+                for node, seg in [(nodes[j], nodes[j + 1]),
+                                  (nodes[j + 1], nodes[j])]:
+                    if type(node) == tuple:
+                        endnodes.setdefault(node, []).append((seg, g[j]))
+
+        #voltage of a node at an end of a section as the conductance-weighted
+        #mean of the voltages of the connected segments
+        weights = {}
+        for node, segs in endnodes.items():
+            gsum = sum([g for seg, g in segs])
+            weights[node] = [(seg, g / gsum) for seg, g in segs]
+
+        rows = []
+        cols = []
+        data = []
+        for linkrows, node0, node1, g in links:
+            for node, sign in [(node0, g), (node1, -g)]:
+                if type(node) == tuple:
+                    terms = weights[node]
+                else:
+                    terms = [(node, 1.)]
+                for row in linkrows:
+                    for col, w in terms:
+                        rows.append(row)
+                        cols.append(col)
+                        data.append(sign * w)
+        G = sparse.csr_matrix((data, (rows, cols)),
+                              shape=(2 * self.totnsegs, self.totnsegs))
+        G.eliminate_zeros()
+
+        start = np.array([self.xstart, self.ystart, self.zstart]).T
+        mid = np.array([self.xmid, self.ymid, self.zmid]).T
+        end = np.array([self.xend, self.yend, self.zend]).T
+        rstart = np.empty((2 * self.totnsegs, 3))
+        rend = np.empty((2 * self.totnsegs, 3))
+        rstart[0::2] = start
+        rstart[1::2] = mid
+        rend[0::2] = mid
+        rend[1::2] = end
+        return G, rstart, rend
+
+    def simulate_iter(self, chunk_ms=100., electrode=None, rec_imem=False,
+                      rec_vmem=False, rec_ipas=False, rec_icap=False,
+                      rec_variables=[], dotprodcoeffs=None,
+                      warmup_cache=None):
+        '''
+        Generator running the simulation of the NEURON model in chunks of
+        chunk_ms ms, yielding the recordings and LFP of each chunk. The
+        memory use is set by chunk_ms instead of tstopms, the buffers of one
+        chunk are reused for the next one, so results to be kept must be
+        copied. Only the fixed time step method is supported, and the LFP
+        is calculated at the timeres_python resolution. Afterwards,
+        cell.somav holds the soma potential of the last chunk.
+        
+        Arguments:
+        ::
+            
+            chunk_ms:   [100.]: duration of each chunk
+            electrode:  [None]: Override to choose electrode object(s)
+            rec_imem:   [False]: yield membrane currents
+            rec_vmem:   [False]: yield membrane voltages
+            rec_ipas:   [False]: yield passive currents
+            rec_icap:   [False]: yield capacitive currents
+            rec_variables: [[]]: yield the variables of all segments, as
+                        in Cell.simulate
+            dotprodcoeffs: list of N x Nseg np.ndarray or scipy.sparse
+                        matrices multiplied with the membrane currents of
+                        each chunk
+            warmup_cache: [None]: see Cell.simulate
+        
+        Yields:
+        ::
+            
+            dict with entries 'tvec', 'somav' if the cell has a soma,
+            'imem', 'vmem', 'ipas', 'icap' and 'rec_variables' (dict of
+            variable names and values) if recorded, 'LFP' with the LFP of
+            electrode (list of LFPs if electrode is a list) and
+            'dotprodresults' if dotprodcoeffs are given
+        
+        Usage:
+        ::
+            
+            for chunk in cell.simulate_iter(chunk_ms=1000,
+                                            electrode=electrode):
+                print(chunk['tvec'][0], chunk['LFP'].std(axis=1))
+        '''
+        if electrode is None:
+            electrodes = []
+        elif type(electrode) == list:
+            electrodes = electrode
         else:
-            #allow using both electrode and additional coefficients:
-            _run_simulation_with_electrode(self, electrode, variable_dt, atol,
-                                               to_memory, to_file, file_name,
-                                               dotprodcoeffs)
-        #somatic trace
-        self.somav = np.array(self.somav)
-        
-        if rec_imem:
-            self._calc_imem()        
-        if rec_ipas:
-            self._calc_ipas()        
-        if rec_icap:
-            self._calc_icap()        
-        if rec_vmem:
-            self._collect_vmem()        
-        if rec_isyn:
-            self._collect_isyn()        
-        if rec_vmemsyn:
-            self._collect_vsyn()        
-        if rec_istim:
-            self._collect_istim()
-        if len(rec_variables) > 0:
-            self._collect_rec_variables(rec_variables)
+            electrodes = [electrode]
+        if dotprodcoeffs is None:
+            dotprodcoeffs = []
+        elif type(dotprodcoeffs) != list:
+            dotprodcoeffs = [dotprodcoeffs]
+        if len(electrodes) > 0:
+            if not hasattr(self, 'tvec'):
+                self._collect_tvec()
+            if self.verbose:
+                print('precalculating geometry - LFP mapping')
+            run_simulation = backends.get_module('run_simulation')
+            coeffs = run_simulation._get_electrode_coeffs([self], electrodes)
+        else:
+            coeffs = []
+        
+        #i_membrane_ requires CVode.use_fast_imem, which is restored after
+        #the last chunk
+        cvode = neuron.h.CVode()
+        fast_imem = cvode.use_fast_imem()
+        if not self.extracellular:
+            cvode.use_fast_imem(1)
+        chunk = {}
+        try:
+            #recorders, membrane currents are needed for the LFP
+            self._set_soma_volt_recorder()
+            if self.nsomasec > 0:
+                recorded = [('somav', [self.somav])]
+            else:
+                recorded = []
+            if rec_imem or len(coeffs) + len(dotprodcoeffs) > 0:
+                self._set_imem_recorders()
+                recorded.append(('imem', self.memireclist))
+            if rec_vmem:
+                self._set_voltage_recorders()
+                recorded.append(('vmem', self.memvreclist))
+            if rec_ipas:
+                self._set_ipas_recorders()
+                recorded.append(('ipas', self.memipasreclist))
+            if rec_icap:
+                self._set_icap_recorders()
+                recorded.append(('icap', self.memicapreclist))
+            if len(rec_variables) > 0:
+                self._set_variable_recorders(rec_variables)
+                for variable, variablereclist in zip(rec_variables,
+                                                     self.recvariablesreclist):
+                    recorded.append((('rec_variables', variable),
+                                     variablereclist))
+            
+            #buffers for the recordings and LFPs of one chunk
+            nchunk = int(np.ceil(chunk_ms / self.timeres_python)) + 1
+            buffers = {}
+            for name, reclist in recorded:
+                buffers[name] = np.empty((len(reclist), nchunk))
+            LFPs = [np.empty((c.shape[0], nchunk)) for c in coeffs]
+            results = [np.empty((c.shape[0], nchunk)) for c in dotprodcoeffs]
+            area = self._get_imem_factors()[:, np.newaxis]
+            
+            if warmup_cache and self.tstartms < 0:
+                warmup_file = self._get_warmup_file(warmup_cache, [self])
+            else:
+                warmup_file = None
+            neuron.h.dt = self.timeres_NEURON
+            cvode.active(0)
+            run_simulation = backends.get_module('run_simulation')
+            run_simulation._initialize_simulation([self], cvode, warmup_file)
+            
+            offset = 0
+            tend = 0.
+            while neuron.h.t < self.tstopms - self.timeres_NEURON / 2:
+                tend = min(tend + chunk_ms, self.tstopms)
+                while neuron.h.t < tend - self.timeres_NEURON / 2:
+                    neuron.h.fadvance()
+                
+                #copy values recorded every timeres_python from t = 0 to
+                #the buffers, and empty recorders
+                n = int(round(neuron.h.t / self.timeres_python)) + 1 - offset
+                chunk = {'tvec' : (offset + np.arange(n)) *
+                                  self.timeres_python}
+                for name, reclist in recorded:
+                    buf = buffers[name]
+                    for i, rec in enumerate(reclist):
+                        buf[i, :n] = rec.as_numpy()
+                        rec.resize(0)
+                    if name == 'imem':
+                        buf[:, :n] *= area
+                    if name == 'somav':
+                        chunk[name] = buf[0, :n]
+                    elif name == 'imem' and not rec_imem:
+                        pass
+                    elif type(name) == tuple:
+                        chunk.setdefault('rec_variables', {})[name[1]] = \
+                            buf[:, :n]
+                    else:
+                        chunk[name] = buf[:, :n]
+                
+                for LFP, c in zip(LFPs, coeffs):
+                    LFP[:, :n] = c.dot(buffers['imem'][:, :n])
+                if len(coeffs) > 0:
+                    if type(electrode) == list:
+                        chunk['LFP'] = [LFP[:, :n] for LFP in LFPs]
+                    else:
+                        chunk['LFP'] = LFPs[0][:, :n]
+                for result, c in zip(results, dotprodcoeffs):
+                    result[:, :n] = c.dot(buffers['imem'][:, :n])
+                if len(dotprodcoeffs) > 0:
+                    chunk['dotprodresults'] = [result[:, :n]
+                                               for result in results]
+                offset += n
+                yield chunk
+        finally:
+            cvode.use_fast_imem(fast_imem)
+            #delete recorders, they are not needed after the simulation
+            for reclist in ['memireclist', 'memvreclist', 'memipasreclist',
+                            'memicapreclist', 'recvariablesreclist']:
+                if hasattr(self, reclist):
+                    delattr(self, reclist)
+            if 'somav' in chunk:
+                self.somav = chunk['somav']
+            elif 'tvec' in chunk:
+                #not recorded without soma, zeros as in simulate
+                self.somav = np.zeros(chunk['tvec'].size)
+            else:
+                self.somav = np.array(self.somav)
+    
+    def _get_warmup_file(self, warmup_cache, cells, spike_detectors=False):
+        '''Path of the file in the folder warmup_cache (or the folder of the
+        morphology if True) with the state at t = 0 of the cells. The file
+        is identified by the morphology and custom code files, the model
+        parameters, the synapses and point processes and their input before
+        t = 0, and the time parameters. Returns None if NetStims are active,
+        as their random state is not reproduced. With spike_detectors, the
+        NetCons detecting somatic spikes of each cell are counted, as they
+        are created later'''
+        nnetcons = int(neuron.h.List('NetCon').count())
+        if spike_detectors:
+            nnetcons += len(cells)
+        sha = hashlib.sha1()
+        sha.update(repr((nnetcons,
+                         len(list(neuron.h.allsec())), neuron.h.celsius,
+                         self.v_init, self.timeres_NEURON, self.tstartms)
+                        ).encode('utf-8'))
+        for cell in cells:
+            if hasattr(cell, 'netstimlist'):
+                for netstim in cell.netstimlist:
+                    if netstim.number > 0:
+                        if self.verbose:
+                            print('active NetStims, state is not cached')
+                        return None
+            files = []
+            if type(cell.morphology) == str:
+                files.append(cell.morphology)
+            if cell._model_params['custom_code'] is not None:
+                files += cell._model_params['custom_code']
+            if hasattr(cell, 'templatefile'):
+                if type(cell.templatefile) == list:
+                    files += cell.templatefile
+                else:
+                    files.append(cell.templatefile)
+            for fname in files:
+                if os.path.isfile(fname):
+                    with open(fname, 'rb') as f:
+                        sha.update(f.read())
+            sha.update(repr(sorted(cell._model_params.items())
+                            ).encode('utf-8'))
+            sha.update(repr(cell.allsecnames).encode('utf-8'))
+            for synapse in cell.synapses:
+                sha.update(repr((synapse.idx, synapse.syntype,
+                                 sorted(synapse.kwargs.items()))
+                                ).encode('utf-8'))
+                if hasattr(synapse, 'sptimes'):
+                    sptimes = np.array(synapse.sptimes, dtype=float)
+                    sha.update(np.ascontiguousarray(sptimes[sptimes < 0]))
+            for pointprocess in cell.pointprocesses:
+                sha.update(repr((pointprocess.idx, pointprocess.pptype,
+                                 sorted(pointprocess.kwargs.items()))
+                                ).encode('utf-8'))
+        
+        if warmup_cache is True:
+            if type(self.morphology) != str:
+                raise ValueError('warmup_cache=True requires a morphology file')
+            warmup_cache = os.path.dirname(os.path.abspath(self.morphology))
+            name = os.path.basename(self.morphology)
+        elif type(self.morphology) == str:
+            name = os.path.basename(self.morphology)
+        else:
+            name = 'cell'
+        return os.path.join(warmup_cache, '%s.%s.state.dat' % (
+                            name, sha.hexdigest()[:16]))
+    
+    def reset_inputs(self):
+        '''
+        Remove the spike times of all synapses, switch off their NetStim
+        generators and delete the results of previous simulations, so that
+        the instantiated cell can be simulated again with new input.
+        Synapses and point processes are kept, and their recorders deleted
+        by the previous simulation are set up again.
+        
+        Usage:
+        ::
+            
+            cell.reset_inputs()
+            synapse.set_spike_times(np.array([10., 20.]))
+            cell.simulate(rec_isyn=True)
+        '''
+        if hasattr(self, 'sptimeslist'):
+            self.sptimeslist = neuron.h.List()
         if hasattr(self, 'netstimlist'):
-            del self.netstimlist
+            for netstim in self.netstimlist:
+                netstim.number = 0
+        self._set_pointprocess_recorders()
+        for pointprocess in self.synapses + self.pointprocesses:
+            for attr in ['sptimes', 'i', 'v']:
+                if hasattr(pointprocess, attr):
+                    delattr(pointprocess, attr)
+        for attr in ['somav', 'imem', 'ipas', 'icap', 'vmem', 'rec_variables',
+                     'dotprodresults']:
+            if hasattr(self, attr):
+                delattr(self, attr)
+    
+    def run_trial(self, spike_times=None, electrode=None, **kwargs):
+        '''
+        Simulate the instantiated cell again with new synaptic input, without
+        reconstructing the morphology, mechanisms and synapses. The
+        coefficients mapping membrane currents onto the electrode contacts
+        are reused between trials for as long as the geometry of the cell and
+        the electrode contacts are unchanged.
+        
+        Arguments:
+        ::
+            
+            spike_times : list of np.ndarrays, spike times of each synapse in
+                          cell.synapses, or None to only reset the inputs
+            electrode : LFPy.RecExtElectrode object or list of them, the LFP
+                        of this trial is stored in electrode.LFP
+            **kwargs : arguments passed on to Cell.simulate
+        
+        Usage:
+        ::
+            
+            for trial in range(10):
+                cell.run_trial(spike_times=[np.sort(np.random.rand(5)*100)
+                                            for syn in cell.synapses],
+                               electrode=electrode)
+                LFPs.append(electrode.LFP)
+        '''
+        self.reset_inputs()
+        if spike_times is not None:
+            if len(spike_times) != len(self.synapses):
+                raise ValueError('spike_times must contain %i arrays, one '
+                                 'for each synapse' % len(self.synapses))
+            for synapse, sptimes in zip(self.synapses, spike_times):
+                synapse.set_spike_times(np.array(sptimes, dtype=float))
+        
+        if electrode is None:
+            self.simulate(**kwargs)
+            return
+        if type(electrode) == list:
+            electrodes = electrode
+        else:
+            electrodes = [electrode]
+        coeffs = self._get_trial_coeffs(electrodes)
+        dotprodcoeffs = kwargs.pop('dotprodcoeffs', None)
+        if dotprodcoeffs is None:
+            dotprodcoeffs = []
+        elif type(dotprodcoeffs) != list:
+            dotprodcoeffs = [dotprodcoeffs]
+        ndotprodcoeffs = len(dotprodcoeffs)
+        self.simulate(dotprodcoeffs=dotprodcoeffs + coeffs, **kwargs)
+        
+        #the LFP of each trial replaces the one of the previous trial
+        if hasattr(self, 'dotprodresults'):
+            results = self.dotprodresults
+            self.dotprodresults = results[:ndotprodcoeffs]
+            for el, coeff, LFP in zip(electrodes, coeffs,
+                                      results[ndotprodcoeffs:]):
+                el.LFP = LFP
+                el.electrodecoeff = coeff
+                if el.perCellLFP:
+                    el.CellLFP = [LFP]
+    
+    def _get_trial_coeffs(self, electrodes):
+        '''
+        Get the coefficient matrices of electrodes from the previous trial,
+        or calculate them if the geometry or electrodes have changed'''
+        sha = hashlib.sha1()
+        for array in [self.xstart, self.ystart, self.zstart,
+                      self.xend, self.yend, self.zend, self.diam]:
+            sha.update(np.ascontiguousarray(array, dtype=float))
+        for el in electrodes:
+            sha.update(repr((id(el), el.sigma, el.method, el.r, el.n,
+                             el.shape, el.cutoff, id(el.table))
+                            ).encode('utf-8'))
+            for array in [el.x, el.y, el.z, el.N, el.r_z]:
+                if array is not None:
+                    sha.update(np.ascontiguousarray(array, dtype=float))
+        key = sha.hexdigest()
+        
+        if getattr(self, '_trial_coeffs_key', None) != key:
+            if self.verbose:
+                print('precalculating geometry - LFP mapping')
+            if not hasattr(self, 'tvec'):
+                self._collect_tvec()
+            run_simulation = backends.get_module('run_simulation')
+            self._trial_coeffs = run_simulation._get_electrode_coeffs(
+                [self], electrodes)
+            self._trial_coeffs_key = key
+        return self._trial_coeffs
 
     def _collect_tvec(self):
         '''
@@ -793,8 +1694,7 @@ class Cell(object):
         containing all the membrane currents.
         '''
         self.imem = np.array(self.memireclist)
-        for i in range(self.imem.shape[0]):
-            self.imem[i, ] *= self.area[i] * 1E-2
+        self.imem *= self._get_imem_factors()[:, np.newaxis]
         self.memireclist = None
         del self.memireclist
     
@@ -873,15 +1773,18 @@ class Cell(object):
             i += 1
         del self.recvariablesreclist
     
-    def _loadspikes(self):
+    def _loadspikes(self, tmin=None):
         '''
-        Initialize spiketimes from netcon if they exist
+        Initialize spiketimes from netcon if they exist, only spike times
+        not before tmin if given
         '''
         if hasattr(self, 'synlist'):
             if len(self.synlist) == len(self.sptimeslist):
                 for i in range(int(self.synlist.count())):
                     for ii in range(int(self.sptimeslist.o(i).size)):
-                        self.netconlist.o(i).event(float(self.sptimeslist.o(i)[ii]))
+                        sptime = float(self.sptimeslist.o(i)[ii])
+                        if tmin is None or sptime >= tmin:
+                            self.netconlist.o(i).event(sptime)
             # elif len(self.synlist) > 0 and len(self.sptimeslist) == 0:
             #     errmsg = 'please run method "set_spike_times() for every' + \
             #             '\n' + 'instance of LFPy.pointprocess.Synapse'
@@ -891,6 +1794,56 @@ class Cell(object):
             
 
     
+    def _get_recorders(self):
+        '''
+        List of the NEURON Vectors recording during a simulation, all of the
+        same size. somav of cells without soma sections is not recording
+        '''
+        if self.nsomasec > 0:
+            recorders = [self.somav]
+        else:
+            recorders = []
+        for reclist in ['memireclist', 'memipasreclist', 'memicapreclist',
+                        'memvreclist', 'synireclist', 'synvreclist',
+                        'stimireclist']:
+            if hasattr(self, reclist):
+                recorders += list(getattr(self, reclist))
+        if hasattr(self, 'recvariablesreclist'):
+            for variablereclist in self.recvariablesreclist:
+                recorders += list(variablereclist)
+        return recorders
+    
+    def _set_pointprocess_recorders(self):
+        '''
+        Record currents and potentials of synapses and point processes as
+        set up by set_synapse and set_point_process
+        '''
+        if hasattr(self, 'synlist'):
+            self.synireclist = neuron.h.List()
+            self.synvreclist = neuron.h.List()
+            for synapse in self.synapses:
+                syn = self.synlist.o(synapse.hocidx)
+                if synapse.record_current:
+                    synirec = neuron.h.Vector(int(self.tstopms /
+                                                  self.timeres_python+1))
+                    synirec.record(syn._ref_i, self.timeres_python)
+                    self.synireclist.append(synirec)
+                if synapse.kwargs.get('record_potential', False):
+                    synvrec = neuron.h.Vector(int(self.tstopms /
+                                                  self.timeres_python+1))
+                    synvrec.record(syn.get_segment()._ref_v,
+                                   self.timeres_python)
+                    self.synvreclist.append(synvrec)
+        if hasattr(self, 'stimlist'):
+            self.stimireclist = neuron.h.List()
+            for pointprocess in self.pointprocesses:
+                if pointprocess.record_current:
+                    stim = self.stimlist.o(pointprocess.hocidx)
+                    stimirec = neuron.h.Vector(int(self.tstopms /
+                                                   self.timeres_python+1))
+                    stimirec.record(stim._ref_i, self.timeres_python)
+                    self.stimireclist.append(stimirec)
+    
     def _set_soma_volt_recorder(self):
         '''
         Record somatic membrane potential
@@ -928,7 +1881,8 @@ class Cell(object):
             for seg in sec:
                 memirec = neuron.h.Vector(int(self.tstopms / 
                                               self.timeres_python+1))
-                memirec.record(seg._ref_i_membrane, self.timeres_python)
+                memirec.record(getattr(seg, '_ref_' + self._imemvar),
+                               self.timeres_python)
                 self.memireclist.append(memirec)
     
     def _set_ipas_recorders(self):
@@ -1401,26 +2355,16 @@ class Cell(object):
 
     def _collect_pt3d(self):
         '''collect the pt3d info, for each section'''
-        x = []
-        y = []
-        z = []
-        d = []
-
-        for sec in self.allseclist:
-            n3d = int(neuron.h.n3d())
-            x_i, y_i, z_i = np.zeros(n3d), np.zeros(n3d), np.zeros(n3d),
-            d_i = np.zeros(n3d)
-            for i in range(n3d):
-                x_i[i] = neuron.h.x3d(i)
-                y_i[i] = neuron.h.y3d(i)
-                z_i[i] = neuron.h.z3d(i)
-                d_i[i] = neuron.h.diam3d(i)
-
-            
-            x.append(x_i)
-            y.append(y_i)
-            z.append(z_i)
-            d.append(d_i)
+        run_simulation = backends.get_module('run_simulation')
+        n3d, _, x3d, y3d, z3d, d3d = \
+            run_simulation._get_pt3d_vectors(self.allseclist)
+        
+        #split concatenated arrays into one array per section
+        splits = np.cumsum(n3d)[:-1]
+        x = np.split(x3d, splits)
+        y = np.split(y3d, splits)
+        z = np.split(z3d, splits)
+        d = np.split(d3d, splits)
         
         #remove offsets which may be present if soma is centred in Origo
         if len(x) > 1:
@@ -1439,18 +2383,12 @@ class Cell(object):
         '''
         update the locations in neuron.hoc.space using neuron.h.pt3dchange()
         '''
-        i = 0
-        for sec in self.allseclist:
-            n3d = int(neuron.h.n3d())
-            for n in range(n3d):
-                neuron.h.pt3dchange(n,
-                                self.x3d[i][n],
-                                self.y3d[i][n],
-                                self.z3d[i][n],
-                                self.diam3d[i][n])
-            i += 1
-            #let NEURON know about the changes we just did:
-            neuron.h.define_shape()
+        run_simulation = backends.get_module('run_simulation')
+        run_simulation._set_pt3d_vectors(self.allseclist,
+                                         np.concatenate(self.x3d),
+                                         np.concatenate(self.y3d),
+                                         np.concatenate(self.z3d),
+                                         np.concatenate(self.diam3d))
         #must recollect the geometry, otherwise we get roundoff errors!
         self._collect_geometry()
 
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+'''Copyright (C) 2012 Computational Neuroscience Group, NMBU.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Coefficient matrices of the ground-truth current source density (CSD),
+i.e., the membrane currents averaged over the volume of voxels, for use as
+dotprodcoeffs in Cell.simulate. The membrane current of each segment is
+assumed uniformly distributed along the line from its start to end point,
+and split between voxels in proportion to the length of the line inside
+each voxel.'''
+
+from __future__ import division
+import numpy as np
+
+
+def get_box_csd_coeffs(cell, x, y, z):
+    '''
+    Coefficients of the CSD in a grid of box-shaped voxels.
+
+    Arguments:
+    ::
+
+        cell : Cell object, or list of Cell objects to be simulated together
+        x, y, z : np.ndarray, edges of the voxels along each axis (mum)
+
+    Returns:
+    ::
+
+        np.ndarray, shape ((x.size - 1) * (y.size - 1) * (z.size - 1),
+            total number of segments), multiplied with the membrane currents
+            (nA) gives the CSD (nA/mum**3) of the voxels in C order, i.e.,
+            the CSD reshapes to (x.size - 1, y.size - 1, z.size - 1)
+    '''
+    if type(cell) == list:
+        return np.hstack([get_box_csd_coeffs(c, x, y, z) for c in cell])
+    x, y, z = [np.array(edges, dtype=float) for edges in (x, y, z)]
+
+    #parameter intervals of the lines inside the slabs of each axis
+    tx0, tx1 = _get_slab_intervals(cell.xstart, cell.xend, x)
+    ty0, ty1 = _get_slab_intervals(cell.ystart, cell.yend, y)
+    tz0, tz1 = _get_slab_intervals(cell.zstart, cell.zend, z)
+    t0 = np.maximum(np.maximum(tx0[:, np.newaxis, np.newaxis],
+                               ty0[np.newaxis, :, np.newaxis]),
+                    tz0[np.newaxis, np.newaxis, :])
+    t1 = np.minimum(np.minimum(tx1[:, np.newaxis, np.newaxis],
+                               ty1[np.newaxis, :, np.newaxis]),
+                    tz1[np.newaxis, np.newaxis, :])
+    fraction = np.clip(t1 - t0, 0., None)
+
+    volume = np.diff(x)[:, np.newaxis, np.newaxis] * \
+        np.diff(y)[np.newaxis, :, np.newaxis] * \
+        np.diff(z)[np.newaxis, np.newaxis, :]
+    return (fraction / volume[..., np.newaxis]).reshape(-1, cell.totnsegs)
+
+
+def get_cylinder_csd_coeffs(cell, z, r, x0=0., y0=0.):
+    '''
+    Coefficients of the CSD in cylindrical voxels with their axes along the
+    z-axis, e.g., the laminar CSD of a population.
+
+    Arguments:
+    ::
+
+        cell : Cell object, or list of Cell objects to be simulated together
+        z : np.ndarray, shape (n_voxels, 2), lower and upper bounds of each
+            cylinder (mum)
+        r : np.ndarray, shape (n_voxels, ), radius of each cylinder (mum)
+        x0, y0 : float, position of the axis of the cylinders (mum)
+
+    Returns:
+    ::
+
+        np.ndarray, shape (n_voxels, total number of segments), multiplied
+            with the membrane currents (nA) gives the CSD (nA/mum**3)
+    '''
+    if type(cell) == list:
+        return np.hstack([get_cylinder_csd_coeffs(c, z, r, x0, y0)
+                          for c in cell])
+    z = np.array(z, dtype=float).reshape(-1, 2)
+    r = np.array(r, dtype=float).flatten()
+    if r.size != z.shape[0]:
+        raise ValueError('z and r must have the same number of voxels')
+
+    #parameter interval of the lines inside the infinite cylinders, solving
+    #a t**2 + b t + c <= 0 for the distance to the axis
+    xs = cell.xstart - x0
+    ys = cell.ystart - y0
+    dx = cell.xend - cell.xstart
+    dy = cell.yend - cell.ystart
+    a = dx**2 + dy**2
+    b = 2 * (xs * dx + ys * dy)
+    c = xs**2 + ys**2 - r[:, np.newaxis]**2
+    radial = a > 0
+    disc = b**2 - 4 * a * c
+    sqrt_disc = np.sqrt(np.clip(disc, 0., None))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tr0 = np.where(radial, (-b - sqrt_disc) / (2 * a), -np.inf)
+        tr1 = np.where(radial, (-b + sqrt_disc) / (2 * a), np.inf)
+    #lines parallel to the axis are inside or outside everywhere
+    outside = (radial & (disc < 0)) | (~radial & (c > 0))
+    tr0[outside] = np.inf
+    tr1[outside] = -np.inf
+
+    #parameter interval inside the slab of each cylinder
+    tz0, tz1 = _get_slab_intervals(cell.zstart, cell.zend, z.T)
+    t0 = np.maximum(tr0, tz0)
+    t1 = np.minimum(tr1, tz1)
+    fraction = np.clip(t1 - t0, 0., None)
+
+    volume = np.pi * r**2 * (z[:, 1] - z[:, 0])
+    return fraction / volume[:, np.newaxis]
+
+
+def _get_slab_intervals(start, end, edges):
+    '''
+    Return the intervals [t0, t1] of the line parameter t in [0, 1], for the
+    lines from start to end inside the slabs between consecutive edges. If
+    edges is 2D, its rows are the lower and upper bounds of the slabs.
+    Empty intervals have t0 >= t1.
+    '''
+    if edges.ndim == 1:
+        lower = edges[:-1, np.newaxis]
+        upper = edges[1:, np.newaxis]
+    else:
+        lower = edges[0][:, np.newaxis]
+        upper = edges[1][:, np.newaxis]
+    d = end - start
+    moving = d != 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ta = np.where(moving, (lower - start) / d, -np.inf)
+        tb = np.where(moving, (upper - start) / d, np.inf)
+    t0 = np.clip(np.minimum(ta, tb), 0., 1.)
+    t1 = np.clip(np.maximum(ta, tb), 0., 1.)
+    #lines in the plane of an axis are inside the slab or not at all
+    outside = ~moving & ((start < lower) | (start >= upper))
+    t0[outside] = 1.
+    t1[outside] = 0.
+    return t0, t1
@@ -0,0 +1,4 @@
+#!/usr/bin/env python
+'''Cython builds of LFPy/lfpcalc.pyx, LFPy/run_simulation.pyx and
+LFPy/alias_method.pyx, compiled by setup.py and used by the 'cython'
+backend in LFPy.backends.'''
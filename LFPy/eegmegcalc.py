@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+'''Copyright (C) 2012 Computational Neuroscience Group, NMBU.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+EEG and MEG signals of current dipole moments, see
+Cell.simulate(rec_current_dipole_moment=True), and magnetic fields of the
+axial currents of cells, see Cell.simulate(rec_magnetic_field=...).'''
+
+from __future__ import division
+import numpy as np
+
+
+def get_biot_savart_coeffs(rstart, rend, r_sensors):
+    '''
+    Coefficients of the magnetic field at sensor locations of currents along
+    straight line segments in an infinite homogeneous medium, from the
+    Biot-Savart law of a finite wire, e.g., of the axial currents of
+    Cell.get_axial_current_coeffs.
+
+    Arguments:
+    ::
+
+        rstart, rend : np.ndarray, shape (n_lines, 3), start and end points
+            of the lines (mum), the currents are positive from start to end
+        r_sensors : np.ndarray, shape (n_sensors, 3), sensor locations (mum)
+
+    Returns:
+    ::
+
+        np.ndarray, shape (n_sensors * 3, n_lines), multiplied with the
+            currents (nA) gives the x-, y- and z-components of the magnetic
+            field (nT) at the sensors, i.e., reshapes to (n_sensors, 3, ...)
+    '''
+    rstart = np.array(rstart, dtype=float).reshape(-1, 3)
+    rend = np.array(rend, dtype=float).reshape(-1, 3)
+    r_sensors = np.array(r_sensors, dtype=float).reshape(-1, 3)
+
+    #vectors from the ends of the lines to the sensors
+    dl = rend - rstart
+    r1 = r_sensors[:, np.newaxis, :] - rstart[np.newaxis, :, :]
+    r2 = r_sensors[:, np.newaxis, :] - rend[np.newaxis, :, :]
+    d1 = np.sqrt((r1**2).sum(axis=2))
+    d2 = np.sqrt((r2**2).sum(axis=2))
+
+    #B = mu0 I / (4 pi) (d1 + d2) / (d1 d2 (d1 d2 + r1.r2)) dl x r1, where
+    #d1 d2 + r1.r2 = |r1 x r2|**2 / (d1 d2 - r1.r2) and r1 x r2 = dl x r1
+    #avoid cancellation beside the line, and the field is zero on the line
+    cross = np.cross(dl[np.newaxis, :, :], r1)
+    dot = (r1 * r2).sum(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(dot >= 0,
+                          (d1 + d2) / (d1 * d2 * (d1 * d2 + dot)),
+                          (d1 + d2) * (d1 * d2 - dot) /
+                          (d1 * d2 * (cross**2).sum(axis=2)))
+    factor[~np.isfinite(factor)] = 0.
+
+    #mu0 / (4 pi) nA / mum = 1E-7 T m / A * 1E-9 A / 1E-6 m = 0.1 nT
+    coeffs = 0.1 * factor[:, :, np.newaxis] * cross
+    return coeffs.transpose(0, 2, 1).reshape(-1, rstart.shape[0])
+
+
+class FourSphereVolumeConductor(object):
+    '''
+    Potentials at EEG electrodes of a four-sphere head model consisting of
+    brain, cerebrospinal fluid (CSF), skull and scalp, due to current
+    dipoles in the brain sphere (Naess et al. 2017, Front. Comput. Neurosci.
+    11:69). The head is centered at the origin, and the potential is
+    expanded in Legendre polynomials, where the coefficients of each order
+    follow from the boundary conditions at the four spherical surfaces.
+
+    The lead field of a dipole location, i.e., the matrix mapping the
+    dipole moment to the electrode potentials, is calculated once and kept
+    for later calls.
+
+    Arguments:
+    ::
+
+        radii : list, outer radii of brain, CSF, skull and scalp (mum)
+        sigmas : list, conductivities of brain, CSF, skull and scalp (S/m)
+        r_electrodes : np.ndarray, shape (n_contacts, 3), positions of
+            the electrodes relative to the center of the head (mum)
+        tol : float, relative tolerance for truncating the Legendre series
+        nmax : int, maximum number of terms of the series
+    '''
+    def __init__(self, radii=[79000., 80000., 85000., 90000.],
+                 sigmas=[0.3, 1.5, 0.015, 0.3],
+                 r_electrodes=np.array([[0., 0., 90000.]]),
+                 tol=1E-10, nmax=10000):
+        '''Initialize class FourSphereVolumeConductor'''
+        self.radii = np.array(radii, dtype=float)
+        self.sigmas = np.array(sigmas, dtype=float)
+        if self.radii.shape != (4, ) or self.sigmas.shape != (4, ):
+            raise ValueError('radii and sigmas must have 4 elements')
+        if np.any(np.diff(self.radii) <= 0):
+            raise ValueError('radii must be increasing')
+        self.r_electrodes = np.array(r_electrodes, dtype=float).reshape(-1, 3)
+        self.r = np.sqrt((self.r_electrodes**2).sum(axis=1))
+        if np.any(self.r > self.radii[-1]):
+            raise ValueError('electrodes must be inside the scalp sphere')
+        #sphere of each electrode
+        self.region = np.searchsorted(self.radii, self.r)
+        self.tol = tol
+        self.nmax = nmax
+
+        self._lead_fields = {}
+
+    def calc_potential(self, p, rz):
+        '''
+        Calculate the potential at the electrodes of a current dipole.
+
+        Arguments:
+        ::
+
+            p : np.ndarray, shape (3, n_timesteps), current dipole moment
+                (nA mum), e.g., cell.current_dipole_moment
+            rz : np.ndarray, shape (3, ), position of the dipole (mum)
+
+        Returns:
+        ::
+
+            np.ndarray, shape (n_contacts, n_timesteps), potential (mV)
+        '''
+        return np.dot(self.get_lead_field(rz), p)
+
+    def calc_potential_from_cells(self, cells, location='somapos'):
+        '''
+        Calculate the potential at the electrodes of a population of cells,
+        each represented by its current dipole moment at one location. The
+        lead fields of all cells are stacked, so that the potential is one
+        matrix product.
+
+        Arguments:
+        ::
+
+            cells : list of Cell objects simulated with
+                rec_current_dipole_moment=True
+            location : str, 'somapos' for the dipoles at cell.somapos,
+                'midpoints' for the mean of the segment midpoints
+
+        Returns:
+        ::
+
+            np.ndarray, shape (n_contacts, n_timesteps), potential (mV)
+        '''
+        rzs = np.array([self._get_dipole_location(cell, location)
+                        for cell in cells])
+        lead_fields = self.get_lead_fields(rzs)
+        M = np.concatenate(list(lead_fields), axis=1)
+        P = np.concatenate([cell.current_dipole_moment for cell in cells])
+        return np.dot(M, P)
+
+    def get_lead_field(self, rz):
+        '''
+        Return the lead field of a dipole at rz (mum), np.ndarray with shape
+        (n_contacts, 3), mapping a dipole moment (nA mum) to the potential at
+        the electrodes (mV).
+        '''
+        return self.get_lead_fields(np.array(rz).reshape(1, 3))[0]
+
+    def get_lead_fields(self, rzs):
+        '''
+        Return the lead fields of dipoles at the rows of rzs (mum),
+        np.ndarray with shape (n_dipoles, n_contacts, 3). Lead fields not
+        calculated before are calculated together.
+        '''
+        rzs = np.array(rzs, dtype=float).reshape(-1, 3)
+        keys = [tuple(rz) for rz in rzs]
+        new = []
+        for key in keys:
+            if key not in self._lead_fields and key not in new:
+                new.append(key)
+        if len(new) > 0:
+            for key, lead_field in zip(new,
+                                       self._calc_lead_fields(np.array(new))):
+                self._lead_fields[key] = lead_field
+        return np.array([self._lead_fields[key] for key in keys])
+
+    def _get_dipole_location(self, cell, location):
+        '''Return the dipole location of cell'''
+        if location == 'somapos':
+            return cell.somapos
+        elif location == 'midpoints':
+            return np.array([cell.xmid.mean(), cell.ymid.mean(),
+                             cell.zmid.mean()])
+        else:
+            raise ValueError("location must be 'somapos' or 'midpoints'")
+
+    def _calc_lead_fields(self, rzs):
+        '''
+        Calculate the lead fields of dipoles at the rows of rzs, summing the
+        Legendre series of all dipoles and electrodes together
+        '''
+        z = np.sqrt((rzs**2).sum(axis=1))
+        if np.any(z == 0) or np.any(z >= self.radii[0]):
+            raise ValueError('dipoles must be inside the brain sphere, '
+                             'away from the center')
+        if np.any(self.r[np.newaxis, :] <= z[:, np.newaxis]):
+            raise ValueError('electrodes must be farther from the center '
+                             'than the dipoles')
+
+        #radial unit vectors of the dipoles, and unit vectors tangential to
+        #the sphere pointing towards the electrodes
+        e_z = rzs / z[:, np.newaxis]
+        e_r = self.r_electrodes / self.r[:, np.newaxis]
+        cos_theta = np.clip(np.dot(e_z, e_r.T), -1., 1.)
+        sin_theta = np.sqrt(1. - cos_theta**2)
+        e_t = e_r[np.newaxis, :, :] - \
+            cos_theta[:, :, np.newaxis] * e_z[:, np.newaxis, :]
+        e_t[sin_theta > 0] /= sin_theta[sin_theta > 0][:, np.newaxis]
+        e_t[sin_theta == 0] = 0.
+
+        #the radial functions of order n of electrodes in sphere k are
+        #A_k (r / R_k)**n + B_k (R_k-1 / r)**(n + 1), with R_0 = z
+        Rinner = np.r_[0., self.radii][self.region]
+        ratio_a = self.r / self.radii[self.region]
+        ratio_b = np.where(self.region == 0, z[:, np.newaxis], Rinner) / \
+            self.r
+        pow_a = np.ones(z.shape + self.r.shape)
+        pow_b = ratio_b.copy()
+
+        S_rad = np.zeros(pow_a.shape)
+        S_tan = np.zeros(pow_a.shape)
+        P = [np.ones(pow_a.shape), cos_theta]
+        P1 = [np.zeros(pow_a.shape), sin_theta]
+        nblock = 100
+        for n0 in range(1, self.nmax + 1, nblock):
+            n = np.arange(n0, min(n0 + nblock, self.nmax + 1))
+            A, B = self._get_coefficients(z, n)
+            blockmax = 0.
+            for j, nj in enumerate(n):
+                if nj > 1:
+                    P = [P[1], ((2 * nj - 1) * cos_theta * P[1] -
+                                (nj - 1) * P[0]) / nj]
+                    P1 = [P1[1], ((2 * nj - 1) * cos_theta * P1[1] -
+                                  nj * P1[0]) / (nj - 1)]
+                pow_a *= ratio_a
+                pow_b *= ratio_b
+                F = A[:, j, self.region] * pow_a + B[:, j, self.region] * pow_b
+                S_rad += nj * F * P[1]
+                S_tan += F * P1[1]
+                blockmax = max(blockmax, abs(nj * F).max())
+            if blockmax <= self.tol * max(abs(S_rad).max(), abs(S_tan).max()):
+                break
+
+        #potential of a dipole in an infinite medium in the brain sphere
+        const = 1. / (4 * np.pi * self.sigmas[0] * z**2)
+        return const[:, np.newaxis, np.newaxis] * (
+            S_rad[:, :, np.newaxis] * e_z[:, np.newaxis, :] +
+            S_tan[:, :, np.newaxis] * e_t)
+
+    def _get_coefficients(self, z, n):
+        '''
+        Solve the boundary conditions of the radial functions of order n
+        for dipoles at distances z from the center, in units of the
+        potential of the dipole in an infinite medium, i.e., B_1 = 1. The
+        potential and the normal current are continuous at the surfaces of
+        the brain, CSF and skull, and no current leaves the scalp.
+
+        Returns:
+        ::
+
+            A, B : np.ndarray, shape (n_dipoles, len(n), 4), coefficients
+                of the four spheres
+        '''
+        R = self.radii
+        sigma = self.sigmas
+        shape = z.shape + n.shape
+        n = n[np.newaxis, :]
+        #unknowns A_1, A_2, B_2, A_3, B_3, A_4, B_4
+        M = np.zeros(shape + (7, 7))
+        rhs = np.zeros(shape + (7, ))
+        q1 = (z[:, np.newaxis] / R[0])**(n + 1)
+        for k in range(3):
+            #column of A_k and B_k of the inner sphere, and of the outer one
+            iA = 2 * k - 1 if k > 0 else 0
+            jA, jB = 2 * k + 1, 2 * k + 2
+            p = (R[k] / R[k + 1])**n
+            if k == 0:
+                M[..., 0, iA] = 1.
+                M[..., 1, iA] = sigma[0] * n
+                rhs[..., 0] = -q1
+                rhs[..., 1] = sigma[0] * (n + 1) * q1
+            else:
+                q = (R[k - 1] / R[k])**(n + 1)
+                M[..., 2 * k, iA] = 1.
+                M[..., 2 * k, iA + 1] = q
+                M[..., 2 * k + 1, iA] = sigma[k] * n
+                M[..., 2 * k + 1, iA + 1] = -sigma[k] * (n + 1) * q
+            M[..., 2 * k, jA] = -p
+            M[..., 2 * k, jB] = -1.
+            M[..., 2 * k + 1, jA] = -sigma[k + 1] * n * p
+            M[..., 2 * k + 1, jB] = sigma[k + 1] * (n + 1)
+        M[..., 6, 5] = n
+        M[..., 6, 6] = -(n + 1) * (R[2] / R[3])**(n + 1)
+        x = np.linalg.solve(M, rhs[..., np.newaxis])[..., 0]
+
+        A = x[..., [0, 1, 3, 5]]
+        B = np.concatenate([np.ones(shape + (1, )), x[..., [2, 4, 6]]],
+                           axis=-1)
+        return A, B
@@ -12,10 +12,14 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.'''
 
 import numpy as np
+import scipy.sparse as sparse
+from scipy.spatial import cKDTree
+from multiprocessing.pool import ThreadPool
 
 def calc_lfp_choose(cell, x=0., y=0., z=0., sigma=0.3,
                     r_limit=None,
-                    timestep=None, t_indices=None, method='linesource'):
+                    timestep=None, t_indices=None, method='linesource',
+                    return_clamped=False):
     '''
     Determine which method to use, line-source for soma default
     
@@ -32,23 +36,28 @@ def calc_lfp_choose(cell, x=0., y=0., z=0., sigma=0.3,
         t_indices : [None]/np.ndarray, calculate LFP at specific timesteps
         method=['linesource']/'pointsource'/'som_as_point'
             switch for choosing underlying methods
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
     '''
     if method == 'som_as_point':
         return calc_lfp_som_as_point(cell, x=x, y=y, z=z, sigma=sigma,
                                      r_limit=r_limit,
-                                     timestep=timestep, t_indices=t_indices)
+                                     timestep=timestep, t_indices=t_indices,
+                                     return_clamped=return_clamped)
     elif method == 'linesource':
         return calc_lfp_linesource(cell, x=x, y=y, z=z, sigma=sigma,
                                    r_limit=r_limit,
-                                   timestep=timestep, t_indices=t_indices)
+                                   timestep=timestep, t_indices=t_indices,
+                                   return_clamped=return_clamped)
     elif method == 'pointsource':
         return calc_lfp_pointsource(cell, x=x, y=y, z=z, sigma=sigma,
                                     r_limit=r_limit,
-                                    timestep=timestep, t_indices=t_indices)
+                                    timestep=timestep, t_indices=t_indices,
+                                    return_clamped=return_clamped)
 
 def calc_lfp_linesource(cell, x=0., y=0., z=0., sigma=0.3,
                         r_limit=None,
-                        timestep=None, t_indices=None):
+                        timestep=None, t_indices=None, return_clamped=False):
     '''Calculate electric field potential using the line-source method, all
     compartments treated as line sources, even soma.
     
@@ -63,14 +72,10 @@ def calc_lfp_linesource(cell, x=0., y=0., z=0., sigma=0.3,
         r_limit : [None]/float/np.ndarray: minimum distance to source current
         timestep : [None]/int, calculate LFP at this timestep
         t_indices : [None]/np.ndarray, calculate LFP at specific timesteps
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
     '''
-    # Handling the r_limits. If a r_limit is a single value, an array r_limit
-    # of shape cell.diam is returned.
-    if type(r_limit) == int or type(r_limit) == float:
-        r_limit = np.ones(np.shape(cell.diam))*abs(r_limit)
-    elif np.shape(r_limit) != np.shape(cell.diam):
-        raise Exception('r_limit is neither a float- or int- value, nor is \
-            r_limit.shape() equal to cell.diam.shape()')
+    r_limit = _r_limit_calc(cell, r_limit)
     
     if timestep is not None:
         currmem = cell.imem[:, timestep]
@@ -79,46 +84,18 @@ def calc_lfp_linesource(cell, x=0., y=0., z=0., sigma=0.3,
     else:
         currmem = cell.imem
 
-    #some variables for h, r2, r_soma calculations
-    xstart = cell.xstart
-    xend = cell.xend
-    ystart = cell.ystart
-    yend = cell.yend
-    zstart = cell.zstart
-    zend = cell.zend
+    coeffs, clamped = _linesource_coeffs(cell, x, y, z, sigma, r_limit)
     
-    deltaS = _deltaS_calc(xstart, xend, ystart, yend, zstart, zend)
-    h = _h_calc(xstart, xend, ystart, yend, zstart, zend, deltaS, x, y, z)
-    r2 = _r2_calc(xend, yend, zend, x, y, z, h)
-
-    r2 = _check_rlimit(r2, r_limit, h, deltaS)
-    
-    l = h + deltaS
-
-    hnegi = h < 0
-    hposi = h >= 0
-    lnegi = l < 0
-    lposi = l >= 0
-
-    #case i, h < 0, l < 0
-    [i] = np.where(hnegi & lnegi)
-    #case ii, h < 0, l >= 0
-    [ii] = np.where(hnegi & lposi)
-    #case iii, h >= 0, l >= 0
-    [iii] = np.where(hposi & lposi)
-    
-    Ememi = _Ememi_calc(i, currmem, sigma, deltaS, l, r2, h)
-    Ememii = _Ememii_calc(ii, currmem, sigma, deltaS, l, r2, h)
-    Ememiii = _Ememiii_calc(iii, currmem, sigma, deltaS, l, r2, h)
-    
-    
-    Emem = Ememi + Ememii + Ememiii
+    Emem = np.dot(currmem.T, coeffs)
     
+    if return_clamped:
+        return Emem.transpose(), np.nonzero(clamped)[0]
     return Emem.transpose()
 
 def calc_lfp_som_as_point(cell, x=0., y=0., z=0., sigma=0.3,
                           r_limit=None,
-                          timestep=None, t_indices=None):
+                          timestep=None, t_indices=None,
+                          return_clamped=False):
     '''Calculate electric field potential using the line-source method,
     soma is treated as point/sphere source
     
@@ -133,24 +110,10 @@ def calc_lfp_som_as_point(cell, x=0., y=0., z=0., sigma=0.3,
         r_limit : [None]/float/np.ndarray: minimum distance to source current
         timestep : [None]/int, calculate LFP at this timestep
         t_indices : [None]/np.ndarray, calculate LFP at specific timesteps
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit, 0 for the soma
     '''
-    #Handling the r_limits. If a r_limit is a single value,
-    #an array r_limit of shape cell.diam is returned.
-    if type(r_limit) != type(np.array([])):
-        r_limit = np.array(r_limit)
-    if r_limit.shape == ():
-        s_limit = r_limit
-        r_limit = np.ones(cell.diam.size) * abs(r_limit)
-    elif r_limit.shape == (2, ):
-        s_limit = abs(r_limit[0])
-        r_limit = np.ones(cell.diam.size) * abs(r_limit[1])
-    elif r_limit.shape == cell.diam.shape:
-        s_limit = r_limit[0]
-        r_limit = r_limit
-    else:
-        raise Exception('r_limit is neither a float- or int- value, \
-            on the form r_limit=[s_limit, r_limit],  \
-            nor is shape(r_limit) equal to shape(cell.diam)!')
+    s_limit, r_limit = _rs_limit_calc(cell, r_limit)
 
     if timestep is not None:
         currmem = cell.imem[:, timestep]
@@ -159,36 +122,37 @@ def calc_lfp_som_as_point(cell, x=0., y=0., z=0., sigma=0.3,
     else:
         currmem = cell.imem
 
-    #some variables for h, r2, r_soma calculations
-    xstart = cell.xstart
-    xmid = cell.xmid[0]
-    xend = cell.xend
-    ystart = cell.ystart
-    ymid = cell.ymid[0]
-    yend = cell.yend
-    zstart = cell.zstart
-    zmid = cell.zmid[0]
-    zend = cell.zend
+    coeffs, clamped = _som_as_point_coeffs(cell, x, y, z, sigma, r_limit,
+                                           s_limit)
+    
+    Emem = np.dot(currmem.T, coeffs)
 
+    if return_clamped:
+        return Emem.transpose(), np.nonzero(clamped)[0]
+    return Emem.transpose()
 
+def _linesource_coeffs(cell, x, y, z, sigma, r_limit, idx=None):
+    '''Coefficients mapping the membrane currents of all segments, or of the
+    segments idx, onto the potential at (x, y, z) with the line-source
+    method, and the boolean mask of the segments whose distance was raised
+    to r_limit'''
+    if idx is None:
+        idx = slice(None)
+    #some variables for h, r2 calculations
+    xstart = cell.xstart[idx]
+    xend = cell.xend[idx]
+    ystart = cell.ystart[idx]
+    yend = cell.yend[idx]
+    zstart = cell.zstart[idx]
+    zend = cell.zend[idx]
+    r_limit = r_limit[idx]
+    
     deltaS = _deltaS_calc(xstart, xend, ystart, yend, zstart, zend)
     h = _h_calc(xstart, xend, ystart, yend, zstart, zend, deltaS, x, y, z)
     r2 = _r2_calc(xend, yend, zend, x, y, z, h)
-    r_soma = _r_soma_calc(xmid, ymid, zmid, x, y, z)
-    if r_soma < s_limit:
-        print('Adjusting r-distance to soma segment from %g to %g'
-                % (r_soma, s_limit))
-        r_soma = s_limit
-
-    # Check that no segment is closer to the electrode than r_limit
-    if np.sum(np.nonzero( r2 < r_limit*r_limit )) > 0:
-        for idx in np.nonzero( r2[1:] < r_limit[1:] * r_limit[1:] )[0]+1:
-            if (h[idx] < r_limit[idx]) and \
-            ((deltaS[idx] + h[idx]) > -r_limit[idx]):
-                print('Adjusting distance to segment %s from %.2f to %.2f.'
-                      % (idx, r2[idx]**0.5, r_limit[idx]))
-                r2[idx] = r_limit[idx] * r_limit[idx]
 
+    clamped = _check_rlimit(r2, r_limit, h, deltaS)
+    
     l = h + deltaS
 
     hnegi = h < 0
@@ -196,32 +160,41 @@ def calc_lfp_som_as_point(cell, x=0., y=0., z=0., sigma=0.3,
     lnegi = l < 0
     lposi = l >= 0
 
-    # Ensuring that soma is not treated as line-source
-    hnegi[0] = hposi[0] = lnegi[0] = lposi[0] = False
+    coeffs = np.zeros(deltaS.size)
 
-    #Line sources
-    #case i,  h < 0,  l < 0
-    i = np.where(hnegi & lnegi)
-    #case ii,  h < 0,  l >= 0
-    ii = np.where(hnegi & lposi)
-    #case iii,  h >= 0,  l >= 0
-    iii = np.where(hposi & lposi)
+    #case i, h < 0, l < 0
+    [i] = np.where(hnegi & lnegi)
+    #case ii, h < 0, l >= 0
+    [ii] = np.where(hnegi & lposi)
+    #case iii, h >= 0, l >= 0
+    [iii] = np.where(hposi & lposi)
     
-    Ememi = _Ememi_calc(i, currmem, sigma, deltaS, l, r2, h)
-    Ememii = _Ememii_calc(ii, currmem, sigma, deltaS, l, r2, h)
-    Ememiii = _Ememiii_calc(iii, currmem, sigma, deltaS, l, r2, h)
-
-    #Potential contribution from soma
-    Emem0 = currmem[0]/(4 * np.pi * sigma * r_soma)
-
-    #Summarizing all potential contributions
-    Emem = Emem0 + Ememi + Ememiii + Ememii
-
-    return Emem.transpose()
-
-def _Ememi_calc(i, currmem, sigma, deltaS, l, r2, h):
-    '''Subroutine used by calc_lfp_*()'''
-    currmem_iT = currmem[i].transpose()
+    coeffs[i] = _coeffsi_calc(i, sigma, deltaS, l, r2, h)
+    coeffs[ii] = _coeffsii_calc(ii, sigma, deltaS, l, r2, h)
+    coeffs[iii] = _coeffsiii_calc(iii, sigma, deltaS, l, r2, h)
+    
+    return coeffs, clamped
+
+def _som_as_point_coeffs(cell, x, y, z, sigma, r_limit, s_limit, idx=None):
+    '''Coefficients mapping the membrane currents of all segments, or of the
+    sorted segments idx, onto the potential at (x, y, z) with the
+    line-source method, soma as point source, and the boolean mask of the
+    segments whose distance was raised to r_limit, or s_limit for the soma'''
+    coeffs, clamped = _linesource_coeffs(cell, x, y, z, sigma, r_limit, idx)
+
+    # Potential contribution from soma, the first segment
+    if idx is None or (len(idx) > 0 and idx[0] == 0):
+        r_soma = _r_soma_calc(cell.xmid[0], cell.ymid[0], cell.zmid[0],
+                              x, y, z)
+        clamped[0] = r_soma < s_limit
+        if clamped[0]:
+            r_soma = s_limit
+        coeffs[0] = 1. / (4 * np.pi * sigma * r_soma)
+
+    return coeffs, clamped
+
+def _coeffsi_calc(i, sigma, deltaS, l, r2, h):
+    '''Subroutine used by _*_coeffs()'''
     deltaS_i = deltaS[i]
     l_i = l[i]
     r2_i = r2[i]
@@ -232,13 +205,10 @@ def _Ememi_calc(i, currmem, sigma, deltaS, l, r2, h):
     cc = np.sqrt(l_i**2 + r2_i) - l_i
     dd = np.log(bb / cc) / aa
     
-    Emem_i = np.dot(currmem_iT, dd)
-    
-    return Emem_i
+    return dd
 
-def _Ememii_calc(ii, currmem, sigma, deltaS, l, r2, h):
-    '''Subroutine used by calc_lfp_*()'''
-    currmem_iiT = currmem[ii].transpose()
+def _coeffsii_calc(ii, sigma, deltaS, l, r2, h):
+    '''Subroutine used by _*_coeffs()'''
     deltaS_ii = deltaS[ii]
     l_ii = l[ii]
     r2_ii = r2[ii]
@@ -249,13 +219,10 @@ def _Ememii_calc(ii, currmem, sigma, deltaS, l, r2, h):
     cc = (l_ii + np.sqrt(l_ii**2 + r2_ii)) / r2_ii
     dd = np.log(bb * cc) / aa
     
-    Emem_ii = np.dot(currmem_iiT, dd)
-    
-    return Emem_ii
+    return dd
     
-def _Ememiii_calc(iii, currmem, sigma, deltaS, l, r2, h):
-    '''Subroutine used by calc_lfp_*()'''
-    currmem_iiiT = currmem[iii].transpose()
+def _coeffsiii_calc(iii, sigma, deltaS, l, r2, h):
+    '''Subroutine used by _*_coeffs()'''
     l_iii = l[iii]
     r2_iii = r2[iii]
     h_iii = h[iii]
@@ -266,9 +233,7 @@ def _Ememiii_calc(iii, currmem, sigma, deltaS, l, r2, h):
     cc = np.sqrt(h_iii**2 + r2_iii) + h_iii
     dd = np.log(bb / cc) / aa
 
-    Emem_iii = np.dot(currmem_iiiT, dd)
-    
-    return Emem_iii
+    return dd
 
 def _deltaS_calc(xstart, xend, ystart, yend, zstart, zend):
     '''Subroutine used by calc_lfp_*()'''
@@ -279,9 +244,10 @@ def _deltaS_calc(xstart, xend, ystart, yend, zstart, zend):
 
 def _h_calc(xstart, xend, ystart, yend, zstart, zend, deltaS, x, y, z):
     '''Subroutine used by calc_lfp_*()'''
-    aa = np.array([x - xend, y - yend, z-zend])
-    bb = np.array([xend - xstart, yend - ystart, zend - zstart])
-    cc = np.dot(aa.T, bb).diagonal()
+    #projection of the electrode position onto each segment, row by row,
+    #so that time and memory are linear in the number of segments
+    cc = (x - xend) * (xend - xstart) + (y - yend) * (yend - ystart) + \
+        (z - zend) * (zend - zstart)
     hh = cc / deltaS
     return hh
 
@@ -289,18 +255,15 @@ def _r2_calc(xend, yend, zend, x, y, z, h):
     '''Subroutine used by calc_lfp_*()'''
     r2 = (x-xend)**2 + (y-yend)**2 + (z-zend)**2 - h**2
     
-    return abs(r2)
+    return np.abs(r2)
 
 def _check_rlimit(r2, r_limit, h, deltaS):
-    '''Check that no segment is close the electrode than r_limit'''
-    if np.sum(np.nonzero( r2 < r_limit*r_limit )) > 0:
-        for idx in np.nonzero( r2 < r_limit*r_limit )[0]:
-            if (h[idx] < r_limit[idx]) and ((deltaS[idx]+h[idx]) >
-                                             -r_limit[idx]):
-                print('Adjusting distance to segment %s from %.2f to %.2f.'
-                      % (idx, r2[idx]**0.5, r_limit[idx]))
-                r2[idx] = r_limit[idx]**2
-    return r2
+    '''Correct r2 in place so that no segment is closer to the electrode
+    than r_limit, returns the boolean mask of the corrected segments'''
+    clamped = (r2 < r_limit*r_limit) & (h < r_limit) & \
+        (deltaS + h > -r_limit)
+    r2[clamped] = r_limit[clamped]**2
+    return clamped
 
 def _r_soma_calc(xmid, ymid, zmid, x, y, z):
     '''calculate the distance to soma midpoint'''
@@ -311,7 +274,7 @@ def _r_soma_calc(xmid, ymid, zmid, x, y, z):
 
 def calc_lfp_pointsource(cell, x=0, y=0, z=0, sigma=0.3,
                         r_limit=None, 
-                        timestep=None, t_indices=None):
+                        timestep=None, t_indices=None, return_clamped=False):
     '''Calculate local field potentials using the point-source equation on all
     compartments
 
@@ -326,14 +289,10 @@ def calc_lfp_pointsource(cell, x=0, y=0, z=0, sigma=0.3,
         r_limit : [None]/float/np.ndarray: minimum distance to source current
         timestep : [None]/int, calculate LFP at this timestep
         t_indices : [None]/np.ndarray, calculate LFP at specific timesteps
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
     '''
-    # Handling the r_limits. If a r_limit is a single value, an array r_limit
-    # of shape cell.diam is returned.
-    if type(r_limit) == int or type(r_limit) == float:
-        r_limit = np.ones(np.shape(cell.diam))*abs(r_limit)
-    elif np.shape(r_limit) != np.shape(cell.diam):
-        raise Exception('r_limit is neither a float- or int- value, nor is \
-            r_limit.shape() equal to cell.diam.shape()')
+    r_limit = _r_limit_calc(cell, r_limit)
 
     if timestep is not None:
         currmem = cell.imem[:, timestep]
@@ -342,17 +301,239 @@ def calc_lfp_pointsource(cell, x=0, y=0, z=0, sigma=0.3,
     else:
         currmem = cell.imem
     
-    r2 = (cell.xmid - x)**2 + (cell.ymid - y)**2 + (cell.zmid - z)**2
-    r2 = _check_rlimit_point(r2, r_limit)
-    r = np.sqrt(r2)
+    coeffs, clamped = _pointsource_coeffs(cell, x, y, z, sigma, r_limit)
     
-    Emem = 1 / (4 * np.pi * sigma) * np.dot(currmem.T, 1/r)
+    Emem = np.dot(currmem.T, coeffs)
     
+    if return_clamped:
+        return Emem.transpose(), np.nonzero(clamped)[0]
     return Emem.transpose()
 
+def _pointsource_coeffs(cell, x, y, z, sigma, r_limit, idx=None):
+    '''Coefficients mapping the membrane currents of all segments, or of the
+    segments idx, onto the potential at (x, y, z) with the point-source
+    method, and the boolean mask of the segments whose distance was raised
+    to r_limit'''
+    if idx is None:
+        idx = slice(None)
+    r2 = (cell.xmid[idx] - x)**2 + (cell.ymid[idx] - y)**2 + \
+        (cell.zmid[idx] - z)**2
+    clamped = _check_rlimit_point(r2, r_limit[idx])
+    r = np.sqrt(r2)
+    
+    return 1 / (4 * np.pi * sigma * r), clamped
+
 def _check_rlimit_point(r2, r_limit):
-    '''Correct r2 so that r2 >= r_limit**2 for all values'''
+    '''Correct r2 in place so that r2 >= r_limit**2 for all values, returns
+    the boolean mask of the corrected segments'''
     inds = r2 < r_limit*r_limit
     r2[inds] = r_limit[inds]*r_limit[inds]
     
-    return r2
+    return inds
+
+def _r_limit_calc(cell, r_limit):
+    '''Handling the r_limits. If a r_limit is a single value, an array
+    r_limit of shape cell.diam is returned.'''
+    if type(r_limit) == int or type(r_limit) == float:
+        r_limit = np.ones(np.shape(cell.diam))*abs(r_limit)
+    elif np.shape(r_limit) != np.shape(cell.diam):
+        raise Exception('r_limit is neither a float- or int- value, nor is \
+            r_limit.shape() equal to cell.diam.shape()')
+    return r_limit
+
+def _rs_limit_calc(cell, r_limit):
+    '''Handling the r_limits of the som_as_point method. If a r_limit is a
+    single value, an array r_limit of shape cell.diam is returned, together
+    with the soma limit s_limit.'''
+    if type(r_limit) != type(np.array([])):
+        r_limit = np.array(r_limit)
+    if r_limit.shape == ():
+        s_limit = r_limit
+        r_limit = np.ones(cell.diam.size) * abs(r_limit)
+    elif r_limit.shape == (2, ):
+        s_limit = abs(r_limit[0])
+        r_limit = np.ones(cell.diam.size) * abs(r_limit[1])
+    elif r_limit.shape == cell.diam.shape:
+        s_limit = r_limit[0]
+        r_limit = r_limit
+    else:
+        raise Exception('r_limit is neither a float- or int- value, \
+            on the form r_limit=[s_limit, r_limit],  \
+            nor is shape(r_limit) equal to shape(cell.diam)!')
+    return s_limit, r_limit
+
+def calc_mapping(cell, x, y, z, sigma=0.3, r_limit=None,
+                 method='linesource', n_threads=1, return_clamped=False):
+    '''
+    Calculate the matrix mapping the membrane currents of all segments of
+    cell onto the extracellular potential at each contact, so that the
+    potential is np.dot(mapping, cell.imem). The contacts are split in
+    n_threads blocks filled by a pool of threads. Each row takes a few short
+    NumPy calls on arrays of cell.totnsegs elements, which mostly hold the
+    GIL, so threads give little speedup with the numpy and numba backends.
+    The cython backend fills the rows without the GIL and scales with
+    n_threads.
+    
+    Arguments:
+    ::
+        
+        cell: LFPy.Cell or LFPy.TemplateCell instance
+        x : np.ndarray, extracellular positions, x-axis
+        y : np.ndarray, extracellular positions, y-axis
+        z : np.ndarray, extracellular positions, z-axis
+        sigma : double, extracellular conductivity
+        r_limit : [None]/float/np.ndarray: minimum distance to source current
+        method : ['linesource']/'pointsource'/'som_as_point'
+        n_threads : int, number of threads
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
+    
+    Returns:
+    ::
+        
+        mapping : np.ndarray, shape (number of contacts, cell.totnsegs)
+        clamped : list of np.ndarray, if return_clamped, the indices of the
+            segments whose distance was raised to r_limit for each contact
+    '''
+    x = np.array(x, dtype=float).flatten()
+    y = np.array(y, dtype=float).flatten()
+    z = np.array(z, dtype=float).flatten()
+    coeffs = _coeffs_function(cell, sigma, r_limit, method)
+    
+    mapping = np.empty((x.size, cell.totnsegs))
+    clamped = np.empty((x.size, cell.totnsegs), dtype=bool)
+    def fill(contacts):
+        for i in contacts:
+            mapping[i], clamped[i] = coeffs(x[i], y[i], z[i])
+    
+    _map_blocks(fill, _split_contacts(x.size, n_threads), n_threads)
+    
+    if return_clamped:
+        return mapping, [np.nonzero(row)[0] for row in clamped]
+    return mapping
+
+def calc_sparse_mapping(cell, x, y, z, sigma=0.3, r_limit=None,
+                        method='linesource', cutoff=100., n_threads=1,
+                        return_clamped=False):
+    '''
+    Calculate the sparse matrix mapping the membrane currents of the
+    segments of cell within a distance cutoff of each contact onto the
+    extracellular potential, so that the potential is mapping.dot(cell.imem).
+    The neighbouring segments are found with a KD-tree over the segment
+    midpoints, their coefficients are exact as in calc_mapping, those of the
+    other segments are dropped. As no point of a dropped segment is closer
+    than cutoff to the contact, the error of the potential is bounded by
+    bound times the summed absolute currents of the dropped segments.
+    
+    Arguments:
+    ::
+        
+        cell: LFPy.Cell or LFPy.TemplateCell instance
+        x : np.ndarray, extracellular positions, x-axis
+        y : np.ndarray, extracellular positions, y-axis
+        z : np.ndarray, extracellular positions, z-axis
+        sigma : double, extracellular conductivity
+        r_limit : [None]/float/np.ndarray: minimum distance to source current
+        method : ['linesource']/'pointsource'/'som_as_point'
+        cutoff : float, distance (mum) beyond which segments are dropped
+        n_threads : int, number of threads
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
+    
+    Returns:
+    ::
+        
+        mapping : scipy.sparse.csr_matrix, shape (number of contacts,
+            cell.totnsegs)
+        bound : np.ndarray, the bound of the absolute error of the potential
+            at each contact per nA of dropped current, 1 / (4 pi sigma
+            cutoff) or 0 if no segment is dropped
+        clamped : list of np.ndarray, if return_clamped, the indices of the
+            segments whose distance was raised to r_limit for each contact
+    '''
+    x = np.array(x, dtype=float).flatten()
+    y = np.array(y, dtype=float).flatten()
+    z = np.array(z, dtype=float).flatten()
+    coeffs = _coeffs_function(cell, sigma, r_limit, method)
+    
+    indices, indptr, bound = _sparse_pattern(cell, x, y, z, sigma, cutoff)
+    
+    data = np.empty(indices.size)
+    clamped = np.empty(indices.size, dtype=bool)
+    def fill(contacts):
+        for i in contacts:
+            row = slice(indptr[i], indptr[i + 1])
+            if indptr[i + 1] > indptr[i]:
+                data[row], clamped[row] = coeffs(x[i], y[i], z[i],
+                                                 indices[row])
+    
+    _map_blocks(fill, _split_contacts(x.size, n_threads), n_threads)
+    
+    mapping = sparse.csr_matrix((data, indices, indptr),
+                                shape=(x.size, cell.totnsegs))
+    if return_clamped:
+        return mapping, bound, [indices[indptr[i]:indptr[i + 1]][
+            clamped[indptr[i]:indptr[i + 1]]] for i in range(x.size)]
+    return mapping, bound
+
+def _coeffs_function(cell, sigma, r_limit, method):
+    '''Return the function coeffs(x, y, z, idx=None) of the coefficients of
+    the segments idx (all if None) at a contact at x, y, z and the boolean
+    array of the segments clamped to r_limit, for the given method'''
+    if method == 'som_as_point':
+        s_limit, r_limit = _rs_limit_calc(cell, r_limit)
+        def coeffs(x, y, z, idx=None):
+            return _som_as_point_coeffs(cell, x, y, z, sigma, r_limit,
+                                        s_limit, idx)
+    elif method == 'linesource':
+        r_limit = _r_limit_calc(cell, r_limit)
+        def coeffs(x, y, z, idx=None):
+            return _linesource_coeffs(cell, x, y, z, sigma, r_limit, idx)
+    elif method == 'pointsource':
+        r_limit = _r_limit_calc(cell, r_limit)
+        def coeffs(x, y, z, idx=None):
+            return _pointsource_coeffs(cell, x, y, z, sigma, r_limit, idx)
+    else:
+        raise ValueError('method must be linesource, pointsource or '
+                         'som_as_point, not %s' % method)
+    return coeffs
+
+def _split_contacts(ncontacts, n_threads):
+    '''Split the indices of ncontacts contacts into one block per thread'''
+    return np.array_split(np.arange(ncontacts),
+                          max(1, min(n_threads, ncontacts)))
+
+def _map_blocks(func, items, n_threads=1):
+    '''Return the list of func applied to each of items, called from a pool
+    of n_threads threads if n_threads > 1. Only faster than a loop when func
+    spends its time in long NumPy calls or compiled code releasing the
+    GIL'''
+    if n_threads > 1 and len(items) > 1:
+        pool = ThreadPool(min(n_threads, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return [func(item) for item in items]
+
+def _sparse_pattern(cell, x, y, z, sigma, cutoff):
+    '''Sorted column indices and row pointers of the segments with a point
+    within cutoff of each contact, and the error bound of each row'''
+    if cutoff <= 0:
+        raise ValueError('cutoff must be positive, not %s' % cutoff)
+    deltaS = _deltaS_calc(cell.xstart, cell.xend, cell.ystart, cell.yend,
+                          cell.zstart, cell.zend)
+    tree = cKDTree(np.c_[cell.xmid, cell.ymid, cell.zmid])
+    #all points of a segment lie within half its length of the midpoint
+    neighbors = tree.query_ball_point(np.c_[x, y, z],
+                                      cutoff + deltaS.max() / 2)
+    counts = np.array([len(n) for n in neighbors], dtype=int)
+    indptr = np.r_[0, np.cumsum(counts)]
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    for i, n in enumerate(neighbors):
+        indices[indptr[i]:indptr[i + 1]] = np.sort(n)
+    bound = np.where(counts < cell.totnsegs,
+                     1. / (4 * np.pi * sigma * cutoff), 0.)
+    return indices, indptr, bound
@@ -12,17 +12,23 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.'''
 
 import numpy as np
+import scipy.sparse as sparse
+from scipy.spatial import cKDTree
 cimport numpy as np
+cimport cython
+from cython.parallel import prange
+from libc.math cimport sqrt, log, fabs
 
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
 ctypedef Py_ssize_t   LTYPE_t
 
 
-cpdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] calc_lfp_choose(cell,
+cpdef calc_lfp_choose(cell,
                     double x=0, double y=0, double z=0, double sigma=0.3,
                     r_limit=None,
-                    timestep=None, t_indices=None, method='linesource'):
+                    timestep=None, t_indices=None, method='linesource',
+                    return_clamped=False):
     '''
     Determine which method to use, line-source for soma default
     
@@ -39,29 +45,34 @@ cpdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] calc_lfp_choose(cell,
         t_indices : [None]/np.ndarray, calculate LFP at specific timesteps
         method=['linesource']/'pointsource'/'som_as_point'
             switch for choosing underlying methods
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
     '''
     if method == 'som_as_point':
         return calc_lfp_som_as_point(cell, x=x, y=y, z=z, sigma=sigma,
                                      r_limit=r_limit,
-                                     timestep=timestep, t_indices=t_indices)
+                                     timestep=timestep, t_indices=t_indices,
+                                     return_clamped=return_clamped)
     elif method == 'linesource':
         return calc_lfp_linesource(cell, x=x, y=y, z=z, sigma=sigma,
                                    r_limit=r_limit,
-                                   timestep=timestep, t_indices=t_indices)
+                                   timestep=timestep, t_indices=t_indices,
+                                   return_clamped=return_clamped)
     elif method == 'pointsource':
         return calc_lfp_pointsource(cell, x=x, y=y, z=z, sigma=sigma,
                                     r_limit=r_limit,
-                                    timestep=timestep, t_indices=t_indices)
+                                    timestep=timestep, t_indices=t_indices,
+                                    return_clamped=return_clamped)
 
 
-cpdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] calc_lfp_linesource(
+cpdef calc_lfp_linesource(
                         cell,
                         double x=0,
                         double y=0,
                         double z=0,
                         double sigma=0.3,
                         r_limit=None,
-                        timestep=None, t_indices=None):
+                        timestep=None, t_indices=None, return_clamped=False):
     '''
     Calculate electric field potential using the line-source method, all
     compartments treated as line sources, even soma.
@@ -77,6 +88,8 @@ cpdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] calc_lfp_linesource(
         r_limit : [None]/float/np.ndarray: minimum distance to source current
         timestep : [None]/int, calculate LFP at this timestep
         t_indices : [None]/np.ndarray, calculate LFP at specific timesteps
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
     '''
     # Handling the r_limits. If a r_limit is a single value, an array r_limit
     # of shape cell.diam is returned.
@@ -91,6 +104,7 @@ cpdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] calc_lfp_linesource(
         ystart, yend, zstart, zend, deltaS, h, r2, l, \
         Ememi, Ememii, Ememiii, Emem, r_lims
     cdef np.ndarray[LTYPE_t, ndim=1, negative_indices=False] i, ii, iii
+    cdef np.ndarray[np.uint8_t, ndim=1, cast=True] clamped
 
     if timestep is not None:
         currmem = cell.imem[:, timestep]
@@ -115,7 +129,7 @@ cpdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] calc_lfp_linesource(
 
 
     r_lims = r_limit
-    r2 = _check_rlimit(r2, r_limit, h, deltaS)
+    clamped = _check_rlimit(r2, r_limit, h, deltaS)
 
     l = h + deltaS
 
@@ -139,13 +153,16 @@ cpdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] calc_lfp_linesource(
 
     Emem = Ememi + Ememii + Ememiii
 
+    if return_clamped:
+        return Emem.transpose(), np.nonzero(clamped)[0]
     return Emem.transpose()
 
 
-cpdef np.ndarray[DTYPE_t, ndim=1] calc_lfp_som_as_point(cell,
+cpdef calc_lfp_som_as_point(cell,
                           double x=0, double y=0, double z=0, double sigma=0.3,
                           r_limit=None,
-                          timestep=None, t_indices=None):
+                          timestep=None, t_indices=None,
+                          return_clamped=False):
     '''
     Calculate electric field potential using the line-source method,
     soma is treated as point/sphere source
@@ -161,6 +178,8 @@ cpdef np.ndarray[DTYPE_t, ndim=1] calc_lfp_som_as_point(cell,
         r_limit : [None]/float/np.ndarray: minimum distance to source current
         timestep : [None]/int, calculate LFP at this timestep
         t_indices : [None]/np.ndarray, calculate LFP at specific timesteps
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit, 0 for the soma
     '''
     #Handling the r_limits. If a r_limit is a single value,
     #an array r_limit of shape cell.diam is returned.
@@ -185,6 +204,7 @@ cpdef np.ndarray[DTYPE_t, ndim=1] calc_lfp_som_as_point(cell,
         ystart, yend, zstart, zend, deltaS, h, r2, l, \
         Ememi, Ememii, Ememiii, Emem
     cdef np.ndarray[LTYPE_t, ndim=1] i, ii, iii
+    cdef np.ndarray[np.uint8_t, ndim=1, cast=True] clamped
     cdef double xmid, ymid, zmid
 
 
@@ -211,19 +231,13 @@ cpdef np.ndarray[DTYPE_t, ndim=1] calc_lfp_som_as_point(cell,
     h = _h_calc(xstart, xend, ystart, yend, zstart, zend, deltaS, x, y, z)
     r2 = _r2_calc(xend, yend, zend, x, y, z, h)
     r_soma = _r_soma_calc(xmid, ymid, zmid, x, y, z)
-    if r_soma < s_limit:
-        print('Adjusting r-distance to soma segment from %g to %g'
-                % (r_soma, s_limit))
-        r_soma = s_limit
 
-    # Check that no segment is close the electrode than r_limit
-    if np.sum(np.nonzero( r2 < r_limit * r_limit )) > 0:
-        for idx in np.nonzero( r2[1:] < r_limit[1:] * r_limit[1:] )[0]+1:
-            if (h[idx] < r_limit[idx]) and \
-            ((deltaS[idx] + h[idx]) > -r_limit[idx]):
-                print('Adjusting distance to segment %s from %.2f to %.2f.'
-                      % (idx, r2[idx]**0.5, r_limit[idx]))
-                r2[idx] = r_limit[idx] * r_limit[idx]
+    # Check that no segment is closer to the electrode than r_limit, the
+    # soma than s_limit
+    clamped = _check_rlimit(r2, r_limit, h, deltaS)
+    clamped[0] = r_soma < s_limit
+    if clamped[0]:
+        r_soma = s_limit
 
     l = h + deltaS
 
@@ -253,6 +267,8 @@ cpdef np.ndarray[DTYPE_t, ndim=1] calc_lfp_som_as_point(cell,
     #Summarizing all potential contributions
     Emem = Emem0 + Ememi + Ememiii + Ememii
     
+    if return_clamped:
+        return Emem.transpose(), np.nonzero(clamped)[0]
     return Emem.transpose()
 
 
@@ -265,20 +281,17 @@ cdef double _r_soma_calc(double xmid, double ymid, double zmid,
     return r_soma
 
 
-cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] _check_rlimit(
+cdef np.ndarray _check_rlimit(
                  np.ndarray[DTYPE_t, ndim=1, negative_indices=False] r2,
                  np.ndarray[DTYPE_t, ndim=1, negative_indices=False] r_limit,
                  np.ndarray[DTYPE_t, ndim=1, negative_indices=False] h,
                  np.ndarray[DTYPE_t, ndim=1, negative_indices=False] deltaS):
-    # Check that no segment is close the electrode than r_limit
-    cdef int idx
-    if np.sum(np.nonzero( r2 < r_limit*r_limit )) > 0:
-        for idx in np.nonzero( r2 < r_limit*r_limit )[0]:
-            if (h[idx] < r_limit[idx]) and ((deltaS[idx]+h[idx])>-r_limit[idx]):
-                print('Adjusting distance to segment %s from %.2f to %.2f.'
-                      % (idx, r2[idx]**0.5, r_limit[idx]))
-                r2[idx] = r_limit[idx]**2
-    return r2
+    '''Correct r2 in place so that no segment is closer to the electrode
+    than r_limit, returns the boolean mask of the corrected segments'''
+    clamped = (r2 < r_limit*r_limit) & (h < r_limit) & \
+        (deltaS + h > -r_limit)
+    r2[clamped] = r_limit[clamped]*r_limit[clamped]
+    return clamped
 
 
 cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] _Ememi_calc(
@@ -391,7 +404,7 @@ cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] _deltaS_calc(
     return deltaS
 
 
-cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] _h_calc(
+cpdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] _h_calc(
                 np.ndarray[DTYPE_t, ndim=1, negative_indices=False] xstart,
                 np.ndarray[DTYPE_t, ndim=1, negative_indices=False] xend,
                 np.ndarray[DTYPE_t, ndim=1, negative_indices=False] ystart,
@@ -401,14 +414,17 @@ cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] _h_calc(
                 np.ndarray[DTYPE_t, ndim=1, negative_indices=False] deltaS,
                 double x, double y, double z):
     '''Subroutine used by calc_lfp_som_as_point()'''
-    cdef np.ndarray[DTYPE_t, ndim=2, negative_indices=False] aa, aaT, bb
-    cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] cc, hh
-
-    aa = np.array([x - xend, y - yend, z-zend])
-    aaT = aa.T
-    bb = np.array([xend - xstart, yend - ystart, zend - zstart])
-    cc = np.dot(aaT, bb).diagonal()
-    hh = cc / deltaS
+    cdef int i
+    cdef int nseg = xstart.shape[0]
+    cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] hh = \
+        np.empty(nseg)
+
+    #projection of the electrode position onto each segment, row by row,
+    #so that time and memory are linear in the number of segments
+    for i in range(nseg):
+        hh[i] = ((x - xend[i]) * (xend[i] - xstart[i]) +
+                 (y - yend[i]) * (yend[i] - ystart[i]) +
+                 (z - zend[i]) * (zend[i] - zstart[i])) / deltaS[i]
     return hh
 
 
@@ -428,7 +444,8 @@ cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] _r2_calc(
 cpdef calc_lfp_pointsource(cell, double x=0, double y=0, double z=0,
                            double sigma=0.3,
                            r_limit=None, 
-                           timestep=None, t_indices=None):
+                           timestep=None, t_indices=None,
+                           return_clamped=False):
     '''
     Calculate local field potentials using the point-source equation on all
     compartments
@@ -444,6 +461,8 @@ cpdef calc_lfp_pointsource(cell, double x=0, double y=0, double z=0,
         r_limit : [None]/float/np.ndarray: minimum distance to source current
         timestep : [None]/int, calculate LFP at this timestep
         t_indices : [None]/np.ndarray, calculate LFP at specific timesteps    
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
     '''
     # Handling the r_limits. If a r_limit is a single value, an array r_limit
     # of shape cell.diam is returned.
@@ -461,20 +480,361 @@ cpdef calc_lfp_pointsource(cell, double x=0, double y=0, double z=0,
         currmem = cell.imem
 
     r2 = (cell.xmid - x)**2 + (cell.ymid - y)**2 + (cell.zmid - z)**2
-    r2 = _check_rlimit_point(r2, r_limit)
+    clamped = _check_rlimit_point(r2, r_limit)
     r = r2**0.5
 
     Emem = 1 / (4 * np.pi * sigma) * np.dot(currmem.T, 1/r)
 
+    if return_clamped:
+        return Emem.transpose(), np.nonzero(clamped)[0]
     return Emem.transpose()
 
 
-cdef np.ndarray[DTYPE_t, ndim=1, negative_indices=False] _check_rlimit_point(
+cdef np.ndarray _check_rlimit_point(
                 np.ndarray[DTYPE_t, ndim=1, negative_indices=False] r2,
                 np.ndarray[DTYPE_t, ndim=1, negative_indices=False] r_limit):
-    '''Correct r2 so that r2 >= r_limit for all values'''
+    '''Correct r2 in place so that r2 >= r_limit for all values, returns
+    the boolean mask of the corrected segments'''
     
     inds = r2 < (r_limit*r_limit)
     r2[inds] = r_limit[inds]*r_limit[inds]
 
-    return r2
+    return inds
+
+
+def _r_limit_calc(cell, r_limit):
+    '''Handling the r_limits. If a r_limit is a single value, an array
+    r_limit of shape cell.diam is returned.'''
+    if type(r_limit) == int or type(r_limit) == float:
+        r_limit = np.ones(np.shape(cell.diam))*abs(r_limit)
+    elif np.shape(r_limit) != np.shape(cell.diam):
+        raise Exception('r_limit is neither a float- or int- value, nor is \
+            r_limit.shape() equal to cell.diam.shape()')
+    return r_limit
+
+
+def _rs_limit_calc(cell, r_limit):
+    '''Handling the r_limits of the som_as_point method. If a r_limit is a
+    single value, an array r_limit of shape cell.diam is returned, together
+    with the soma limit s_limit.'''
+    if type(r_limit) != type(np.array([])):
+        r_limit = np.array(r_limit)
+    if r_limit.shape == ():
+        s_limit = r_limit
+        r_limit = np.ones(cell.diam.size) * abs(r_limit)
+    elif r_limit.shape == (2, ):
+        s_limit = abs(r_limit[0])
+        r_limit = np.ones(cell.diam.size) * abs(r_limit[1])
+    elif r_limit.shape == cell.diam.shape:
+        s_limit = r_limit[0]
+        r_limit = r_limit
+    else:
+        raise Exception('r_limit is neither a float- or int- value, \
+            on the form r_limit=[s_limit, r_limit],  \
+            nor is shape(r_limit) equal to shape(cell.diam)!')
+    return s_limit, r_limit
+
+
+def _method_limits(cell, r_limit, method):
+    '''Return the method number of the kernels (0: linesource, 1:
+    som_as_point, 2: pointsource), the soma limit s_limit (0 unless
+    som_as_point) and the array r_limit of shape cell.diam'''
+    s_limit = 0.
+    if method == 'som_as_point':
+        imethod = 1
+        s_limit, r_limit = _rs_limit_calc(cell, r_limit)
+    elif method == 'linesource':
+        imethod = 0
+        r_limit = _r_limit_calc(cell, r_limit)
+    elif method == 'pointsource':
+        imethod = 2
+        r_limit = _r_limit_calc(cell, r_limit)
+    else:
+        raise ValueError('method must be linesource, pointsource or '
+                         'som_as_point, not %s' % method)
+    return imethod, s_limit, r_limit
+
+
+def calc_mapping(cell, x, y, z, double sigma=0.3, r_limit=None,
+                 method='linesource', int n_threads=1, return_clamped=False):
+    '''
+    Calculate the matrix mapping the membrane currents of all segments of
+    cell onto the extracellular potential at each contact, so that the
+    potential is np.dot(mapping, cell.imem). The rows are filled without the
+    GIL by n_threads OpenMP threads.
+    
+    Arguments:
+    ::
+        
+        cell: LFPy.Cell or LFPy.TemplateCell instance
+        x : np.ndarray, extracellular positions, x-axis
+        y : np.ndarray, extracellular positions, y-axis
+        z : np.ndarray, extracellular positions, z-axis
+        sigma : double, extracellular conductivity
+        r_limit : [None]/float/np.ndarray: minimum distance to source current
+        method : ['linesource']/'pointsource'/'som_as_point'
+        n_threads : int, number of threads
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
+    
+    Returns:
+    ::
+        
+        mapping : np.ndarray, shape (number of contacts, cell.totnsegs)
+        clamped : list of np.ndarray, if return_clamped, the indices of the
+            segments whose distance was raised to r_limit for each contact
+    '''
+    cdef int imethod
+    cdef double s_limit
+    imethod, s_limit, r_limit = _method_limits(cell, r_limit, method)
+    
+    cdef double[::1] xstart = np.ascontiguousarray(cell.xstart, dtype=DTYPE)
+    cdef double[::1] xend = np.ascontiguousarray(cell.xend, dtype=DTYPE)
+    cdef double[::1] ystart = np.ascontiguousarray(cell.ystart, dtype=DTYPE)
+    cdef double[::1] yend = np.ascontiguousarray(cell.yend, dtype=DTYPE)
+    cdef double[::1] zstart = np.ascontiguousarray(cell.zstart, dtype=DTYPE)
+    cdef double[::1] zend = np.ascontiguousarray(cell.zend, dtype=DTYPE)
+    cdef double[::1] xmid = np.ascontiguousarray(cell.xmid, dtype=DTYPE)
+    cdef double[::1] ymid = np.ascontiguousarray(cell.ymid, dtype=DTYPE)
+    cdef double[::1] zmid = np.ascontiguousarray(cell.zmid, dtype=DTYPE)
+    cdef double[::1] rlim = np.ascontiguousarray(r_limit, dtype=DTYPE)
+    cdef double[::1] xx = np.array(x, dtype=DTYPE).flatten()
+    cdef double[::1] yy = np.array(y, dtype=DTYPE).flatten()
+    cdef double[::1] zz = np.array(z, dtype=DTYPE).flatten()
+    cdef Py_ssize_t i
+    cdef Py_ssize_t ncontacts = xx.shape[0]
+    cdef double aa0 = 4 * np.pi * sigma
+    cdef int nthreads = max(n_threads, 1)
+    
+    mapping = np.zeros((ncontacts, xstart.shape[0]))
+    cdef double[:, ::1] out = mapping
+    clamped = np.zeros((ncontacts, xstart.shape[0]), dtype=np.uint8)
+    cdef unsigned char[:, ::1] outclamped = clamped
+    
+    for i in prange(ncontacts, nogil=True, num_threads=nthreads,
+                    schedule='static'):
+        if imethod == 2:
+            _pointsource_row(xmid, ymid, zmid, rlim, xx[i], yy[i], zz[i],
+                             aa0, out[i], outclamped[i])
+        else:
+            _linesource_row(xstart, xend, ystart, yend, zstart, zend, rlim,
+                            xx[i], yy[i], zz[i], aa0, imethod, s_limit,
+                            xmid[0], ymid[0], zmid[0], out[i],
+                            outclamped[i])
+    
+    if return_clamped:
+        return mapping, [np.nonzero(row)[0] for row in clamped]
+    return mapping
+
+
+def calc_sparse_mapping(cell, x, y, z, double sigma=0.3, r_limit=None,
+                        method='linesource', double cutoff=100.,
+                        int n_threads=1, return_clamped=False):
+    '''
+    Calculate the sparse matrix mapping the membrane currents of the
+    segments of cell within a distance cutoff of each contact onto the
+    extracellular potential, so that the potential is mapping.dot(cell.imem).
+    The neighbouring segments are found with a KD-tree over the segment
+    midpoints, their coefficients are exact as in calc_mapping, those of the
+    other segments are dropped. As no point of a dropped segment is closer
+    than cutoff to the contact, the error of the potential is bounded by
+    bound times the summed absolute currents of the dropped segments. The
+    rows are filled without the GIL by n_threads OpenMP threads.
+    
+    Arguments:
+    ::
+        
+        cell: LFPy.Cell or LFPy.TemplateCell instance
+        x : np.ndarray, extracellular positions, x-axis
+        y : np.ndarray, extracellular positions, y-axis
+        z : np.ndarray, extracellular positions, z-axis
+        sigma : double, extracellular conductivity
+        r_limit : [None]/float/np.ndarray: minimum distance to source current
+        method : ['linesource']/'pointsource'/'som_as_point'
+        cutoff : float, distance (mum) beyond which segments are dropped
+        n_threads : int, number of threads
+        return_clamped : bool, if True, also return the indices of the
+            segments whose distance was raised to r_limit
+    
+    Returns:
+    ::
+        
+        mapping : scipy.sparse.csr_matrix, shape (number of contacts,
+            cell.totnsegs)
+        bound : np.ndarray, the bound of the absolute error of the potential
+            at each contact per nA of dropped current, 1 / (4 pi sigma
+            cutoff) or 0 if no segment is dropped
+        clamped : list of np.ndarray, if return_clamped, the indices of the
+            segments whose distance was raised to r_limit for each contact
+    '''
+    cdef int imethod
+    cdef double s_limit
+    imethod, s_limit, r_limit = _method_limits(cell, r_limit, method)
+    
+    x = np.array(x, dtype=DTYPE).flatten()
+    y = np.array(y, dtype=DTYPE).flatten()
+    z = np.array(z, dtype=DTYPE).flatten()
+    indices, indptr, bound = _sparse_pattern(cell, x, y, z, sigma, cutoff)
+    
+    #the geometry of the neighbours of all contacts, one after the other
+    cdef double[::1] xstart = np.ascontiguousarray(cell.xstart[indices],
+                                                   dtype=DTYPE)
+    cdef double[::1] xend = np.ascontiguousarray(cell.xend[indices],
+                                                 dtype=DTYPE)
+    cdef double[::1] ystart = np.ascontiguousarray(cell.ystart[indices],
+                                                   dtype=DTYPE)
+    cdef double[::1] yend = np.ascontiguousarray(cell.yend[indices],
+                                                 dtype=DTYPE)
+    cdef double[::1] zstart = np.ascontiguousarray(cell.zstart[indices],
+                                                   dtype=DTYPE)
+    cdef double[::1] zend = np.ascontiguousarray(cell.zend[indices],
+                                                 dtype=DTYPE)
+    cdef double[::1] xmid = np.ascontiguousarray(cell.xmid[indices],
+                                                 dtype=DTYPE)
+    cdef double[::1] ymid = np.ascontiguousarray(cell.ymid[indices],
+                                                 dtype=DTYPE)
+    cdef double[::1] zmid = np.ascontiguousarray(cell.zmid[indices],
+                                                 dtype=DTYPE)
+    cdef double[::1] rlim = np.ascontiguousarray(
+        np.asarray(r_limit, dtype=DTYPE)[indices])
+    cdef double[::1] xx = x
+    cdef double[::1] yy = y
+    cdef double[::1] zz = z
+    cdef int[::1] cols = indices
+    cdef Py_ssize_t[::1] ptr = np.asarray(indptr, dtype=np.intp)
+    cdef double xmid0 = cell.xmid[0]
+    cdef double ymid0 = cell.ymid[0]
+    cdef double zmid0 = cell.zmid[0]
+    cdef Py_ssize_t i, a, b
+    cdef Py_ssize_t ncontacts = xx.shape[0]
+    cdef double aa0 = 4 * np.pi * sigma
+    cdef int nthreads = max(n_threads, 1)
+    cdef int soma
+    
+    data = np.zeros(indices.size)
+    cdef double[::1] out = data
+    clamped = np.zeros(indices.size, dtype=np.uint8)
+    cdef unsigned char[::1] outclamped = clamped
+    
+    for i in prange(ncontacts, nogil=True, num_threads=nthreads,
+                    schedule='dynamic'):
+        a = ptr[i]
+        b = ptr[i + 1]
+        if b > a:
+            if imethod == 2:
+                _pointsource_row(xmid[a:b], ymid[a:b], zmid[a:b], rlim[a:b],
+                                 xx[i], yy[i], zz[i], aa0, out[a:b],
+                                 outclamped[a:b])
+            else:
+                #the soma is a point source if it is among the neighbours
+                soma = 0
+                if imethod == 1 and cols[a] == 0:
+                    soma = 1
+                _linesource_row(xstart[a:b], xend[a:b], ystart[a:b],
+                                yend[a:b], zstart[a:b], zend[a:b],
+                                rlim[a:b], xx[i], yy[i], zz[i], aa0, soma,
+                                s_limit, xmid0, ymid0, zmid0, out[a:b],
+                                outclamped[a:b])
+    
+    mapping = sparse.csr_matrix((data, indices, indptr),
+                                shape=(ncontacts, cell.totnsegs))
+    if return_clamped:
+        clamped = clamped.astype(bool)
+        return mapping, bound, [indices[indptr[i]:indptr[i + 1]][
+            clamped[indptr[i]:indptr[i + 1]]] for i in range(ncontacts)]
+    return mapping, bound
+
+
+def _sparse_pattern(cell, x, y, z, sigma, cutoff):
+    '''Sorted column indices and row pointers of the segments with a point
+    within cutoff of each contact, and the error bound of each row'''
+    if cutoff <= 0:
+        raise ValueError('cutoff must be positive, not %s' % cutoff)
+    deltaS = np.sqrt((cell.xstart - cell.xend)**2 +
+                     (cell.ystart - cell.yend)**2 +
+                     (cell.zstart - cell.zend)**2)
+    tree = cKDTree(np.c_[cell.xmid, cell.ymid, cell.zmid])
+    #all points of a segment lie within half its length of the midpoint
+    neighbors = tree.query_ball_point(np.c_[x, y, z],
+                                      cutoff + deltaS.max() / 2)
+    counts = np.array([len(n) for n in neighbors], dtype=int)
+    indptr = np.r_[0, np.cumsum(counts)]
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    for i, n in enumerate(neighbors):
+        indices[indptr[i]:indptr[i + 1]] = np.sort(n)
+    bound = np.where(counts < cell.totnsegs,
+                     1. / (4 * np.pi * sigma * cutoff), 0.)
+    return indices, indptr, bound
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _linesource_row(double[::1] xstart, double[::1] xend,
+                         double[::1] ystart, double[::1] yend,
+                         double[::1] zstart, double[::1] zend,
+                         double[::1] r_limit, double x, double y, double z,
+                         double aa0, int soma, double s_limit,
+                         double xmid, double ymid, double zmid,
+                         double[::1] out,
+                         unsigned char[::1] clamped) except -1 nogil:
+    '''One row of calc_mapping with the line-source method, the first
+    segment as point source if soma is 1, flags the segments whose distance
+    was raised to r_limit in clamped'''
+    cdef Py_ssize_t idx
+    cdef Py_ssize_t nseg = xstart.shape[0]
+    cdef double deltaS, h, r2, l, r_soma
+    
+    for idx in range(soma, nseg):
+        deltaS = sqrt((xstart[idx] - xend[idx])*(xstart[idx] - xend[idx]) +
+                      (ystart[idx] - yend[idx])*(ystart[idx] - yend[idx]) +
+                      (zstart[idx] - zend[idx])*(zstart[idx] - zend[idx]))
+        h = ((x - xend[idx]) * (xend[idx] - xstart[idx]) +
+             (y - yend[idx]) * (yend[idx] - ystart[idx]) +
+             (z - zend[idx]) * (zend[idx] - zstart[idx])) / deltaS
+        r2 = fabs((x - xend[idx])*(x - xend[idx]) +
+                  (y - yend[idx])*(y - yend[idx]) +
+                  (z - zend[idx])*(z - zend[idx]) - h*h)
+        if r2 < r_limit[idx]*r_limit[idx] and h < r_limit[idx] \
+                and deltaS + h > -r_limit[idx]:
+            r2 = r_limit[idx]*r_limit[idx]
+            clamped[idx] = 1
+        l = h + deltaS
+        if h < 0 and l < 0:
+            out[idx] = log((sqrt(h*h + r2) - h) / (sqrt(l*l + r2) - l)) / \
+                (aa0 * deltaS)
+        elif h < 0 and l >= 0:
+            out[idx] = log((sqrt(h*h + r2) - h) *
+                           ((l + sqrt(l*l + r2)) / r2)) / (aa0 * deltaS)
+        elif h >= 0 and l >= 0:
+            out[idx] = log((sqrt(l*l + r2) + l) / (sqrt(h*h + r2) + h)) / \
+                (aa0 * deltaS)
+    
+    if soma:
+        r_soma = sqrt((x - xmid)*(x - xmid) + (y - ymid)*(y - ymid) +
+                      (z - zmid)*(z - zmid))
+        if r_soma < s_limit:
+            r_soma = s_limit
+            clamped[0] = 1
+        out[0] = 1. / (aa0 * r_soma)
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _pointsource_row(double[::1] xmid, double[::1] ymid,
+                          double[::1] zmid, double[::1] r_limit,
+                          double x, double y, double z, double aa0,
+                          double[::1] out,
+                          unsigned char[::1] clamped) except -1 nogil:
+    '''One row of calc_mapping with the point-source method, flags the
+    segments whose distance was raised to r_limit in clamped'''
+    cdef Py_ssize_t idx
+    cdef double r2
+    for idx in range(xmid.shape[0]):
+        r2 = (xmid[idx] - x)*(xmid[idx] - x) + (ymid[idx] - y)*(ymid[idx] - y) \
+            + (zmid[idx] - z)*(zmid[idx] - z)
+        if r2 < r_limit[idx]*r_limit[idx]:
+            r2 = r_limit[idx]*r_limit[idx]
+            clamped[idx] = 1
+        out[idx] = 1. / (aa0 * sqrt(r2))
+    return 0
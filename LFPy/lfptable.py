@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+'''Copyright (C) 2012 Computational Neuroscience Group, NMBU.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Tabulated potential of line sources, for repeated calculations of the
+mapping of cells onto electrode contacts, see LineSourceTable.'''
+
+from __future__ import division
+import os
+import hashlib
+from warnings import warn
+import numpy as np
+from LFPy import lfpcalc
+from LFPy.tools import _atomic_savez
+
+
+class LineSourceTable(object):
+    '''
+    Lookup table of the potential of a line source of unit current, for
+    calculating the mappings of lfpcalc.calc_mapping(method='linesource') by
+    interpolation instead of evaluating logarithms for each segment and
+    contact.
+
+    The potential of a segment of length deltaS with current I at a contact
+    at distance s * deltaS along the segment axis from the segment midpoint
+    and at distance v * deltaS from the axis is
+
+        I / (4 pi sigma deltaS) * f(s, v),
+        f(s, v) = arcsinh((s + 1/2) / v) - arcsinh((s - 1/2) / v),
+
+    and f(s, v) * sqrt(s**2 + v**2 + 1), which tends to 1 far from the
+    segment, is tabulated on a regular grid of size + 1 by size + 1 points
+    over a = |s| / (|s| + 1) and b = sqrt(v) / (sqrt(v) + 1), and
+    interpolated bilinearly. The grid covers all distances, the size is
+    doubled from 64 until the largest relative interpolation error at the
+    centers of the grid cells is at most tolerance. Contacts closer to the
+    axis of a segment than r_min * deltaS, where the potential of the
+    segment ends is singular, are calculated exactly.
+
+    Arguments:
+    ::
+
+        tolerance : float, bound of the relative interpolation error
+        r_min : float, smallest tabulated distance from the segment axis
+            relative to the segment length
+        max_size : int, largest size of the table
+        cache_dir : None or str, folder of the cache file of the table
+        verbose : bool, print the size and error of the table
+
+    Usage:
+    ::
+
+        table = LFPy.LineSourceTable(cache_dir='/tmp')
+        mapping = table.calc_mapping(cell, x, y, z, sigma=0.3,
+                                     r_limit=cell.diam/2)
+    '''
+    def __init__(self, tolerance=1E-3, r_min=1E-2, max_size=4096,
+                 cache_dir=None, verbose=False):
+        '''Initialize class LineSourceTable'''
+        if tolerance <= 0:
+            raise ValueError('tolerance must be positive')
+        if r_min <= 0:
+            raise ValueError('r_min must be positive')
+        self.tolerance = tolerance
+        self.r_min = r_min
+        self.max_size = max_size
+        self.verbose = verbose
+
+        if cache_dir is not None:
+            params = [('max_size', max_size), ('r_min', r_min),
+                      ('tolerance', tolerance), ('version', 1)]
+            sha = hashlib.sha1(repr(params).encode('utf-8'))
+            self.cache_file = os.path.join(cache_dir,
+                                           'linesource_table.%s.npz' %
+                                           sha.hexdigest()[:16])
+        else:
+            self.cache_file = None
+        if not self._load_cache():
+            self._build()
+            self._save_cache()
+        if self.verbose:
+            print('line-source table of size %i, relative error %.3g' %
+                  (self.size, self.error))
+
+    def _build(self):
+        '''Tabulate f(s, v) * sqrt(s**2 + v**2 + 1), doubling the size until
+        the interpolation error at the centers of the grid cells is at most
+        self.tolerance'''
+        size = 64
+        while True:
+            self._set_table(size)
+            #exact values at the centers of the grid cells
+            g = (np.arange(size) + 0.5) / size
+            s, v = self._sv(g[:, np.newaxis], g[self._jmin:])
+            exact = self._potential(s, v) * np.sqrt(s**2 + v**2 + 1)
+            i = np.arange(size)[:, np.newaxis]
+            j = np.arange(self._jmin, size)
+            approx = (self.table[i, j] + self.table[i + 1, j] +
+                      self.table[i, j + 1] + self.table[i + 1, j + 1]) / 4
+            self.error = abs(approx / exact - 1).max()
+            if self.error <= self.tolerance:
+                break
+            if size * 2 > self.max_size:
+                warn('line-source table of size %i has relative error %.3g '
+                     '> tolerance' % (size, self.error))
+                break
+            size *= 2
+
+    def _set_table(self, size):
+        '''Tabulate the scaled potential on the grid of the given size'''
+        self.size = size
+        #first column of grid cells with v >= r_min
+        w = np.sqrt(self.r_min)
+        self._jmin = max(1, int(np.floor(w / (w + 1) * size)))
+        g = np.arange(size + 1) / size
+        self.table = np.ones((size + 1, size + 1))
+        self.table[:, :self._jmin] = 0
+        s, v = self._sv(g[:-1, np.newaxis], g[self._jmin:-1])
+        self.table[:-1, self._jmin:-1] = self._potential(s, v) * \
+            np.sqrt(s**2 + v**2 + 1)
+
+    def _sv(self, a, b):
+        '''Normalized distances along and from the segment axis of the grid
+        coordinates a, b < 1'''
+        w = b / (1 - b)
+        return a / (1 - a), w * w
+
+    def _potential(self, s, v):
+        '''Normalized potential f(s, v) of a line source'''
+        return np.arcsinh((s + 0.5) / v) - np.arcsinh((s - 0.5) / v)
+
+    def _load_cache(self):
+        '''Load the table from self.cache_file, returns True if found'''
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return False
+        try:
+            with np.load(self.cache_file) as f:
+                self.table = f['table']
+                self.error = float(f['error'])
+            self.size = self.table.shape[0] - 1
+            w = np.sqrt(self.r_min)
+            self._jmin = max(1, int(np.floor(w / (w + 1) * self.size)))
+            if self.verbose:
+                print('loaded line-source table %s' % self.cache_file)
+            return True
+        except Exception:
+            warn('could not read line-source table %s' % self.cache_file)
+            return False
+
+    def _save_cache(self):
+        '''Write the table to self.cache_file'''
+        if self.cache_file is None:
+            return
+        try:
+            _atomic_savez(self.cache_file, table=self.table, error=self.error)
+            if self.verbose:
+                print('saved line-source table %s' % self.cache_file)
+        except (IOError, OSError):
+            warn('could not write line-source table %s' % self.cache_file)
+
+    def potential(self, h, r2, deltaS):
+        '''
+        Potential of line sources of unit current in units of 4 pi sigma,
+        interpolated from the table.
+
+        Arguments:
+        ::
+
+            h : np.ndarray, signed distance along the segment axis from the
+                segment end to the contact, as in lfpcalc
+            r2 : np.ndarray, squared distance from the segment axis
+            deltaS : np.ndarray, segment lengths
+
+        Returns:
+        ::
+
+            np.ndarray, 1 / deltaS * f(s, v) of each segment
+        '''
+        h, r2, deltaS = np.broadcast_arrays(h, r2, deltaS)
+        s = abs(h / deltaS + 0.5)
+        v = np.sqrt(r2) / deltaS
+        w = np.sqrt(v)
+        ia = s / (s + 1) * self.size
+        ib = w / (w + 1) * self.size
+        i = np.minimum(ia.astype(np.intp), self.size - 1)
+        j = np.minimum(ib.astype(np.intp), self.size - 1)
+        fa = ia - i
+        fb = ib - j
+        k = i * (self.size + 1) + j
+        table = self.table.ravel()
+        F = (table[k] * (1 - fb) + table[k + 1] * fb) * (1 - fa) + \
+            (table[k + self.size + 1] * (1 - fb) +
+             table[k + self.size + 2] * fb) * fa
+        coeffs = F / (np.sqrt(s**2 + v**2 + 1) * deltaS)
+
+        #exact potential close to the segment axes
+        near = j < self._jmin
+        if near.any():
+            coeffs[near] = self._potential(s[near], v[near]) / deltaS[near]
+        return coeffs
+
+    def calc_mapping(self, cell, x, y, z, sigma=0.3, r_limit=None,
+                     n_threads=1, return_clamped=False, block_size=65536):
+        '''
+        Calculate the line-source matrix mapping the membrane currents of
+        all segments of cell onto the extracellular potential at each
+        contact as lfpcalc.calc_mapping(method='linesource'), with the
+        potentials interpolated from the table. The contacts are handled in
+        blocks of about block_size segment-contact pairs, filled by a pool
+        of n_threads threads.
+
+        Arguments:
+        ::
+
+            cell: LFPy.Cell or LFPy.TemplateCell instance
+            x : np.ndarray, extracellular positions, x-axis
+            y : np.ndarray, extracellular positions, y-axis
+            z : np.ndarray, extracellular positions, z-axis
+            sigma : double, extracellular conductivity
+            r_limit : float/np.ndarray: minimum distance to source current
+            n_threads : int, number of threads
+            return_clamped : bool, if True, also return the indices of the
+                segments whose distance was raised to r_limit
+            block_size : int, number of segment-contact pairs per block
+
+        Returns:
+        ::
+
+            mapping : np.ndarray, shape (number of contacts, cell.totnsegs)
+            clamped : list of np.ndarray, if return_clamped, the indices of
+                the segments whose distance was raised to r_limit for each
+                contact
+        '''
+        x = np.array(x, dtype=float).flatten()[:, np.newaxis]
+        y = np.array(y, dtype=float).flatten()[:, np.newaxis]
+        z = np.array(z, dtype=float).flatten()[:, np.newaxis]
+        r_limit = lfpcalc._r_limit_calc(cell, r_limit)
+        deltaS = lfpcalc._deltaS_calc(cell.xstart, cell.xend, cell.ystart,
+                                      cell.yend, cell.zstart, cell.zend)
+
+        mapping = np.empty((x.size, cell.totnsegs))
+        clamped = np.empty((x.size, cell.totnsegs), dtype=bool)
+        def fill(contacts):
+            h = lfpcalc._h_calc(cell.xstart, cell.xend, cell.ystart,
+                                cell.yend, cell.zstart, cell.zend, deltaS,
+                                x[contacts], y[contacts], z[contacts])
+            r2 = lfpcalc._r2_calc(cell.xend, cell.yend, cell.zend,
+                                  x[contacts], y[contacts], z[contacts], h)
+            clamped[contacts] = lfpcalc._check_rlimit(
+                r2, np.broadcast_to(r_limit, r2.shape), h, deltaS)
+            mapping[contacts] = self.potential(h, r2, deltaS) / \
+                (4 * np.pi * sigma)
+
+        nblocks = max(1, min(x.size, x.size * cell.totnsegs // block_size))
+        lfpcalc._map_blocks(fill, np.array_split(np.arange(x.size), nblocks),
+                            n_threads)
+
+        if return_clamped:
+            return mapping, [np.nonzero(row)[0] for row in clamped]
+        return mapping
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+'''Copyright (C) 2012 Computational Neuroscience Group, NMBU.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+LFPs of populations of cells with a hierarchical multipole approximation of
+the potential of distant groups of cells, see MultipoleLFP.'''
+
+from __future__ import division
+import numpy as np
+import scipy.sparse as sparse
+from LFPy import backends
+
+
+class MultipoleLFP(object):
+    '''
+    LFPs of a population of cells at electrode contacts, evaluated with a
+    Barnes-Hut type tree over the segments of all cells (Barnes & Hut 1986,
+    Nature 324:446). The membrane currents of a group of segments far from a
+    contact are represented by their monopole, dipole and quadrupole moments
+    about the center of the group, the potential of the nearby segments is
+    calculated exactly with the mapping of lfpcalc.calc_mapping.
+
+    The cells are split recursively in two halves along the longest axis of
+    the bounding box of their segments, down to single cells, whose
+    segments are split in the same way down to groups of at most leaf_size
+    segments. The truncation error of the expansion of order p of a group
+    with radius a, the largest distance from its center to the segment end
+    points, at a contact at distance d > a is at most
+
+        (a / d)**(p + 1) / (d - a) * sum |I| / (4 pi sigma),
+
+    summed over the segment currents I of the group. The expansion is used
+    if this is at most tolerance times sum |I| / (4 pi sigma d), else the
+    children of the group are tried. The groups and the exact mappings are
+    found once, the moments are calculated by calc_lfp from the membrane
+    currents of the cells in blocks of time steps and shifted up the tree,
+    so that the cost per time step is about the number of segments plus the
+    number of contacts times the number of groups used and of segments
+    calculated exactly.
+
+    Arguments:
+    ::
+
+        cells : list of Cell objects, with the membrane currents cell.imem
+            when calling calc_lfp, the geometry must not change afterwards
+        x, y, z : np.ndarray, positions of the contacts (mum)
+        sigma : float, extracellular conductivity (S/m)
+        tolerance : float, bound of the truncation error of the expansions
+            relative to the potential scale of their currents, 0 for the
+            exact LFP
+        order : int, 0, 1 or 2, expansions up to the monopole, dipole or
+            quadrupole moments
+        leaf_size : int, largest number of segments of the smallest groups
+        method : str, ['linesource']/'pointsource'/'som_as_point', method of
+            the exact terms
+        n_threads : int, number of threads of the exact mappings
+    '''
+    def __init__(self, cells, x, y, z, sigma=0.3, tolerance=1E-3, order=2,
+                 leaf_size=32, method='linesource', n_threads=1):
+        '''Initialize class MultipoleLFP'''
+        if order not in [0, 1, 2]:
+            raise ValueError('order must be 0, 1 or 2, not %s' % order)
+        if tolerance < 0:
+            raise ValueError('tolerance must be non-negative')
+        self.cells = list(cells)
+        self.x = np.array(x, dtype=float).flatten()
+        self.y = np.array(y, dtype=float).flatten()
+        self.z = np.array(z, dtype=float).flatten()
+        if not self.x.size == self.y.size == self.z.size:
+            raise ValueError('x, y and z must have the same number of '
+                             'elements')
+        self.sigma = sigma
+        self.tolerance = tolerance
+        self.order = order
+        self.leaf_size = leaf_size
+        self.method = method
+        self.n_threads = n_threads
+
+        #number of moments: charge, dipole, second moments
+        self._nmoments = [1, 4, 10][order]
+        self._offsets = np.r_[0, np.cumsum([c.totnsegs for c in self.cells])]
+
+        self._build_tree()
+        self._build_plan()
+
+    def calc_lfp(self, t_indices=None, block_size=1024):
+        '''
+        Calculate the LFP at the contacts from the membrane currents of the
+        cells. self.LFP_error_bound holds the bound (mV) of the absolute
+        error of the expansions at each contact.
+
+        Arguments:
+        ::
+
+            t_indices : None or np.ndarray, time steps of cell.imem
+            block_size : int, number of time steps handled together
+
+        Returns:
+        ::
+
+            np.ndarray, shape (number of contacts, number of time steps),
+                the LFP (mV), also stored in self.LFP
+        '''
+        if t_indices is None:
+            ntimes = self.cells[0].imem.shape[1]
+            t_indices = np.arange(ntimes)
+        else:
+            t_indices = np.array(t_indices).flatten()
+            ntimes = t_indices.size
+        nnodes = self._center.shape[0]
+        self.LFP = np.empty((self.x.size, ntimes))
+        self.LFP_error_bound = np.zeros(self.x.size)
+        for start in range(0, ntimes, block_size):
+            inds = t_indices[start:start + block_size]
+            imem = np.concatenate([c.imem[:, inds] for c in self.cells])
+            moments = np.empty((nnodes, self._nmoments, inds.size))
+            moments[self._leaves] = self._G.dot(imem).reshape(
+                self._leaves.size, self._nmoments, inds.size)
+            #summed absolute currents of the groups for the error bounds
+            currents = np.empty((nnodes, inds.size))
+            currents[self._leaves] = self._A.dot(abs(imem))
+            #shift the moments of the children to the centers of their
+            #parents, one level at a time from the leaves
+            for parents, children, shifts in self._levels:
+                moments[parents] = np.einsum('nkij,nkjt->nit', shifts,
+                                             moments[children])
+                currents[parents] = currents[children].sum(axis=1)
+            self.LFP[:, start:start + inds.size] = self._near.dot(imem) + \
+                self._far.dot(moments.reshape(-1, inds.size))
+            self.LFP_error_bound = np.maximum(
+                self.LFP_error_bound, self._bound.dot(currents).max(axis=1))
+        return self.LFP
+
+    def _build_tree(self):
+        '''Split the cells recursively in two halves along the longest axis
+        of their bounding box, and the segments of single cells along the
+        longest axis of theirs, down to leaves of at most leaf_size
+        segments. Nodes are numbered from the root so that children come
+        after their parents'''
+        ncells = len(self.cells)
+        self._start = np.concatenate([np.c_[c.xstart, c.ystart, c.zstart]
+                                      for c in self.cells])
+        self._end = np.concatenate([np.c_[c.xend, c.yend, c.zend]
+                                    for c in self.cells])
+        self._mid = np.concatenate([np.c_[c.xmid, c.ymid, c.zmid]
+                                    for c in self.cells])
+        rlim = np.concatenate([c.diam / 2 for c in self.cells])
+        #lengths of the line sources, the point sources have none
+        self._length = self._end - self._start
+        if self.method == 'pointsource':
+            self._length[:] = 0
+        elif self.method == 'som_as_point':
+            self._length[self._offsets[:-1]] = 0
+        lower = np.array([np.minimum(self._start[a:b], self._end[a:b]
+                                     ).min(axis=0)
+                          for a, b in zip(self._offsets[:-1],
+                                          self._offsets[1:])])
+        upper = np.array([np.maximum(self._start[a:b], self._end[a:b]
+                                     ).max(axis=0)
+                          for a, b in zip(self._offsets[:-1],
+                                          self._offsets[1:])])
+        centers = (lower + upper) / 2
+
+        #cells and segments of each node
+        nodes = [(np.arange(ncells), np.arange(self._offsets[-1]))]
+        depth = [0]
+        children = []
+        i = 0
+        while i < len(nodes):
+            cells, segs = nodes[i]
+            if cells.size > 1:
+                axis = np.argmax(upper[cells].max(axis=0) -
+                                 lower[cells].min(axis=0))
+                order = cells[np.argsort(centers[cells, axis],
+                                         kind='mergesort')]
+                halves = [order[:order.size // 2], order[order.size // 2:]]
+                halves = [(half, np.concatenate([
+                    np.arange(self._offsets[k], self._offsets[k + 1])
+                    for k in np.sort(half)])) for half in halves]
+            elif segs.size > self.leaf_size:
+                points = np.r_[self._start[segs], self._end[segs]]
+                axis = np.argmax(points.max(axis=0) - points.min(axis=0))
+                order = segs[np.argsort(self._mid[segs, axis],
+                                        kind='mergesort')]
+                halves = [(cells, np.sort(order[:order.size // 2])),
+                          (cells, np.sort(order[order.size // 2:]))]
+            else:
+                halves = []
+            children.append(list(range(len(nodes),
+                                       len(nodes) + len(halves))))
+            for half in halves:
+                nodes.append(half)
+                depth.append(depth[i] + 1)
+            i += 1
+
+        nnodes = len(nodes)
+        self._center = np.empty((nnodes, 3))
+        self._radius = np.empty(nnodes)
+        self._rmax = np.empty(nnodes)
+        self._children = children
+        for i, (cells, segs) in enumerate(nodes):
+            points = np.r_[self._start[segs], self._end[segs]]
+            self._center[i] = (points.min(axis=0) + points.max(axis=0)) / 2
+            self._radius[i] = np.sqrt(((points - self._center[i])**2
+                                       ).sum(axis=1)).max()
+            self._rmax[i] = rlim[segs].max()
+        self._leaves = np.array([i for i in range(nnodes)
+                                 if len(children[i]) == 0], dtype=int)
+        self._leaf_cell = dict((i, nodes[i][0][0]) for i in self._leaves)
+        self._leaf_segs = dict((i, nodes[i][1]) for i in self._leaves)
+
+        #translations of the moments of the children, level by level
+        self._levels = []
+        depth = np.array(depth)
+        for level in range(depth.max() - 1, -1, -1):
+            parents = np.array([i for i in np.where(depth == level)[0]
+                                if len(children[i]) > 0], dtype=int)
+            if parents.size == 0:
+                continue
+            kids = np.array([children[i] for i in parents], dtype=int)
+            shifts = np.array([[self._shift(self._center[j] -
+                                            self._center[i]) for j in ks]
+                               for i, ks in zip(parents, kids)])
+            self._levels.append((parents, kids, shifts))
+
+        #moments of the segments of the leaves about their centers, and the
+        #sums of absolute currents
+        nm = self._nmoments
+        rows, cols, vals = [], [], []
+        for n, i in enumerate(self._leaves):
+            segs = self._leaf_segs[i]
+            rows.append(np.repeat(np.arange(n * nm, (n + 1) * nm), segs.size))
+            cols.append(np.tile(segs, nm))
+            vals.append(self._moments(segs, self._center[i]).flatten())
+        shape = (self._leaves.size * nm, self._offsets[-1])
+        self._G = sparse.csr_matrix((np.concatenate(vals),
+                                     (np.concatenate(rows),
+                                      np.concatenate(cols))), shape=shape)
+        self._A = sparse.csr_matrix((np.ones(self._offsets[-1]),
+                                     (np.concatenate(
+                                         [np.zeros(self._leaf_segs[i].size,
+                                                   dtype=int) + n
+                                          for n, i in enumerate(self._leaves)]
+                                      ), np.concatenate(
+                                          [self._leaf_segs[i]
+                                           for i in self._leaves]))),
+                                    shape=(self._leaves.size,
+                                           self._offsets[-1]))
+
+    def _build_plan(self):
+        '''Find the groups expanded at each contact, and the leaves
+        calculated exactly'''
+        nnodes = self._center.shape[0]
+        nm = self._nmoments
+        contacts = np.c_[self.x, self.y, self.z]
+        far_rows, far_cols, far_vals = [], [], []
+        bound_rows, bound_cols, bound_vals = [], [], []
+        exact = [[] for cell in self.cells]
+        stack = [(0, np.arange(self.x.size))]
+        while len(stack) > 0:
+            i, active = stack.pop()
+            R = contacts[active] - self._center[i]
+            d = np.sqrt((R**2).sum(axis=1))
+            a = self._radius[i]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                error = (a / d)**(self.order + 1) * d / (d - a)
+            #no segment of an expanded group may be close enough to the
+            #contact for r_limit to apply
+            accept = (d - a > 2 * self._rmax[i]) & (error <= self.tolerance)
+            if accept.any():
+                rows = active[accept]
+                coeffs = self._expansion(R[accept], d[accept])
+                far_rows.append(np.repeat(rows, nm))
+                far_cols.append(np.tile(np.arange(i * nm, (i + 1) * nm),
+                                        rows.size))
+                far_vals.append(coeffs.flatten())
+                bound_rows.append(rows)
+                bound_cols.append(np.zeros(rows.size, dtype=int) + i)
+                bound_vals.append((a / d[accept])**(self.order + 1) /
+                                  (d[accept] - a) / (4 * np.pi * self.sigma))
+            rest = active[~accept]
+            if rest.size > 0:
+                if len(self._children[i]) == 0:
+                    exact[self._leaf_cell[i]].append((i, rest))
+                else:
+                    for j in self._children[i]:
+                        stack.append((j, rest))
+
+        shape = (self.x.size, nnodes * nm)
+        if len(far_rows) > 0:
+            self._far = sparse.csr_matrix((np.concatenate(far_vals),
+                                           (np.concatenate(far_rows),
+                                            np.concatenate(far_cols))),
+                                          shape=shape)
+            self._bound = sparse.csr_matrix((np.concatenate(bound_vals),
+                                             (np.concatenate(bound_rows),
+                                              np.concatenate(bound_cols))),
+                                            shape=(self.x.size, nnodes))
+        else:
+            self._far = sparse.csr_matrix(shape)
+            self._bound = sparse.csr_matrix((self.x.size, nnodes))
+        self.n_expansions = self._bound.nnz
+
+        #exact coefficients of the segments of the leaves near each contact,
+        #from the mappings of their cells
+        lfpcalc = backends.get_module('lfpcalc')
+        near_rows, near_cols, near_vals = [], [], []
+        self.n_exact = 0
+        for k, cell in enumerate(self.cells):
+            if len(exact[k]) == 0:
+                continue
+            contacts = np.unique(np.concatenate([rest for i, rest
+                                                 in exact[k]]))
+            mapping = lfpcalc.calc_mapping(cell, x=self.x[contacts],
+                                           y=self.y[contacts],
+                                           z=self.z[contacts],
+                                           sigma=self.sigma,
+                                           r_limit=cell.diam / 2,
+                                           method=self.method,
+                                           n_threads=self.n_threads)
+            for i, rest in exact[k]:
+                segs = self._leaf_segs[i]
+                pos = np.searchsorted(contacts, rest)
+                near_rows.append(np.repeat(rest, segs.size))
+                near_cols.append(np.tile(segs, rest.size))
+                near_vals.append(mapping[pos][:, segs - self._offsets[k]
+                                              ].flatten())
+                self.n_exact += rest.size
+        shape = (self.x.size, self._offsets[-1])
+        if len(near_rows) > 0:
+            self._near = sparse.csr_matrix((np.concatenate(near_vals),
+                                            (np.concatenate(near_rows),
+                                             np.concatenate(near_cols))),
+                                           shape=shape)
+        else:
+            self._near = sparse.csr_matrix(shape)
+
+    def _moments(self, segs, center):
+        '''Matrix of the moments about center of the membrane currents of
+        the segments segs, rows charge, dipole x, y, z and second moments
+        xx, yy, zz, xy, xz, yz of uniform line sources, or point sources at
+        the midpoints'''
+        m = self._mid[segs] - center
+        D = self._length[segs]
+        G = np.empty((10, segs.size))
+        G[0] = 1
+        G[1:4] = m.T
+        for k, (i, j) in enumerate([(0, 0), (1, 1), (2, 2),
+                                    (0, 1), (0, 2), (1, 2)]):
+            G[4 + k] = m[:, i] * m[:, j] + D[:, i] * D[:, j] / 12
+        return G[:self._nmoments]
+
+    def _shift(self, t):
+        '''Matrix translating moments about a center c to moments about
+        c - t'''
+        T = np.eye(10)
+        T[1:4, 0] = t
+        for k, (i, j) in enumerate([(0, 0), (1, 1), (2, 2),
+                                    (0, 1), (0, 2), (1, 2)]):
+            T[4 + k, 0] = t[i] * t[j]
+            T[4 + k, 1 + i] += t[j]
+            T[4 + k, 1 + j] += t[i]
+        return T[:self._nmoments, :self._nmoments]
+
+    def _expansion(self, R, d):
+        '''Coefficients of the moments in the potential at the positions R
+        relative to the center of a group, at distances d'''
+        coeffs = np.empty((d.size, 10))
+        coeffs[:, 0] = 1 / d
+        coeffs[:, 1:4] = R / d[:, np.newaxis]**3
+        for k, (i, j) in enumerate([(0, 0), (1, 1), (2, 2),
+                                    (0, 1), (0, 2), (1, 2)]):
+            if i == j:
+                coeffs[:, 4 + k] = (3 * R[:, i]**2 - d**2) / (2 * d**5)
+            else:
+                coeffs[:, 4 + k] = 3 * R[:, i] * R[:, j] / d**5
+        return coeffs[:, :self._nmoments] / (4 * np.pi * self.sigma)
@@ -232,7 +232,8 @@ class StimIntElectrode(PointProcess):
         cell-instance, pass the corresponding kwargs onto
         cell.set_point_process.
         '''
-        PointProcess.__init__(self, cell, idx, color, marker, record_current)
+        PointProcess.__init__(self, cell, idx, color, marker, record_current,
+                              **kwargs)
         self.pptype = pptype
         self.hocidx = int(cell.set_point_process(idx, pptype,
                                                  record_current, **kwargs))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+'''Copyright (C) 2012 Computational Neuroscience Group, NMBU.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+Reading of .swc morphology files with numpy, following the rules of
+NEURON's Import3d_SWC_read and Import3d_GUI (share/lib/hoc/import3d) for
+splitting the points into sections, naming and connecting them.'''
+
+from __future__ import division
+import numpy as np
+
+
+def read_swc(morphology):
+    '''
+    Parse a .swc morphology file into sections the same way as NEURON's
+    Import3d_SWC_read followed by Import3d_GUI.instantiate, without
+    creating any sections in NEURON.
+
+    Arguments:
+    ::
+
+        morphology : str, path/to/morphology.swc
+
+    Returns:
+    ::
+
+        dict with entries
+            secnames : np.ndarray, section names in NEURON creation order
+            parent : np.ndarray, index of parent section, -1 for the root
+            parentx : np.ndarray, connection point on the parent section
+            childx : np.ndarray, connection point on the section itself
+            logical : np.ndarray, shape (nsec, 3), logical connection point
+                of sections connected by a wire, otherwise np.nan
+            n3d : np.ndarray, number of pt3d points of each section
+            x3d, y3d, z3d, diam3d : np.ndarray, concatenated pt3d points
+    '''
+    data = np.loadtxt(morphology, ndmin=2)
+    if data.shape[0] < 2 or data.shape[1] != 7:
+        raise ValueError('%s is not a valid swc-file' % morphology)
+
+    #sort points by id, and map parent ids onto point indices
+    data = data[np.argsort(data[:, 0], kind='mergesort')]
+    ids = data[:, 0].astype(int)
+    types = data[:, 1].astype(int)
+    xyz = data[:, 2:5]
+    diam = data[:, 5] * 2
+    pid = data[:, 6].astype(int)
+    if np.unique(ids).size != ids.size:
+        raise ValueError('%s contains duplicate ids' % morphology)
+    if np.any(pid >= ids):
+        raise ValueError('%s: parent id not less than id' % morphology)
+    if (pid < 0).sum() > 1:
+        raise ValueError('%s contains more than one tree' % morphology)
+    id2index = np.zeros(ids.max() + 1, dtype=int) - 1
+    id2index[ids] = np.arange(ids.size)
+    pix = np.where(pid < 0, -1, id2index[np.maximum(pid, 0)])
+    if np.any(pix[pid >= 0] < 0):
+        raise ValueError('%s contains parent ids with no points' % morphology)
+    npts = ids.size
+
+    #mark_branch: count children of every point, where noncontiguous
+    #children and children of other types count a bit more than 1
+    nchild = np.zeros(npts)
+    child = np.where(pix >= 0)[0]
+    parent = pix[child]
+    noncontig = parent != child - 1
+    contrib = 1 + .01 * noncontig + .01 * (types[parent] != types[child])
+    np.add.at(nchild, parent, contrib)
+    #children of the proximal point of dendrites wired to the soma, or of a
+    #non-soma root point, connect to the proximal end of that section
+    connect2prox = np.zeros(npts, dtype=bool)
+    grandparent = pix[parent]
+    prox = noncontig & (((parent > 1) & (types[parent] != 1) &
+                         (grandparent >= 0) & (types[grandparent] == 1)) |
+                        ((parent == 0) & (types[0] != 1)))
+    connect2prox[child[prox]] = True
+    #the count of such parents is reset to 1 by their last such child
+    last = np.zeros(npts, dtype=int) - 1
+    np.maximum.at(last, parent[prox], child[prox])
+    reset = last >= 0
+    nchild[reset] = 1 + .01 * (types[reset] != types[last[reset]])
+    later = reset[parent] & (child > last[parent])
+    np.add.at(nchild, parent[later], contrib[later])
+
+    #sectionify: number of soma children of each soma point
+    nchild_soma = np.zeros(npts)
+    soma = (types[child] == 1) & (types[parent] == 1)
+    np.add.at(nchild_soma, parent[soma], 1)
+
+    #neuromorpho.org 3-point soma with uniform diameter and length equal to
+    #the diameter is treated as a sphere
+    soma3geom = False
+    if (types == 1).sum() == 3 and pix[1] == 0 and pix[2] == 0 and \
+            nchild[1] == 0 and nchild[2] == 0 and \
+            diam[1] == diam[0] and diam[2] == diam[0]:
+        length = np.sqrt(((xyz[1:3] - xyz[0])**2).sum(axis=1)).sum()
+        if abs(length / diam[0] - 1) < .01:
+            soma3geom = True
+            pix[2] = 1
+
+    #adjacent soma points are not section ends, unless branching soma
+    i = np.arange(npts - 1)
+    contiguous = (types[:-1] == 1) & (types[1:] == 1) & (pix[1:] == i) & \
+        ~((i != 0) & (nchild_soma[:-1] > 1))
+    nchild[:-1][contiguous] = 1
+
+    sec2point = np.where(nchild != 1)[0]
+    point2sec = np.searchsorted(sec2point, np.arange(npts))
+
+    #mksections: the raw points, parent and connection of each section,
+    #looping over lists which is faster than over arrays
+    firsts = np.r_[0, sec2point[:-1] + 1].tolist()
+    ends = (sec2point + 1).tolist()
+    types_list = types.tolist()
+    pix_list = pix.tolist()
+    point2sec_list = point2sec.tolist()
+    nchild_soma_list = nchild_soma.tolist()
+    connect2prox_list = connect2prox.tolist()
+    diam_list = diam.tolist()
+    xyz_list = xyz.tolist()
+    secs = []
+    for isec, (first, end) in enumerate(zip(firsts, ends)):
+        sec = {'type' : types_list[first], 'parent' : -1, 'parentx' : 1.,
+               'first' : 0, 'id' : first}
+        if isec == 0:
+            if soma3geom:
+                end = 1
+            sec['points'] = list(range(first, end))
+        else:
+            pp = pix_list[first]
+            psec = secs[point2sec_list[pp]]
+            sec['parent'] = point2sec_list[pp]
+            den_con_soma = psec['type'] == 1 and types_list[first] != 1
+            con_soma = psec['type'] == 1
+            handled = False
+            if sec['parent'] == 0:
+                handled = True
+                if den_con_soma and len(psec['points']) == 1:
+                    #single point soma, connect by wire to the middle
+                    sec['parentx'] = .5
+                    if end - first > 1:
+                        sec['first'] = 1
+                elif pp == psec['id']:
+                    #connect to the first point of the root
+                    sec['parentx'] = 0.
+                    if types_list[first] != 1 and nchild_soma_list[pp] > 1:
+                        sec['first'] = 1
+                else:
+                    handled = False
+            if not handled and con_soma:
+                offset = -1 if psec['id'] == 0 else -2
+                if pp < psec['id'] + len(psec['points']) + offset:
+                    #connection to the interior of a multipoint soma
+                    sec['parentx'] = .5
+                    if den_con_soma and end - first > 1:
+                        sec['first'] = 1
+                elif end - first > 1 and nchild_soma_list[pp] > 1:
+                    if types_list[first] != 1:
+                        sec['first'] = 1
+            sec['points'] = [pp] + list(range(first, end))
+        sec['diam'] = [diam_list[point] for point in sec['points']]
+        if sec['parent'] >= 0:
+            if secs[sec['parent']]['type'] == 1 and sec['type'] != 1:
+                sec['diam'][0] = sec['diam'][1]
+        if connect2prox_list[first]:
+            sec['parentx'] = 0.
+        secs.append(sec)
+
+    #chk_valid: remove one point and zero length two point sections,
+    #reattaching their children to the parent of the removed section
+    for isec in range(len(secs) - 1, 0, -1):
+        sec = secs[isec]
+        if sec is None:
+            continue
+        npoints = len(sec['points']) - sec['first']
+        if npoints <= 1 or npoints == 2 and \
+                xyz_list[sec['points'][sec['first']]] == \
+                xyz_list[sec['points'][sec['first'] + 1]]:
+            for other in secs[isec + 1:]:
+                if other is not None and other['parent'] == isec:
+                    other['parent'] = sec['parent']
+                    other['parentx'] = sec['parentx']
+            secs[isec] = None
+    keep = [isec for isec, sec in enumerate(secs) if sec is not None]
+
+    #names from types, sections are created type by type
+    counts = {}
+    for isec in keep:
+        sec = secs[isec]
+        sec['nameindex'] = counts.get(sec['type'], 0)
+        counts[sec['type']] = sec['nameindex'] + 1
+    order = sorted(keep, key=lambda isec: (secs[isec]['type'],
+                                           secs[isec]['nameindex']))
+    newindex = dict((isec, i) for i, isec in enumerate(order))
+
+    secnames = []
+    parent = np.zeros(len(order), dtype=int) - 1
+    parentx = np.zeros(len(order))
+    logical = np.zeros((len(order), 3)) + np.nan
+    n3d = np.zeros(len(order), dtype=int)
+    index3d = []
+    diam3d = []
+    xshift3d = []
+    for i, isec in enumerate(order):
+        sec = secs[isec]
+        secnames.append('%s[%i]' % (_type2name(sec['type']),
+                                    sec['nameindex']))
+        if sec['parent'] >= 0:
+            parent[i] = newindex[sec['parent']]
+            parentx[i] = sec['parentx']
+        if sec['first'] == 1:
+            logical[i] = xyz[sec['points'][0]]
+        points = sec['points'][sec['first']:]
+        d = sec['diam'][sec['first']:]
+        if len(points) == 1:
+            #sphere represented as a cylinder with length equal to diam
+            points = points * 3
+            d = d * 3
+            xshift3d += [-d[0] / 2, 0., d[0] / 2]
+        else:
+            xshift3d += [0.] * len(points)
+        n3d[i] = len(points)
+        index3d += points
+        diam3d += d
+
+    return {
+        'secnames' : np.array(secnames),
+        'parent' : parent,
+        'parentx' : parentx,
+        'childx' : np.zeros(len(order)),
+        'logical' : logical,
+        'n3d' : n3d,
+        'x3d' : xyz[index3d, 0] + np.array(xshift3d),
+        'y3d' : xyz[index3d, 1],
+        'z3d' : xyz[index3d, 2],
+        'diam3d' : np.array(diam3d),
+    }
+
+
+def _type2name(swc_type):
+    '''Section name of swc point type, as in Import3d_GUI'''
+    if swc_type == 1:
+        return 'soma'
+    elif swc_type == 2:
+        return 'axon'
+    elif swc_type == 3:
+        return 'dend'
+    elif swc_type == 4:
+        return 'apic'
+    elif swc_type < 0:
+        return 'minus_%i' % -swc_type
+    else:
+        return 'dend_%i' % swc_type
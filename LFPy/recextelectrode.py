@@ -12,8 +12,11 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.'''
 
 import numpy as np
+import scipy.sparse as sparse
 import warnings
-from LFPy import lfpcalc, tools
+from collections import OrderedDict
+from LFPy import backends, tools
+from LFPy.lfpcalc import _map_blocks
 
 class RecExtElectrodeSetup(object):
     '''
@@ -57,6 +60,17 @@ class RecExtElectrodeSetup(object):
             Flag for verbose output
         seedvalue : int,
             rand seed when finding random position on contact with r >0
+        n_threads : int,
+            number of threads filling the mapping matrix in calc_mapping.
+            Speeds up the mapping only with the cython backend, which fills
+            the rows without the GIL, see LFPy.backends
+        cutoff : None or float,
+            if given, point contacts use a sparse mapping matrix keeping only
+            the segments within cutoff (mum) of each contact, see
+            calc_mapping
+        table : None or LFPy.LineSourceTable,
+            if given, the line-source mapping of point contacts without a
+            cutoff is interpolated from the table, see calc_mapping
     '''
     def __init__(self, cell=None, sigma=0.3,
                  x=np.array([0]), y=np.array([0]), z=np.array([0]),
@@ -64,7 +78,7 @@ class RecExtElectrodeSetup(object):
                  perCellLFP=False, method='linesource', 
                  color='g', marker='o',
                  from_file=False, cellfile=None, verbose=False,
-                 seedvalue=None,
+                 seedvalue=None, n_threads=1, cutoff=None, table=None,
                  **kwargs):
         '''Initialize class RecExtElectrodeSetup'''
         self.cell = cell
@@ -122,6 +136,9 @@ class RecExtElectrodeSetup(object):
         self.method = method
         self.verbose = verbose
         self.seedvalue = seedvalue
+        self.n_threads = n_threads
+        self.cutoff = cutoff
+        self.table = table
         
         self.kwargs = kwargs
         
@@ -129,6 +146,11 @@ class RecExtElectrodeSetup(object):
         self.electrodecoeff = None
         self.circle = None
         self.offsets = None
+        #indices of the segments closer than r_limit to each contact
+        self.clamped_segments = None
+        #error bounds of the sparse mapping, see calc_mapping
+        self.mapping_error_bound = None
+        self.LFP_error_bound = None
         
 
         if from_file:
@@ -152,7 +174,15 @@ class RecExtElectrodeSetup(object):
         
         
         if self.cell is not None:
-            sum_imem = self.cell.imem.sum(axis=0)
+            imem = self.cell.imem
+            if isinstance(imem, np.ndarray):
+                sum_imem = imem.sum(axis=0)
+            else:
+                #HDF5 datasets and the like, read in blocks of time steps
+                sum_imem = np.empty(imem.shape[1])
+                for i in range(0, imem.shape[1], 1024):
+                    sum_imem[i:i + 1024] = np.asarray(
+                        imem[:, i:i + 1024]).sum(axis=0)
             #check if eye matrix is supplied:
             if np.any(sum_imem == np.ones(self.cell.totnsegs)):
                 pass
@@ -169,6 +199,16 @@ class RecExtElectrodeSetup(object):
         else:
             pass
 
+    def _report_clamped(self):
+        '''Print a summary of the segments whose distance to the contacts
+        was raised to r_limit'''
+        if self.verbose and self.clamped_segments is not None:
+            counts = np.array([inds.size for inds in self.clamped_segments])
+            if counts.sum() > 0:
+                print('r_limit: adjusted distances to %i segments at %i of %i '
+                      'contacts, see clamped_segments'
+                      % (counts.sum(), (counts > 0).sum(), counts.size))
+
 
 class RecExtElectrode(RecExtElectrodeSetup):
     '''
@@ -232,7 +272,8 @@ class RecExtElectrode(RecExtElectrodeSetup):
                  perCellLFP=False, method='linesource', 
                  color='g', marker='o',
                  from_file=False, cellfile=None, verbose=False,
-                 seedvalue=None, **kwargs):
+                 seedvalue=None, n_threads=1, cutoff=None, table=None,
+                 **kwargs):
         '''This is the regular implementation of the RecExtElectrode class
         that calculates the LFP serially using a single core
         
@@ -245,26 +286,77 @@ class RecExtElectrode(RecExtElectrodeSetup):
         RecExtElectrodeSetup.__init__(self, cell, sigma, x, y, z,
                                 N, r, n, shape, r_z, perCellLFP,
                                 method, color, marker, from_file,
-                                cellfile, verbose, seedvalue, **kwargs)
+                                cellfile, verbose, seedvalue, n_threads,
+                                cutoff, table, **kwargs)
         
         
-    def calc_lfp(self, t_indices=None, cell=None):
+    def calc_lfp(self, t_indices=None, cell=None, block_size=None,
+                 out=None, lazy=False, cache_size=0):
         '''Calculate LFP on electrode geometry from all cell instances.
         Will chose distributed calculated if electrode contain 'n', 'N', and 'r'
+        The indices of the segments closer than r_limit to each contact are
+        stored in self.clamped_segments. With a cutoff, the LFP is the product
+        of the sparse mapping of calc_mapping and the membrane currents, and
+        self.LFP_error_bound holds the bound (mV) of its absolute error at
+        each contact.
+
+        With a block_size or out, the mapping of calc_mapping is calculated
+        once and applied to blocks of block_size time steps of cell.imem,
+        which may be a np.memmap or an h5py.Dataset (with increasing
+        t_indices), so that only one block of membrane currents per thread
+        is held in memory. The blocks are handled by self.n_threads threads.
+
+        With lazy=True, self.LFP is a LazyLFP holding the mapping and a
+        reference to cell.imem, which calculates only the contacts and time
+        steps that are indexed, in blocks of block_size (default 1024) time
+        steps of which cache_size are kept. The error bound of a cutoff is
+        then not calculated.
+
+        Arguments:
+        ::
+
+            t_indices : None or np.ndarray, time steps of cell.imem
+            cell : None or LFPy.Cell like object, if None, self.cell
+            block_size : None or int, number of time steps per block
+            out : None or array like, e.g. np.memmap or h5py.Dataset, of
+                shape (number of contacts, number of time steps), written
+                with the LFP and stored as self.LFP
+            lazy : bool, if True, self.LFP is a LazyLFP
+            cache_size : int, number of cached blocks of a contact of a
+                LazyLFP
+
+        Returns:
+        ::
+
+            self.LFP
         '''
+        if lazy and out is not None:
+            raise ValueError('out can not be used with lazy=True')
 
         if cell is not None:
             self.cell = cell
             self._test_imem_sum()
        
-        if not hasattr(self,  'LFP'):
+        if not hasattr(self,  'LFP') and out is None and not lazy:
             if t_indices is not None:
                 self.LFP = np.zeros((self.x.size, t_indices.size))
             else:
                 self.LFP = np.zeros((self.x.size, self.cell.imem.shape[1]))
                     
         
-        if self.n is not None and self.N is not None and self.r is not None:
+        if lazy:
+            if block_size is None:
+                block_size = 1024
+            LFP_temp = LazyLFP(self.calc_mapping(), self.cell.imem,
+                               t_indices=t_indices, block_size=block_size,
+                               cache_size=cache_size)
+        elif block_size is not None or out is not None:
+            LFP_temp = self._calc_lfp_blocks(t_indices=t_indices,
+                                             block_size=block_size, out=out)
+            if self.verbose:
+                print('calculations finished, %s, %s' % (str(self),
+                                                         str(self.cell)))
+        elif self.n is not None and self.N is not None and self.r is not None:
             if self.n <= 1:
                 raise ValueError("n = %i must be larger that 1" % self.n)
             else:
@@ -276,6 +368,11 @@ class RecExtElectrode(RecExtElectrodeSetup):
             if self.verbose:
                 print('calculations finished, %s, %s' % (str(self),
                                                          str(self.cell)))
+        elif self.cutoff is not None:
+            LFP_temp = self._calc_lfp_blocks(t_indices=t_indices)
+            if self.verbose:
+                print('calculations finished, %s, %s' % (str(self),
+                                                         str(self.cell)))
         else:
             LFP_temp = self._loop_over_contacts(t_indices=t_indices,
                                                 r_limit=self.cell.diam/2)
@@ -285,21 +382,156 @@ class RecExtElectrode(RecExtElectrodeSetup):
         
         #dump results:
         self.LFP = LFP_temp
+        self._report_clamped()
+        return self.LFP
+
+
+    def calc_mapping(self, cell=None):
+        '''Calculate the matrix mapping the membrane currents of all segments
+        of the cell onto the electrode contacts, so that the LFP is
+        np.dot(mapping, cell.imem). The rows of point contacts are filled by
+        self.n_threads threads, contacts with a surface (n, N and r given)
+        are averaged as in calc_lfp. The indices of the segments closer
+        than r_limit to each contact are stored in self.clamped_segments.
+        
+        With a cutoff, the mapping of point contacts is a
+        scipy.sparse.csr_matrix of the segments within cutoff of each
+        contact, and self.mapping_error_bound holds the bound of the absolute
+        error of the LFP at each contact per nA of summed absolute current of
+        the dropped segments. Otherwise, with a table and the line-source
+        method, the mapping of point contacts is interpolated by
+        self.table.calc_mapping.
+
+        Arguments:
+        ::
+
+            cell : LFPy.Cell like object, if None, self.cell
+
+        Returns:
+        ::
+
+            mapping : np.ndarray or scipy.sparse.csr_matrix, shape (number of
+                contacts, cell.totnsegs)
+        '''
+        if cell is not None:
+            self.cell = cell
 
+        if self.n is not None and self.N is not None and self.r is not None:
+            #the LFP of unit currents in each segment, will try temp store of
+            #imem, tvec, LFP and CellLFP
+            cellTvec = self.cell.tvec
+            if hasattr(self.cell, 'imem'):
+                cellImem = self.cell.imem
+            else:
+                cellImem = None
+            self.cell.imem = np.eye(self.cell.totnsegs)
+            self.cell.tvec = np.arange(self.cell.totnsegs) * \
+                self.cell.timeres_python
+            restoreLFP = hasattr(self, 'LFP')
+            if restoreLFP:
+                LFPcopy = self.LFP
+                del self.LFP
+            restoreCellLFP = hasattr(self, 'CellLFP')
+            if restoreCellLFP:
+                CellLFP = self.CellLFP
+            self.calc_lfp()
+            mapping = self.LFP.copy()
+            if restoreLFP:
+                self.LFP = LFPcopy
+            else:
+                del self.LFP
+            if restoreCellLFP:
+                self.CellLFP = CellLFP
+            elif hasattr(self, 'CellLFP'):
+                del self.CellLFP
+
+            #putting back variables
+            self.cell.tvec = cellTvec
+            if cellImem is not None:
+                self.cell.imem = cellImem
+            else:
+                del self.cell.imem
+        elif self.cutoff is not None:
+            lfpcalc = backends.get_module('lfpcalc')
+            mapping, self.mapping_error_bound, self.clamped_segments = \
+                lfpcalc.calc_sparse_mapping(
+                    self.cell, x=self.x, y=self.y, z=self.z, sigma=self.sigma,
+                    r_limit=self.cell.diam/2, method=self.method,
+                    cutoff=self.cutoff, n_threads=self.n_threads,
+                    return_clamped=True)
+            self._report_clamped()
+        elif self.table is not None and self.method == 'linesource':
+            mapping, self.clamped_segments = self.table.calc_mapping(
+                self.cell, x=self.x, y=self.y, z=self.z, sigma=self.sigma,
+                r_limit=self.cell.diam/2, n_threads=self.n_threads,
+                return_clamped=True)
+            self._report_clamped()
+        else:
+            lfpcalc = backends.get_module('lfpcalc')
+            mapping, self.clamped_segments = lfpcalc.calc_mapping(
+                self.cell, x=self.x, y=self.y, z=self.z, sigma=self.sigma,
+                r_limit=self.cell.diam/2, method=self.method,
+                n_threads=self.n_threads, return_clamped=True)
+            self._report_clamped()
+
+        return mapping
+
+
+    def _calc_lfp_blocks(self, t_indices=None, block_size=None, out=None):
+        '''The LFP as the product of the mapping of calc_mapping with blocks
+        of time steps of the membrane currents, written into out'''
+        mapping = self.calc_mapping()
+        imem = self.cell.imem
+        if t_indices is None:
+            ntimes = imem.shape[1]
+        else:
+            t_indices = np.array(t_indices).flatten()
+            ntimes = t_indices.size
+        if block_size is None:
+            block_size = max(ntimes, 1)
+        if out is None:
+            out = np.empty((self.x.size, ntimes))
+        elif tuple(out.shape) != (self.x.size, ntimes):
+            raise ValueError('out must have shape %s, not %s' % (
+                str((self.x.size, ntimes)), str(tuple(out.shape))))
+        if sparse.issparse(mapping):
+            #the summed absolute currents of the dropped segments
+            pattern = sparse.csr_matrix((np.ones(mapping.nnz),
+                                         mapping.indices, mapping.indptr),
+                                        shape=mapping.shape)
+
+        def calc_block(start):
+            if t_indices is None:
+                block = np.asarray(imem[:, start:start + block_size])
+            else:
+                block = np.asarray(
+                    imem[:, t_indices[start:start + block_size]])
+            out[:, start:start + block.shape[1]] = mapping.dot(block)
+            if sparse.issparse(mapping):
+                dropped = abs(block).sum(axis=0) - pattern.dot(abs(block))
+                return dropped.max(axis=1)
+
+        starts = list(range(0, ntimes, block_size))
+        dropped = _map_blocks(calc_block, starts, self.n_threads)
+        if sparse.issparse(mapping) and len(starts) > 0:
+            self.LFP_error_bound = self.mapping_error_bound * \
+                np.max(dropped, axis=0)
+        return out
 
     def _loop_over_contacts(self,
                     r_limit=None,
                     timestep=None,
                     t_indices=None):
         '''Loop over electrode contacts, and will return LFPs across channels'''
+        lfpcalc = backends.get_module('lfpcalc')
         if t_indices is not None:
             LFP_temp = np.zeros((self.x.size, t_indices.size))
         else:
             LFP_temp = np.zeros((self.x.size, self.cell.imem.shape[1]))
             
+        self.clamped_segments = []
         for i in range(self.x.size):
-            LFP_temp[i, :] = LFP_temp[i, :] + \
-                    lfpcalc.calc_lfp_choose(self.cell,
+            lfp, clamped = lfpcalc.calc_lfp_choose(self.cell,
                                             x = self.x[i],
                                             y = self.y[i],
                                             z = self.z[i],
@@ -308,7 +540,10 @@ class RecExtElectrode(RecExtElectrodeSetup):
                                             timestep = timestep,
                                             t_indices = t_indices,
                                             method = self.method,
+                                            return_clamped = True,
                                             **self.kwargs)
+            LFP_temp[i, :] = LFP_temp[i, :] + lfp
+            self.clamped_segments.append(clamped)
             
         return LFP_temp
 
@@ -323,6 +558,7 @@ class RecExtElectrode(RecExtElectrodeSetup):
         electrode surface: circle of radius r or square of side r. The
         locations of these n points on the electrode surface are random,
         within the given surface. '''
+        lfpcalc = backends.get_module('lfpcalc')
         lfp_el_pos = np.zeros(self.LFP.shape)
         offsets = {}
         circle_circ = {}
@@ -401,7 +637,7 @@ class RecExtElectrode(RecExtElectrodeSetup):
 
             #loop over points on contact
             for j in range(self.n):
-                tmp = lfpcalc.calc_lfp_choose(self.cell,
+                tmp, clamped = lfpcalc.calc_lfp_choose(self.cell,
                                               x = x_n[j],
                                               y = y_n[j],
                                               z = z_n[j],
@@ -409,7 +645,10 @@ class RecExtElectrode(RecExtElectrodeSetup):
                                               sigma = self.sigma,
                                               t_indices = t_indices,
                                               method = self.method,
+                                              return_clamped = True,
                                               **self.kwargs)
+                self.clamped_segments[-1] = np.union1d(
+                    self.clamped_segments[-1], clamped)
 
                 
                 if j == 0:
@@ -423,7 +662,9 @@ class RecExtElectrode(RecExtElectrodeSetup):
             return lfp_e.mean(axis=0)
 
         #loop over contacts
+        self.clamped_segments = []
         for i in range(len(self.x)):
+            self.clamped_segments.append(np.array([], dtype=int))
             if self.n > 1:
             
                 #fetch offsets:
@@ -436,14 +677,16 @@ class RecExtElectrode(RecExtElectrodeSetup):
                 #del lfp_e
                 
             else:
-                lfp_el_pos[i] = lfpcalc.calc_lfp_choose(self.cell, 
-                                                        x=self.x[i],
-                                                        y=self.y[i],
-                                                        z=self.z[i],
-                                                        r_limit = r_limit, 
-                                                        sigma=self.sigma,
-                                                        t_indices=t_indices,
-                                                        **self.kwargs)
+                lfp_el_pos[i], self.clamped_segments[i] = \
+                    lfpcalc.calc_lfp_choose(self.cell, 
+                                            x=self.x[i],
+                                            y=self.y[i],
+                                            z=self.z[i],
+                                            r_limit = r_limit, 
+                                            sigma=self.sigma,
+                                            t_indices=t_indices,
+                                            return_clamped = True,
+                                            **self.kwargs)
                 
             offsets[i] = {
                 'x_n' : x_n,
@@ -472,4 +715,108 @@ class RecExtElectrode(RecExtElectrodeSetup):
         return circle_circ,  offsets,  lfp_el_pos
 
 
+class LazyLFP(object):
+    '''
+    Array like LFP of RecExtElectrode.calc_lfp(lazy=True), the product of a
+    mapping matrix with membrane currents, calculated only for the contacts
+    and time steps that are indexed.
+
+    The time steps are split in blocks of block_size. With cache_size > 0,
+    the LFP of each indexed contact is calculated for whole blocks, and the
+    cache_size least recently used blocks of single contacts are kept.
+
+    Arguments:
+    ::
+
+        mapping : np.ndarray or scipy.sparse matrix, shape (number of
+            contacts, number of segments)
+        imem : np.ndarray, np.memmap or h5py.Dataset, membrane currents of
+            shape (number of segments, number of time steps)
+        t_indices : None or np.ndarray, time steps of imem
+        block_size : int, number of time steps of the cached blocks
+        cache_size : int, number of cached blocks
+
+    Usage:
+    ::
 
+        LFP = electrode.calc_lfp(lazy=True, cache_size=64)
+        LFP[:4, 1000:2000]     #calculates 4 contacts at 1000 time steps
+        np.asarray(LFP)        #calculates everything
+    '''
+    def __init__(self, mapping, imem, t_indices=None, block_size=1024,
+                 cache_size=0):
+        '''Initialize class LazyLFP'''
+        self.mapping = mapping
+        self.imem = imem
+        if t_indices is None:
+            self.t_indices = None
+            ntimes = imem.shape[1]
+        else:
+            self.t_indices = np.array(t_indices).flatten()
+            ntimes = self.t_indices.size
+        self.shape = (mapping.shape[0], ntimes)
+        self.block_size = block_size
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    ndim = 2
+    dtype = np.dtype(float)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        LFP = self[:, :]
+        if dtype is not None:
+            LFP = LFP.astype(dtype)
+        return LFP
+
+    def __getitem__(self, key):
+        '''The LFP of the contacts and time steps key'''
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            raise IndexError('LazyLFP takes at most two indices')
+        rows = np.arange(self.shape[0])[key[0]]
+        cols = np.arange(self.shape[1])[key[1]]
+        LFP = self._calc(np.atleast_1d(rows), np.atleast_1d(cols))
+        if np.ndim(cols) == 0:
+            LFP = LFP[:, 0]
+        if np.ndim(rows) == 0:
+            LFP = LFP[0]
+        return LFP
+
+    def _imem(self, cols):
+        '''Membrane currents of the time steps cols'''
+        if self.t_indices is not None:
+            cols = self.t_indices[cols]
+        if cols.size > 0 and np.all(np.diff(cols) == 1):
+            return np.asarray(self.imem[:, cols[0]:cols[-1] + 1])
+        return np.asarray(self.imem[:, cols])
+
+    def _calc(self, rows, cols):
+        '''The LFP of the contacts rows at the time steps cols'''
+        if self.cache_size <= 0:
+            return self.mapping[rows].dot(self._imem(cols))
+
+        LFP = np.empty((rows.size, cols.size))
+        blocks = cols // self.block_size
+        for block in np.unique(blocks):
+            inds = np.where(blocks == block)[0]
+            start = block * self.block_size
+            #calculate the uncached contacts for the whole block
+            missing = [i for i in np.unique(rows)
+                       if (i, block) not in self._cache]
+            if len(missing) > 0:
+                values = self.mapping[missing].dot(self._imem(
+                    np.arange(start, min(start + self.block_size,
+                                         self.shape[1]))))
+                for i, value in zip(missing, values):
+                    self._cache[(i, block)] = value
+            for n, i in enumerate(rows):
+                value = self._cache.pop((i, block))
+                self._cache[(i, block)] = value
+                LFP[n, inds] = value[cols[inds] - start]
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return LFP
@@ -11,26 +11,114 @@ but WITHOUT ANY WARRANTY; without even the implied warranty of
 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.'''
 
+import os
+import tempfile
 import numpy as np
+import scipy.sparse as sparse
 import neuron
 
 from time import time
+from warnings import warn
+from LFPy.tools import _atomic_write, _atomic_savez
 
-def _run_simulation(cell, variable_dt=False, atol=0.001):
+#hoc procedures filling Vectors with the pt3d points and segments of the
+#currently accessed section, avoiding one Python->hoc call for each value
+if not hasattr(neuron.h, 'lfpy_get_pt3d'):
+    neuron.h('''
+proc lfpy_get_pt3d() { local i
+    $o1.append(n3d())
+    for i = 0, n3d() - 1 {
+        $o2.append(arc3d(i))
+        $o3.append(x3d(i))
+        $o4.append(y3d(i))
+        $o5.append(z3d(i))
+        $o6.append(diam3d(i))
+    }
+}
+proc lfpy_get_segments() { local x
+    $o1.append(nseg)
+    $o2.append(L)
+    for (x, 0) {
+        $o3.append(x)
+        $o4.append(area(x))
+        $o5.append(diam(x))
+    }
+}
+func lfpy_set_pt3d() { local i, j
+    j = $5
+    for i = 0, n3d() - 1 {
+        pt3dchange(i, $o1.x[j], $o2.x[j], $o3.x[j], $o4.x[j])
+        j += 1
+    }
+    return j
+}
+proc lfpy_add_pt3d() { local i
+    pt3dclear()
+    for i = $5, $6 - 1 {
+        pt3dadd($o1.x[i], $o2.x[i], $o3.x[i], $o4.x[i])
+    }
+}
+''')
+
+def _set_threads(cells, threads=1):
     '''
-    Running the actual simulation in NEURON, simulations in NEURON
-    are now interruptable.
+    Set the number of threads used by NEURON for the integration. With more
+    than one thread, each cell is split at the middle of its root section
+    using ParallelContext.multisplit, so that the subtrees of a single cell
+    are distributed among the threads. With one thread, the ParallelContext
+    is left as it is, the settings of more threads are undone by
+    _reset_threads.
+    
+    NEURON only allows one thread once the extracellular mechanism has been
+    used, all cells must then be created with extracellular=False.
     '''
-    neuron.h.dt = cell.timeres_NEURON
+    if threads <= 1:
+        return
+    pc = neuron.h.ParallelContext()
+    #splits of earlier simulations must be removed before changing threads
+    pc.gid_clear(2)
+    #NEURON complains at initialization, before the cells are split
+    pc.nthread(threads)
+    try:
+        neuron.h.finitialize()
+    except RuntimeError:
+        raise ValueError('threads > 1 not possible after the '
+                         'extracellular mechanism has been used')
+    finally:
+        pc.nthread(1)
+    pc.nthread(threads)
+    for sid, c in enumerate(cells):
+        for sec in c.allseclist:
+            root = neuron.h.SectionRef(sec=sec).root
+            break
+        pc.multisplit(root(0.5), sid)
+    pc.multisplit()
+
+
+def _reset_threads(nthread=1):
+    '''
+    Remove the splits of the cells made by _set_threads, and set the number
+    of threads used by NEURON back to nthread.
+    '''
+    pc = neuron.h.ParallelContext()
+    pc.gid_clear(2)
+    pc.nthread(nthread)
+
+
+def _initialize_simulation(cells, cvode, warmup_file=None, threads=1):
+    '''
+    Initialize the state of NEURON at the v_init of the first cell, and set
+    time to its tstartms. Spike times of synapses are put in the event queue.
+    The integration uses the given number of threads, see _set_threads.
     
-    cvode = neuron.h.CVode()
+    If warmup_file is given, the state at t = 0 is restored from this file
+    if it exists, otherwise the model is integrated from tstartms to t = 0
+    and the state is saved to the file using neuron.h.SaveState. Only used
+    with the fixed time step method.
+    '''
+    cell = cells[0]
     
-    #don't know if this is the way to do, but needed for variable dt method
-    if variable_dt:
-        cvode.active(1)
-        cvode.atol(atol)
-    else:
-        cvode.active(0)
+    _set_threads(cells, threads)
     
     #initialize state
     neuron.h.finitialize(cell.v_init)
@@ -38,14 +126,360 @@ def _run_simulation(cell, variable_dt=False, atol=0.001):
     #initialize current- and record
     if cvode.active():
         cvode.re_init()
+        warmup_file = None
     else:
         neuron.h.fcurrent()
     neuron.h.frecord_init()
     
-    ##Starting simulation at tstart
+    if warmup_file is not None and os.path.isfile(warmup_file):
+        try:
+            state = neuron.h.SaveState()
+            f = neuron.h.File()
+            f.ropen(warmup_file)
+            state.fread(f)
+            #keep the event queue of recorders, spikes are loaded below
+            state.restore(1)
+            if cell.verbose:
+                print('restored state at t = 0 from %s' % warmup_file)
+            for c in cells:
+                c._loadspikes(tmin=neuron.h.t)
+            return
+        except RuntimeError:
+            print('could not restore state from %s' % warmup_file)
+            neuron.h.finitialize(cell.v_init)
+            neuron.h.fcurrent()
+            neuron.h.frecord_init()
+    
+    #Starting simulation at t != 0
     neuron.h.t = cell.tstartms
     
-    cell._loadspikes()
+    #load spike times from NetCon
+    for c in cells:
+        c._loadspikes()
+    
+    if warmup_file is not None:
+        #integrate up to the time step closest to t = 0 and save the state
+        while neuron.h.t < -cell.timeres_NEURON / 2:
+            neuron.h.fadvance()
+        state = neuron.h.SaveState()
+        state.save()
+        def write(tmpfile):
+            f = neuron.h.File()
+            f.wopen(tmpfile)
+            state.fwrite(f)
+            f.close()
+        try:
+            _atomic_write(warmup_file, write, '.dat')
+            if cell.verbose:
+                print('saved state at t = 0 to %s' % warmup_file)
+        except (IOError, OSError, RuntimeError):
+            print('could not write state to %s' % warmup_file)
+
+
+def _save_checkpoint(cells, checkpoint_file, tstep, counter,
+                     electrodesLFP=None, el_LFP_file=None, saved=None):
+    '''
+    Save a checkpoint of a running simulation to checkpoint_file, from
+    which the simulation can be continued by _load_checkpoint. The file
+    contains the NEURON state and event queue from neuron.h.SaveState, the
+    random state of NetStims and the step counters. The values recorded by
+    NEURON and the first tstep samples of the LFPs in electrodesLFP are
+    kept in the files checkpoint_file + '.rec' and checkpoint_file + '.lfp'.
+    saved is a list of the numbers of samples of the recorders and the LFPs
+    already in these files, written by earlier checkpoints, so that only
+    the samples since then are appended, and is updated. The LFPs written
+    to file are flushed, they are restored from there.
+    '''
+    if saved is None:
+        saved = [0, 0]
+    checkpoint = {
+        'tstep' : tstep,
+        'counter' : counter,
+    }
+    state = neuron.h.SaveState()
+    state.save()
+    cachedir = os.path.dirname(os.path.abspath(checkpoint_file))
+    fd, tmpfile = tempfile.mkstemp(suffix='.dat', dir=cachedir)
+    os.close(fd)
+    try:
+        f = neuron.h.File()
+        f.wopen(tmpfile)
+        state.fwrite(f)
+        with open(tmpfile, 'rb') as f:
+            checkpoint['state'] = np.frombuffer(f.read(), dtype=np.uint8)
+    finally:
+        os.remove(tmpfile)
+    
+    recorders = []
+    for i, c in enumerate(cells):
+        recorders += [rec.as_numpy()[np.newaxis]
+                      for rec in c._get_recorders()]
+        checkpoint['cell{}_netstim'.format(i)] = np.array(
+                                        _get_netstim_sequences(c))
+    if len(recorders) > 0:
+        nrec = recorders[0].shape[1]
+    else:
+        nrec = 0
+    checkpoint['nrec'] = nrec
+    saved[0] = _append_samples(checkpoint_file + '.rec', recorders,
+                               saved[0], nrec)
+    if electrodesLFP is not None and len(electrodesLFP) > 0:
+        saved[1] = _append_samples(checkpoint_file + '.lfp', electrodesLFP,
+                                   saved[1], tstep)
+    if el_LFP_file is not None:
+        el_LFP_file.flush()
+    
+    _atomic_savez(checkpoint_file, **checkpoint)
+    if cells[0].verbose:
+        print('saved checkpoint at t = {:.0f} to {}'.format(neuron.h.t,
+                                                          checkpoint_file))
+
+
+def _load_checkpoint(cells, cvode, checkpoint_file, electrodesLFP=None,
+                     saved=None):
+    '''
+    Restore a simulation initialized by _initialize_simulation from
+    checkpoint_file written by _save_checkpoint, returns the step counters.
+    The LFPs calculated before the checkpoint are put in electrodesLFP. If
+    saved is given, it is set to the numbers of samples in the files of the
+    checkpoint, for continuing to write checkpoints to checkpoint_file.
+    '''
+    with np.load(checkpoint_file) as checkpoint:
+        cachedir = os.path.dirname(os.path.abspath(checkpoint_file))
+        fd, tmpfile = tempfile.mkstemp(suffix='.dat', dir=cachedir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(checkpoint['state'].tobytes())
+            state = neuron.h.SaveState()
+            f = neuron.h.File()
+            f.ropen(tmpfile)
+            state.fread(f)
+        finally:
+            os.remove(tmpfile)
+        #restore the event queue of the checkpoint, replacing spikes loaded
+        #at initialization
+        state.restore(0)
+        if cvode.active():
+            cvode.re_init()
+        
+        nrec = int(checkpoint['nrec'])
+        recorders = []
+        for i, c in enumerate(cells):
+            recorders += c._get_recorders()
+            _set_netstim_sequences(c, checkpoint['cell{}_netstim'.format(i)])
+        samples = _read_samples(checkpoint_file + '.rec', len(recorders),
+                                nrec)
+        for rec, values in zip(recorders, samples):
+            rec.from_python(values)
+        tstep = int(checkpoint['tstep'])
+        if electrodesLFP is not None and len(electrodesLFP) > 0:
+            samples = _read_samples(checkpoint_file + '.lfp',
+                                    sum([LFP.shape[0]
+                                         for LFP in electrodesLFP]), tstep)
+            i = 0
+            for LFP in electrodesLFP:
+                LFP[:, :tstep] = samples[i:i + LFP.shape[0]]
+                i += LFP.shape[0]
+        counter = int(checkpoint['counter'])
+    if saved is not None:
+        saved[:] = [nrec, tstep]
+    if cells[0].verbose:
+        print('resumed at t = {:.0f} from {}'.format(neuron.h.t,
+                                                    checkpoint_file))
+    return tstep, counter
+
+
+def _append_samples(filename, arrays, start, stop):
+    '''
+    Write the samples start to stop of arrays, a list of 2D arrays with
+    the samples along the columns, to the binary file filename after its
+    first start samples, one sample of all rows after the other. The file is
+    written from the first sample if it holds less than start samples.
+    Returns stop, the number of samples in the file.
+    '''
+    nrows = sum([a.shape[0] for a in arrays])
+    if start > 0 and os.path.isfile(filename) and \
+            os.path.getsize(filename) >= start * nrows * 8:
+        f = open(filename, 'r+b')
+    else:
+        start = 0
+        f = open(filename, 'wb')
+    try:
+        f.seek(start * nrows * 8)
+        f.truncate()
+        if nrows > 0 and stop > start:
+            samples = np.concatenate([a[:, start:stop] for a in arrays])
+            f.write(np.ascontiguousarray(samples.T, dtype=np.float64
+                                         ).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    return stop
+
+
+def _read_samples(filename, nrows, stop):
+    '''Return the first stop samples of the nrows rows written to filename
+    by _append_samples, shape (nrows, stop)'''
+    samples = np.fromfile(filename, dtype=np.float64, count=stop * nrows)
+    return samples.reshape(stop, nrows).T
+
+
+def _get_imem_vi(cells, imemvars, imem, vi=None):
+    '''
+    Fill imem with the membrane currents imemvars of the segments of all
+    cells, and vi, if given, with their intracellular potentials in the same
+    loop over the segments. The intracellular potentials are the membrane
+    voltages plus vext[0] of the extracellular mechanism, the axial
+    currents follow from their differences between segments.
+    '''
+    i = 0
+    for c, imemvar in zip(cells, imemvars):
+        if vi is None:
+            for sec in c.allseclist:
+                for seg in sec:
+                    imem[i] = getattr(seg, imemvar)
+                    i += 1
+        elif c.extracellular:
+            for sec in c.allseclist:
+                for seg in sec:
+                    imem[i] = getattr(seg, imemvar)
+                    vi[i] = seg.v + seg.vext[0]
+                    i += 1
+        else:
+            for sec in c.allseclist:
+                for seg in sec:
+                    imem[i] = getattr(seg, imemvar)
+                    vi[i] = seg.v
+                    i += 1
+
+
+def _set_spike_detectors(cells, threshold):
+    '''
+    Create a NetCon for each cell detecting spikes in the membrane potential
+    in the middle of the first soma section, returns the NetCons and the
+    vectors recording their spike times. NetCons watching the same potential
+    share their threshold in NEURON, so the threshold of existing NetCons is
+    kept, with a warning if it differs from threshold.
+    '''
+    netcons = []
+    spikevecs = []
+    for c in cells:
+        if c.nsomasec == 0:
+            raise ValueError('spike detection requires a soma section')
+        for sec in c.somalist:
+            break
+        shared = False
+        for nc in neuron.h.List('NetCon'):
+            if nc.preseg() is not None and nc.preseg() == sec(0.5):
+                shared = True
+                break
+        netcon = neuron.h.NetCon(sec(0.5)._ref_v, None, sec=sec)
+        if not shared:
+            netcon.threshold = threshold
+        elif netcon.threshold != threshold:
+            warn('spikes of %s detected with the threshold %g of existing '
+                 'NetCons instead of %g' % (sec.name(), netcon.threshold,
+                                            threshold))
+        spikevec = neuron.h.Vector()
+        netcon.record(spikevec)
+        netcons.append(netcon)
+        spikevecs.append(spikevec)
+    return netcons, spikevecs
+
+
+def _collect_spike_snippets(spikevecs, nseen, pending, ringLFP, snippets,
+                            spikeinfo, tstep, dt, npre, npost, nsamples):
+    '''
+    Queue the windows from npre samples before to npost samples after the
+    spikes in spikevecs not seen before, and copy the windows completed at
+    sample tstep from the ring buffers ringLFP to snippets, and the spike
+    time and index of the spiking cell to spikeinfo. Sample i is in column
+    i % (npre + npost + 2) of the ring buffers, as spikes are detected up to
+    one time step after the sample closest to the spike.
+    '''
+    for i, spikevec in enumerate(spikevecs):
+        while nseen[i] < spikevec.size():
+            tspike = spikevec.x[nseen[i]]
+            nseen[i] += 1
+            ispike = int(round(tspike / dt))
+            #windows beyond the first or last sample are skipped
+            if ispike - npre >= 0 and ispike + npost < nsamples:
+                pending.append((ispike, tspike, i))
+    for spike in pending[:]:
+        ispike, tspike, i = spike
+        if ispike + npost <= tstep:
+            cols = np.arange(ispike - npre, ispike + npost + 1) % \
+                (npre + npost + 2)
+            for j, ring in enumerate(ringLFP):
+                snippets[j].append(ring[:, cols])
+            spikeinfo.append((tspike, i))
+            pending.remove(spike)
+
+
+def _get_netstim_sequences(cell):
+    '''Sequence numbers of the random streams of the NetStims of cell,
+    for NEURON versions where NetStim has a RANDOM variable'''
+    sequences = []
+    if hasattr(cell, 'netstimlist'):
+        for netstim in cell.netstimlist:
+            if hasattr(netstim, 'ranvar'):
+                sequences.append(netstim.ranvar.get_seq())
+            elif netstim.noise > 0:
+                print('random state of NetStim not saved with this NEURON')
+    return sequences
+
+
+def _set_netstim_sequences(cell, sequences):
+    '''Set the sequence numbers of the random streams of the NetStims of
+    cell, see _get_netstim_sequences'''
+    if hasattr(cell, 'netstimlist'):
+        netstims = [netstim for netstim in cell.netstimlist
+                    if hasattr(netstim, 'ranvar')]
+        for netstim, sequence in zip(netstims, sequences):
+            netstim.ranvar.set_seq(float(sequence))
+
+
+def _run_simulation(cell, variable_dt=False, atol=0.001, warmup_file=None,
+                    checkpoint_file=None, checkpoint_interval=1000.,
+                    resume_from=None, threads=1):
+    '''
+    Running the actual simulation in NEURON, simulations in NEURON
+    are now interruptable.
+    
+    cell may be a list of cells advanced together in one loop, using the
+    time parameters of the first cell. The state at t = 0 is cached in
+    warmup_file if given, see _initialize_simulation.
+    
+    A checkpoint is saved to checkpoint_file every checkpoint_interval ms of
+    simulated time if given, and the simulation is continued from the
+    checkpoint file resume_from if given.
+    '''
+    if type(cell) == list:
+        cells = cell
+        cell = cells[0]
+    else:
+        cells = [cell]
+    
+    neuron.h.dt = cell.timeres_NEURON
+    
+    cvode = neuron.h.CVode()
+    
+    #don't know if this is the way to do, but needed for variable dt method
+    if variable_dt:
+        cvode.active(1)
+        cvode.atol(atol)
+        #the extracellular mechanism requires the daspk solver
+        if any([getattr(c, 'extracellular', False) for c in cells]):
+            cvode.use_daspk(1)
+    else:
+        cvode.active(0)
+    
+    #initialize state, and integrate or restore the state before t = 0
+    if resume_from is None:
+        _initialize_simulation(cells, cvode, warmup_file, threads)
+    else:
+        _initialize_simulation(cells, cvode, threads=threads)
     
     #print sim.time and realtime factor at intervals
     counter = 0.
@@ -56,9 +490,22 @@ def _run_simulation(cell, variable_dt=False, atol=0.001):
     else:
         interval = 1 / cell.timeres_NEURON * 100
     
+    #numbers of samples in the files of checkpoint_file
+    saved = [0, 0]
+    if resume_from is not None:
+        _, counter = _load_checkpoint(cells, cvode, resume_from, saved=saved)
+        if checkpoint_file is None or os.path.abspath(checkpoint_file) != \
+                os.path.abspath(resume_from):
+            saved = [0, 0]
+    tcheckpoint = neuron.h.t + checkpoint_interval
+    
     while neuron.h.t < cell.tstopms:
         neuron.h.fadvance()
         counter += 1.
+        if checkpoint_file is not None and neuron.h.t >= tcheckpoint:
+            _save_checkpoint(cells, checkpoint_file, 0, counter,
+                             saved=saved)
+            tcheckpoint += checkpoint_interval
         if np.mod(counter, interval) == 0:
             rtfactor = (neuron.h.t - ti) * 1E-3 / (time() - t0)
             if cell.verbose:
@@ -70,12 +517,55 @@ def _run_simulation(cell, variable_dt=False, atol=0.001):
 def _run_simulation_with_electrode(cell, electrode=None,
                                    variable_dt=False, atol=0.001,
                                    to_memory=True, to_file=False,
-                                   file_name=None, dotprodcoeffs=None):
+                                   file_name=None, dotprodcoeffs=None,
+                                   warmup_file=None, checkpoint_file=None,
+                                   checkpoint_interval=1000.,
+                                   resume_from=None, threads=1,
+                                   vmemcoeffs=None, spike_window=None,
+                                   spike_threshold=-20., imemcoeffs=None):
     '''
     Running the actual simulation in NEURON.
     electrode argument used to determine coefficient
     matrix, and calculate the LFP on every time step.
+    
+    cell may be a list of cells advanced together in one loop, using the
+    time parameters of the first cell. The coefficients of all cells are
+    then stacked column-wise, so that each electrode needs one product with
+    the membrane currents of all cells per time step. The state at t = 0 is
+    cached in warmup_file if given, see _initialize_simulation.
+    
+    A checkpoint is saved to checkpoint_file every checkpoint_interval ms of
+    simulated time if given, and the simulation is continued from the
+    checkpoint file resume_from if given, writing to the same file_name.
+    
+    With variable_dt, the LFPs are calculated in chunks from membrane
+    currents recorded by NEURON every timeres_python, see
+    _run_cvode_with_electrode. Checkpoints are then not supported.
+    
+    vmemcoeffs is a list of tuples (G, M) of a sparse matrix G and a dense
+    matrix M, for which np.dot(M, G.dot(vmem)) of the intracellular
+    potentials of all segments, gathered with the membrane currents by
+    _get_imem_vi, is calculated on every time step and stored in
+    cell.vmemdotprodresults, e.g., the magnetic field of the axial currents
+    of LFPy.eegmegcalc.get_biot_savart_coeffs. Only with fixed time steps.
+    
+    imemcoeffs is a list of coefficient matrices, whose products with the
+    membrane currents are calculated on every time step and stored in
+    cell.imemdotprodresults independent of to_memory, to_file and
+    spike_window, e.g., the current dipole moments of the cells.
+    
+    With spike_window = (tpre, tpost), only the LFPs in windows from tpre
+    ms before to tpost ms after each somatic spike of the cells, detected
+    with threshold spike_threshold, are kept in memory, using ring buffers
+    of one window instead of the full LFPs, see _collect_spike_snippets.
+    The full LFPs are then not stored, so to_memory must be False.
     '''
+    if type(cell) == list:
+        cells = cell
+        cell = cells[0]
+    else:
+        cells = [cell]
+    
     try:
         import h5py
     except:
@@ -99,6 +589,10 @@ def _run_simulation_with_electrode(cell, electrode=None,
     
     #just for safekeeping
     lendotrodcoeffs0 = len(dotprodcoeffs)
+    if vmemcoeffs is None:
+        vmemcoeffs = []
+    if imemcoeffs is None:
+        imemcoeffs = []
     
     #access electrode object and append dotprodcoeffs
     if electrode is not None:
@@ -108,45 +602,8 @@ def _run_simulation_with_electrode(cell, electrode=None,
         else:
             electrodes = [electrode]
         
-        #calculate list of dotprodcoeffs, will try temp store of imem, tvec, LFP
-        cellTvec = cell.tvec
-        try:
-            cellImem = cell.imem.copy()
-        except:
-            pass
-        
-        cell.imem = np.eye(cell.totnsegs)
-        cell.tvec = np.arange(cell.totnsegs) * cell.timeres_python
-        electrodeLFP = []   #list of electrode.LFP objects if they exist
-        restoreLFP = False
-        restoreCellLFP = False
-        for el in electrodes:
-            if hasattr(el, 'LFP'):
-                LFPcopy = el.LFP
-                del el.LFP
-                restoreLFP = True
-            if hasattr(el, 'CellLFP'):
-                CellLFP = el.CellLFP
-                restoreCellLFP = True
-            el.calc_lfp(cell=cell)
-            dotprodcoeffs.append(el.LFP.copy())
-            if restoreLFP:
-                del el.LFP
-                el.LFP = LFPcopy
-            else:
-                del el.LFP
-            if restoreCellLFP:
-                el.CellLFP = CellLFP
-            else:
-                if hasattr(el, 'CellLFP'):
-                    del el.CellLFP
-            
-        #putting back variables
-        cell.tvec = cellTvec        
-        try:
-            cell.imem = cellImem
-        except:
-            del cell.imem
+        #calculate list of dotprodcoeffs, stacked column-wise for all cells
+        dotprodcoeffs += _get_electrode_coeffs(cells, electrodes)
     elif electrode is None:
         electrodes = None
    
@@ -158,27 +615,46 @@ def _run_simulation_with_electrode(cell, electrode=None,
     cvode = neuron.h.CVode()
     
     #don't know if this is the way to do, but needed for variable dt method
-    if cell.timeres_NEURON <= 1E-8:
+    if variable_dt:
         cvode.active(1)
         cvode.atol(atol)
+        #the extracellular mechanism requires the daspk solver
+        if any([getattr(c, 'extracellular', False) for c in cells]):
+            cvode.use_daspk(1)
     else:
         cvode.active(0)
     
-    #initialize state
-    neuron.h.finitialize(cell.v_init)
-    
-    #initialize current- and record
+    #with variable time steps, NEURON records the membrane currents at the
+    #times of tvec, which are mapped onto the electrodes chunk by chunk
     if cvode.active():
-        cvode.re_init()
-    else:
-        neuron.h.fcurrent()
-    neuron.h.frecord_init()
+        if checkpoint_file is not None or resume_from is not None:
+            raise ValueError('checkpoints require fixed time steps')
+        if len(vmemcoeffs) > 0:
+            raise ValueError('vmemcoeffs require fixed time steps')
+        memireclist = neuron.h.List()
+        for c in cells:
+            for sec in c.allseclist:
+                for seg in sec:
+                    memirec = neuron.h.Vector()
+                    memirec.record(getattr(seg, '_ref_' + c._imemvar),
+                                   c.timeres_python)
+                    memireclist.append(memirec)
     
-    #Starting simulation at tstartms
-    neuron.h.t = cell.tstartms
+    #detect somatic spikes, only windows around them are kept in memory
+    if spike_window is not None:
+        if cvode.active() or checkpoint_file is not None or \
+                resume_from is not None:
+            raise ValueError('spike_window requires fixed time steps and '
+                             'is not possible with checkpoints')
+        if to_memory:
+            raise ValueError('spike_window requires to_memory=False')
+        netcons, spikevecs = _set_spike_detectors(cells, spike_threshold)
     
-    #load spike times from NetCon
-    cell._loadspikes()
+    #initialize state, and integrate or restore the state before t = 0
+    if resume_from is None:
+        _initialize_simulation(cells, cvode, warmup_file, threads)
+    else:
+        _initialize_simulation(cells, cvode, threads=threads)
     
     #print sim.time at intervals
     counter = 0.
@@ -190,50 +666,133 @@ def _run_simulation_with_electrode(cell, electrode=None,
     else:
         interval = 1 / cell.timeres_NEURON * 100
     
+    #number of LFP samples, at every time step or at the times of tvec
+    if cvode.active():
+        nsamples = int(cell.tstopms / cell.timeres_python + 1)
+    else:
+        nsamples = int(cell.tstopms / cell.timeres_NEURON + 1)
+    
+    #the coefficient matrices stacked into one dense and one sparse matrix,
+    #the LFPs of each are row views of the stacked products
+    stacks, slices, nrows = _stack_coeffs(dotprodcoeffs)
+    dotprod = np.empty(nrows)
     #temp vector to store membrane currents at each timestep
-    imem = np.empty(cell.totnsegs)
+    imem = np.empty(sum([c.totnsegs for c in cells]))
+    #ring buffers of the LFPs, windows completed, spikes seen of each cell,
+    #and windows to be completed
+    if spike_window is not None:
+        npre = int(round(spike_window[0] / cell.timeres_NEURON))
+        npost = int(round(spike_window[1] / cell.timeres_NEURON))
+        ringbuffer = np.empty((nrows, npre + npost + 2))
+        ringLFP = [ringbuffer[rows] for rows in slices]
+        snippets = [[] for coeffs in dotprodcoeffs]
+        spikeinfo = []
+        nseen = [0] * len(cells)
+        pending = []
+    #membrane voltages, and their products with vmemcoeffs kept in memory
+    vmem = np.empty(imem.size)
+    vmemresults = [np.empty((M.shape[0], nsamples)) for G, M in vmemcoeffs]
+    #products with imemcoeffs kept in memory
+    imemresults = [np.empty((coeffs.shape[0], nsamples))
+                   for coeffs in imemcoeffs]
     #LFPs for each electrode will be put here during simulation
     if to_memory:
-        electrodesLFP = []
-        for coeffs in dotprodcoeffs:
-            electrodesLFP.append(np.empty((coeffs.shape[0],
-                                int(cell.tstopms / cell.timeres_NEURON) + 1)))
+        LFPbuffer = np.empty((nrows, nsamples))
+        electrodesLFP = [LFPbuffer[rows] for rows in slices]
     #LFPs for each electrode will be put here during simulations
     if to_file:
         #ensure right ending:
         if file_name.split('.')[-1] != 'h5':
             file_name += '.h5'
-        el_LFP_file = h5py.File(file_name, 'w')
-        i = 0
-        for coeffs in dotprodcoeffs:
-            el_LFP_file['electrode{:03d}'.format(i)] = np.empty((coeffs.shape[0],
-                                    int(cell.tstopms / cell.timeres_NEURON + 1)))
-            i += 1
+        if resume_from is not None:
+            #continue writing into the datasets of the interrupted run
+            el_LFP_file = h5py.File(file_name, 'r+')
+        else:
+            el_LFP_file = h5py.File(file_name, 'w')
+            i = 0
+            for coeffs in dotprodcoeffs:
+                el_LFP_file['electrode{:03d}'.format(i)] = np.empty((coeffs.shape[0],
+                                                                     nsamples))
+                i += 1
     
     #multiply segment areas with specific membrane currents later,
     #mum2 conversion factor:
-    area = cell.area * 1E-2
+    area = np.concatenate([c._get_imem_factors() for c in cells])
+    #i_membrane, or i_membrane_ of cells without the extracellular mechanism
+    imemvars = [c._imemvar for c in cells]
+    #intracellular potentials are gathered with the membrane currents
+    if len(vmemcoeffs) > 0:
+        vi = vmem
+    else:
+        vi = None
+    
+    #the products with vmemcoeffs and imemcoeffs are saved in checkpoints
+    #after the LFPs kept in memory, LFPs written to file are restored from
+    #the file
+    checkpointLFP = vmemresults + imemresults
+    if to_memory and not to_file:
+        checkpointLFP = electrodesLFP + checkpointLFP
+    
+    #numbers of samples in the files of checkpoint_file
+    saved = [0, 0]
+    if resume_from is not None:
+        tstep, counter = _load_checkpoint(cells, cvode, resume_from,
+                                          checkpointLFP, saved)
+        if checkpoint_file is None or os.path.abspath(checkpoint_file) != \
+                os.path.abspath(resume_from):
+            saved = [0, 0]
+        if to_memory and to_file:
+            for j, LFP in enumerate(electrodesLFP):
+                LFP[:, :tstep] = el_LFP_file['electrode{:03d}'.format(j)
+                                             ][:, :tstep]
+        #the LFP at the time of the checkpoint is in the checkpoint, while
+        #membrane currents are only set by fadvance
+        neuron.h.fadvance()
+        counter += 1.
+    tcheckpoint = neuron.h.t + checkpoint_interval
+    
+    if cvode.active():
+        _run_cvode_with_electrode(cells, memireclist, stacks, slices,
+                                  LFPbuffer if to_memory else None,
+                                  el_LFP_file if to_file else None,
+                                  imemcoeffs, imemresults)
+    
     #run fadvance until time limit, and calculate LFPs for each timestep
     while neuron.h.t < cell.tstopms:
         if neuron.h.t >= 0:
-            i = 0
-            for sec in cell.allseclist:
-                for seg in sec:
-                    imem[i] = seg.i_membrane
-                    i += 1
+            _get_imem_vi(cells, imemvars, imem, vi)
             #pA/mum2 -> nA conversion
             imem *= area
             
+            _stacked_dot(stacks, imem, dotprod)
             if to_memory:
-                for j, coeffs in enumerate(dotprodcoeffs):
-                    electrodesLFP[j][:, tstep] = np.dot(coeffs, imem)
+                LFPbuffer[:, tstep] = dotprod
                     
             if to_file:
-                for j, coeffs in enumerate(dotprodcoeffs):
+                for j, rows in enumerate(slices):
                     el_LFP_file['electrode{:03d}'.format(j)
-                                ][:, tstep] = np.dot(coeffs, imem)
+                                ][:, tstep] = dotprod[rows]
+
+            if spike_window is not None:
+                ringbuffer[:, tstep % (npre + npost + 2)] = dotprod
+                _collect_spike_snippets(spikevecs, nseen, pending, ringLFP,
+                                        snippets, spikeinfo, tstep,
+                                        cell.timeres_NEURON, npre, npost,
+                                        nsamples)
+
+            for j, (G, M) in enumerate(vmemcoeffs):
+                vmemresults[j][:, tstep] = np.dot(M, G.dot(vmem))
+            
+            for j, coeffs in enumerate(imemcoeffs):
+                imemresults[j][:, tstep] = coeffs.dot(imem)
             
             tstep += 1
+            
+            if checkpoint_file is not None and neuron.h.t >= tcheckpoint:
+                _save_checkpoint(cells, checkpoint_file, tstep, counter,
+                                 checkpointLFP,
+                                 el_LFP_file if to_file else None, saved)
+                tcheckpoint += checkpoint_interval
         neuron.h.fadvance()
         counter += 1.
         if divmod(counter, interval)[1] == 0:
@@ -244,32 +803,68 @@ def _run_simulation_with_electrode(cell, electrode=None,
             t0 = time()
             ti = neuron.h.t
     
-    try:
-        #calculate LFP after final fadvance()
-        i = 0
-        for sec in cell.allseclist:
-            for seg in sec:
-                imem[i] = seg.i_membrane
-                i += 1
-        #pA/mum2 -> nA conversion
-        imem *= area
+    if not cvode.active():
+        try:
+            #calculate LFP after final fadvance()
+            _get_imem_vi(cells, imemvars, imem, vi)
+            #pA/mum2 -> nA conversion
+            imem *= area
             
-        if to_memory:
-            for j, coeffs in enumerate(dotprodcoeffs):
-                electrodesLFP[j][:, tstep] = np.dot(coeffs, imem)
-        if to_file:
-            for j, coeffs in enumerate(dotprodcoeffs):
-                el_LFP_file['electrode{:03d}'.format(j)
-                            ][:, tstep] = np.dot(coeffs, imem)
+            _stacked_dot(stacks, imem, dotprod)
+            if to_memory:
+                LFPbuffer[:, tstep] = dotprod
+            if to_file:
+                for j, rows in enumerate(slices):
+                    el_LFP_file['electrode{:03d}'.format(j)
+                                ][:, tstep] = dotprod[rows]
+            
+            if spike_window is not None:
+                ringbuffer[:, tstep % (npre + npost + 2)] = dotprod
+                _collect_spike_snippets(spikevecs, nseen, pending, ringLFP,
+                                        snippets, spikeinfo, tstep,
+                                        cell.timeres_NEURON, npre, npost,
+                                        nsamples)
+            
+            for j, (G, M) in enumerate(vmemcoeffs):
+                vmemresults[j][:, tstep] = np.dot(M, G.dot(vmem))
+            
+            for j, coeffs in enumerate(imemcoeffs):
+                imemresults[j][:, tstep] = coeffs.dot(imem)
 
-    except:
-        pass
+        except:
+            pass
+    
+    if len(vmemcoeffs) > 0:
+        for c in cells:
+            c.vmemdotprodresults = vmemresults
+    if len(imemcoeffs) > 0:
+        for c in cells:
+            c.imemdotprodresults = imemresults
+    
+    #snippets of the input dotprodcoeffs and of the electrodes, shape
+    #(number of windows, number of contacts, number of samples of a window)
+    if spike_window is not None:
+        for j, LFPs in enumerate(snippets):
+            snippets[j] = np.array(LFPs).reshape((len(LFPs),
+                                                  ringLFP[j].shape[0],
+                                                  npre + npost + 1))
+        for c, spikevec in zip(cells, spikevecs):
+            c.dotprodresults = snippets[:lendotrodcoeffs0]
+            c.spiketimes = np.array(spikevec)
+            c.snippet_times = np.array([t for t, i in spikeinfo])
+            c.snippet_cells = np.array([i for t, i in spikeinfo], dtype=int)
+            c.snippet_tvec = np.arange(-npre, npost + 1) * \
+                cell.timeres_NEURON
+        if electrodes is not None:
+            for el, LFP in zip(electrodes, snippets[lendotrodcoeffs0:]):
+                el.spike_snippets = LFP
     
     # Final step, put LFPs in the electrode object, superimpose if necessary
     # If electrode.perCellLFP, store individual LFPs
     if to_memory:
         #the first few belong to input dotprodcoeffs
-        cell.dotprodresults = electrodesLFP[:lendotrodcoeffs0]
+        for c in cells:
+            c.dotprodresults = electrodesLFP[:lendotrodcoeffs0]
         #the remaining belong to input electrode arguments
         if electrodes is not None:
             for j, LFP in enumerate(electrodesLFP):
@@ -289,10 +884,137 @@ def _run_simulation_with_electrode(cell, electrode=None,
         el_LFP_file.close()
 
 
+def _run_cvode_with_electrode(cells, memireclist, stacks, slices,
+                              LFPbuffer=None, el_LFP_file=None,
+                              imemcoeffs=[], imemresults=[], nchunk=1000):
+    '''
+    Integrate with variable time steps up to tstopms of the first cell. The
+    membrane currents recorded by NEURON in memireclist every
+    timeres_python are mapped onto the electrodes every nchunk samples with
+    the stacked coefficients of _stack_coeffs, so that the LFPs are on the
+    time axis of cell.tvec. The products with imemcoeffs are put in
+    imemresults.
+    '''
+    cell = cells[0]
+    nsamples = int(cell.tstopms / cell.timeres_python + 1)
+    area = np.concatenate([c._get_imem_factors()
+                           for c in cells])[:, np.newaxis]
+    imem = np.empty((int(memireclist.count()), nchunk))
+    dotprod = np.empty((sum([rows.stop - rows.start
+                             for matrix, rows in stacks]), nchunk))
+    tstep = 0
+    while tstep < nsamples:
+        #the last sample may be recorded by a step beyond tstopms
+        while memireclist.o(0).size() < min(nchunk, nsamples - tstep):
+            neuron.h.fadvance()
+        n = min(int(memireclist.o(0).size()), nchunk, nsamples - tstep)
+        for i, rec in enumerate(memireclist):
+            imem[i, :n] = rec.as_numpy()[:n]
+            rec.remove(0, n - 1)
+        #pA/mum2 -> nA conversion
+        imem[:, :n] *= area
+        
+        _stacked_dot(stacks, imem[:, :n], dotprod[:, :n])
+        if LFPbuffer is not None:
+            LFPbuffer[:, tstep:tstep + n] = dotprod[:, :n]
+        if el_LFP_file is not None:
+            for j, rows in enumerate(slices):
+                el_LFP_file['electrode{:03d}'.format(j)
+                            ][:, tstep:tstep + n] = dotprod[rows, :n]
+        for coeffs, results in zip(imemcoeffs, imemresults):
+            results[:, tstep:tstep + n] = coeffs.dot(imem[:, :n])
+        tstep += n
+        if cell.verbose:
+            print('t = {:.0f}'.format(neuron.h.t))
+
+
+def _stack_coeffs(dotprodcoeffs):
+    '''
+    Stack the coefficient matrices row-wise, the dense and the sparse ones
+    separately, so that their products with the membrane currents take one
+    matrix product per group and time step.
+    
+    Arguments:
+    ::
+        
+        dotprodcoeffs : list of np.ndarray or scipy.sparse matrices
+    
+    Returns:
+    ::
+        
+        stacks : list of tuples (matrix, rows) of the stacked matrices and
+            the slices of their products in the stacked result
+        slices : list of slices of the products of each coefficient matrix
+            in the stacked result
+        nrows : int, number of rows of the stacked result
+    '''
+    slices = [None] * len(dotprodcoeffs)
+    stacks = []
+    nrows = 0
+    for issparse in [False, True]:
+        group = [j for j, coeffs in enumerate(dotprodcoeffs)
+                 if sparse.issparse(coeffs) == issparse]
+        if len(group) == 0:
+            continue
+        start = nrows
+        for j in group:
+            slices[j] = slice(nrows, nrows + dotprodcoeffs[j].shape[0])
+            nrows += dotprodcoeffs[j].shape[0]
+        if issparse:
+            matrix = sparse.vstack([dotprodcoeffs[j] for j in group],
+                                   format='csr')
+        else:
+            matrix = np.ascontiguousarray(
+                np.vstack([dotprodcoeffs[j] for j in group]), dtype=float)
+        stacks.append((matrix, slice(start, nrows)))
+    return stacks, slices, nrows
+
+
+def _stacked_dot(stacks, imem, out):
+    '''Write the products of the stacked coefficient matrices of
+    _stack_coeffs with the membrane currents imem into out'''
+    for matrix, rows in stacks:
+        out[rows] = matrix.dot(imem)
+    return out
+
+
+def _get_electrode_coeffs(cells, electrodes):
+    '''
+    Calculate the coefficient matrices mapping the membrane currents of the
+    cells onto the contacts of each electrode with
+    RecExtElectrode.calc_mapping. The coefficients of several cells are
+    stacked column-wise.
+    
+    Arguments:
+    ::
+        
+        cells : list of LFPy.Cell objects
+        electrodes : list of LFPy.RecExtElectrode objects
+    
+    Returns:
+    ::
+        
+        list of np.ndarray, shape (number of contacts, total number of
+        segments of all cells), one per electrode, scipy.sparse.csr_matrix
+        for electrodes with a cutoff
+    '''
+    cellcoeffs = [[] for el in electrodes]
+    for c in cells:
+        for k, el in enumerate(electrodes):
+            cellcoeffs[k].append(el.calc_mapping(cell=c))
+    return [sparse.hstack(coeffs, format='csr') if sparse.issparse(coeffs[0])
+            else np.hstack(coeffs) for coeffs in cellcoeffs]
+
+
 def _collect_geometry_neuron(cell):
     '''Loop over allseclist to determine area, diam, xyz-start- and
-    endpoints, embed geometry to cell object'''
+    endpoints, embed geometry to cell object.
     
+    The pt3d- and segment info of all sections are fetched from NEURON in
+    a few bulk calls, and the start- and endpoints of all segments are
+    interpolated at once on the concatenated pt3d arrays'''
+    n3d, arc3d, x3d, y3d, z3d, _ = _get_pt3d_vectors(cell.allseclist)
+    nseg, secL, segx, area, diam = _get_segment_vectors(cell.allseclist)
     
     areavec = np.zeros(cell.totnsegs)
     diamvec = np.zeros(cell.totnsegs)
@@ -305,54 +1027,39 @@ def _collect_geometry_neuron(cell):
     zstartvec = np.zeros(cell.totnsegs)
     zendvec = np.zeros(cell.totnsegs)
     
-    counter = 0
-    
-    #loop over all segments
-    for sec in cell.allseclist:
-        n3d = int(neuron.h.n3d())
-        nseg = sec.nseg
-        gsen2 = 1./2/nseg
-        if n3d > 0:
-            #create interpolation objects for the xyz pt3d info:
-            L = np.zeros(n3d)
-            x = np.zeros(n3d)
-            y = np.zeros(n3d)
-            z = np.zeros(n3d)
-            for i in range(n3d):
-                L[i] = neuron.h.arc3d(i)
-                x[i] = neuron.h.x3d(i)
-                y[i] = neuron.h.y3d(i)
-                z[i] = neuron.h.z3d(i)
-            
-            #normalize as seg.x [0, 1]
-            L /= sec.L
-                        
-            #temporary store position of segment midpoints
-            segx = np.zeros(nseg)
-            for i, seg in enumerate(sec):
-                segx[i] = seg.x
-            
-            #can't be >0 which may happen due to NEURON->Python float transfer:
-            segx0 = (segx - gsen2).round(decimals=6)
-            segx1 = (segx + gsen2).round(decimals=6)
-            
-            #fill vectors with interpolated coordinates of start and end points
-            xstartvec[counter:counter+nseg] = np.interp(segx0, L, x)
-            xendvec[counter:counter+nseg] = np.interp(segx1, L, x)
-            
-            ystartvec[counter:counter+nseg] = np.interp(segx0, L, y)
-            yendvec[counter:counter+nseg] = np.interp(segx1, L, y)
-            
-            zstartvec[counter:counter+nseg] = np.interp(segx0, L, z)
-            zendvec[counter:counter+nseg] = np.interp(segx1, L, z)
-                        
-            #fill in values area, diam, length
-            for i, seg in enumerate(sec):
-                areavec[counter] = neuron.h.area(seg.x)
-                diamvec[counter] = seg.diam
-                lengthvec[counter] = sec.L/nseg
-
-                counter += 1
+    #section index of each pt3d point and segment
+    secidx3d = np.repeat(np.arange(n3d.size), n3d)
+    secidx = np.repeat(np.arange(nseg.size), nseg)
+    
+    #normalize as seg.x [0, 1], and offset each section by twice its index
+    #so that the arc lengths of all sections are monotonically increasing
+    #without overlap, allowing one np.interp call per axis
+    L = arc3d / secL[secidx3d] + 2 * secidx3d
+    
+    #only sections with pt3d info are included, as before
+    segmask = (n3d > 0)[secidx]
+    counter = segmask.sum()
+    
+    gsen2 = 1. / 2 / nseg[secidx]
+    #can't be >0 which may happen due to NEURON->Python float transfer:
+    segx0 = (segx - gsen2).round(decimals=6)[segmask] + 2 * secidx[segmask]
+    segx1 = (segx + gsen2).round(decimals=6)[segmask] + 2 * secidx[segmask]
+    
+    #fill vectors with interpolated coordinates of start and end points
+    if L.size > 0:
+        xstartvec[:counter] = np.interp(segx0, L, x3d)
+        xendvec[:counter] = np.interp(segx1, L, x3d)
+        
+        ystartvec[:counter] = np.interp(segx0, L, y3d)
+        yendvec[:counter] = np.interp(segx1, L, y3d)
+        
+        zstartvec[:counter] = np.interp(segx0, L, z3d)
+        zendvec[:counter] = np.interp(segx1, L, z3d)
+    
+    #fill in values area, diam, length
+    areavec[:counter] = area[segmask]
+    diamvec[:counter] = diam[segmask]
+    lengthvec[:counter] = (secL / nseg)[secidx][segmask]
     
     #set cell attributes
     cell.xstart = xstartvec
@@ -367,3 +1074,62 @@ def _collect_geometry_neuron(cell):
     cell.diam = diamvec
     cell.length = lengthvec
 
+
+def _get_pt3d_vectors(seclist):
+    '''Return the number of pt3d points of each section in seclist, and
+    the concatenated arc3d, x3d, y3d, z3d and diam3d values of all
+    sections as np.ndarrays'''
+    n3d = neuron.h.Vector()
+    arc3d = neuron.h.Vector()
+    x3d = neuron.h.Vector()
+    y3d = neuron.h.Vector()
+    z3d = neuron.h.Vector()
+    diam3d = neuron.h.Vector()
+    for sec in seclist:
+        neuron.h.lfpy_get_pt3d(n3d, arc3d, x3d, y3d, z3d, diam3d, sec=sec)
+    
+    return (np.array(n3d).astype(int), np.array(arc3d), np.array(x3d),
+            np.array(y3d), np.array(z3d), np.array(diam3d))
+
+
+def _get_segment_vectors(seclist):
+    '''Return nseg and L of each section in seclist, and x, area and diam
+    of every segment as np.ndarrays'''
+    nseg = neuron.h.Vector()
+    secL = neuron.h.Vector()
+    segx = neuron.h.Vector()
+    area = neuron.h.Vector()
+    diam = neuron.h.Vector()
+    for sec in seclist:
+        neuron.h.lfpy_get_segments(nseg, secL, segx, area, diam, sec=sec)
+    
+    return (np.array(nseg).astype(int), np.array(secL), np.array(segx),
+            np.array(area), np.array(diam))
+
+
+def _set_pt3d_vectors(seclist, x3d, y3d, z3d, diam3d):
+    '''Update the pt3d info of all sections in seclist with the
+    concatenated arrays x3d, y3d, z3d, diam3d using pt3dchange() in NEURON'''
+    x3d = neuron.h.Vector(np.asarray(x3d, dtype=float))
+    y3d = neuron.h.Vector(np.asarray(y3d, dtype=float))
+    z3d = neuron.h.Vector(np.asarray(z3d, dtype=float))
+    diam3d = neuron.h.Vector(np.asarray(diam3d, dtype=float))
+    j = 0
+    for sec in seclist:
+        j = neuron.h.lfpy_set_pt3d(x3d, y3d, z3d, diam3d, j, sec=sec)
+    #let NEURON know about the changes we just did:
+    neuron.h.define_shape()
+
+
+def _add_pt3d_vectors(seclist, n3d, x3d, y3d, z3d, diam3d):
+    '''Replace the pt3d info of all sections in seclist, where section
+    number i is given n3d[i] points from the concatenated arrays
+    x3d, y3d, z3d, diam3d using pt3dadd() in NEURON'''
+    x3d = neuron.h.Vector(np.asarray(x3d, dtype=float))
+    y3d = neuron.h.Vector(np.asarray(y3d, dtype=float))
+    z3d = neuron.h.Vector(np.asarray(z3d, dtype=float))
+    diam3d = neuron.h.Vector(np.asarray(diam3d, dtype=float))
+    j = 0
+    for sec, n in zip(seclist, n3d):
+        neuron.h.lfpy_add_pt3d(x3d, y3d, z3d, diam3d, j, j + int(n), sec=sec)
+        j += int(n)
@@ -18,7 +18,6 @@ import neuron
 import numpy as np
 import pickle
 from LFPy import Cell, RecExtElectrode
-from LFPy.run_simulation import _run_simulation, _run_simulation_with_electrode
 import sys
 
 class TemplateCell(Cell):
@@ -229,21 +228,3 @@ class TemplateCell(Cell):
                 if sec.name().find('soma') >= 0:
                     self.somalist.append(sec=sec)
                     self.nsomasec += 1
- 
-
-    def _update_pt3d(self):           
-        '''
-        update the locations in neuron.hoc.space using neuron.h.pt3dchange()
-        '''
-        for i, sec in enumerate(self.allseclist):
-            n3d = int(neuron.h.n3d())
-            for n in range(n3d):
-                neuron.h.pt3dchange(n,
-                                self.x3d[i][n],
-                                self.y3d[i][n],
-                                self.z3d[i][n],
-                                self.diam3d[i][n])
-            #let NEURON know about the changes we just did:
-            neuron.h.define_shape()
-        #must recollect the geometry, otherwise we get roundoff errors!
-        self._collect_geometry()
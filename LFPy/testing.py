@@ -3,14 +3,35 @@
 extracellular field potentials'''
 
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+import warnings
 import numpy as np
 from scipy.integrate import quad
 from scipy import real, imag
+import scipy.sparse as sparse
 import LFPy
 import neuron
 from warnings import warn
 
+#swc morphologies of the tests, a soma with one dendrite, and a soma with a
+#branching dendrite and an axon
+ball_and_stick = '''1 1 0 0 0 10 -1
+2 3 0 0 10 2 1
+3 3 0 0 500 1 2
+'''
+ball_and_sticks = '''1 1 0 0 0 10 -1
+2 3 0 0 10 2 1
+3 3 0 0 200 1.5 2
+4 3 50 0 400 1 3
+5 3 -50 0 400 1 3
+6 2 0 0 -10 1 1
+7 2 0 0 -300 0.5 6
+'''
+
 class testLFPy(unittest.TestCase):
     '''
     A set of test functions for each method of calculating the LFP, where the
@@ -470,7 +491,1065 @@ class testLFPy(unittest.TestCase):
         
         self.assertEqual(nidx, hist[0])
         
+    def test_cell_morphology_cache_00(self):
+        '''cached nseg and geometry of stick.hoc'''
+        cachedir = tempfile.mkdtemp()
+        try:
+            cells = [self.stickGeometry(morphology_cache=cache)
+                     for cache in [None, cachedir, cachedir]]
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+        finally:
+            shutil.rmtree(cachedir)
+        
+        for cell in cells[1:]:
+            self.assertEqual(cell.totnsegs, cells[0].totnsegs)
+            for attr in ['xstart', 'zend', 'xmid', 'area', 'diam', 'length']:
+                np.testing.assert_allclose(getattr(cell, attr),
+                                           getattr(cells[0], attr))
+    
+    def test_cell_morphology_cache_01(self):
+        '''cached sections and pt3d info of a swc-file'''
+        cachedir = tempfile.mkdtemp()
+        try:
+            cells = []
+            for cache in [None, cachedir, cachedir]:
+                cell = self.ballAndStickGeometry(ball_and_sticks, pt3d=True,
+                                                 nsegs_method='lambda_f',
+                                                 morphology_cache=cache)
+                cells.append([cell.allsecnames,
+                              np.c_[cell.xstart, cell.ystart, cell.zstart,
+                                    cell.xend, cell.yend, cell.zend,
+                                    cell.area, cell.diam]])
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+        finally:
+            shutil.rmtree(cachedir)
+        
+        for secnames, geometry in cells[1:]:
+            self.assertEqual(secnames, cells[0][0])
+            np.testing.assert_allclose(geometry, cells[0][1], atol=1E-9)
+    
+    def test_read_swc_import3d(self):
+        '''sections from swc-file equal to those of NEURON's Import3d'''
+        tempdir = tempfile.mkdtemp()
+        morphology = os.path.join(tempdir, 'branching_soma.swc')
+        f = open(morphology, 'w')
+        f.write('''# soma with branches, wires and a zero length section
+1 1 0 0 0 5 -1
+2 1 0 3 0 6 1
+3 1 0 6 0 7 2
+4 1 0 9 0 6 3
+5 1 0 12 0 4 4
+6 3 3 6 0 2 3
+7 3 100 6 0 1.5 6
+8 3 150 50 0 1 7
+9 3 150 -50 0 1 7
+10 4 0 15 0 2 5
+11 4 0 300 0 1 10
+12 2 0 -3 0 1 1
+13 2 0 -300 0 0.5 12
+14 3 -3 6 0 1 3
+15 3 -100 6 0 1 14
+16 1 3 12 0 3 5
+17 1 6 14 0 2 16
+18 3 6 24 0 1 17
+19 3 6 50 0 1 18
+20 3 6 50 0 1 19
+21 3 60 50 0 1 20
+22 3 6 60 0 1 19
+''')
+        f.close()
+        try:
+            cells = []
+            cell = LFPy.Cell(morphology=morphology, nsegs_method='lambda_f')
+            cells.append([cell.allsecnames,
+                          np.c_[cell.xstart, cell.ystart, cell.zstart,
+                                cell.xend, cell.yend, cell.zend,
+                                cell.area, cell.diam]])
+            
+            neuron.h('forall delete_section()')
+            Import = neuron.h.Import3d_SWC_read()
+            Import.quiet = 1
+            Import.input(morphology)
+            neuron.h.Import3d_GUI(Import, 0).instantiate(None)
+            cell = LFPy.Cell(morphology=None, delete_sections=False,
+                             nsegs_method='lambda_f')
+            cells.append([cell.allsecnames,
+                          np.c_[cell.xstart, cell.ystart, cell.zstart,
+                                cell.xend, cell.yend, cell.zend,
+                                cell.area, cell.diam]])
+        finally:
+            shutil.rmtree(tempdir)
+        
+        self.assertEqual(cells[0][0], cells[1][0])
+        np.testing.assert_allclose(cells[0][1], cells[1][1], atol=1E-6)
+    
+    def test_cell_simulate_cells(self):
+        '''LFP of coexisting cells simulated together equals sum of LFPs'''
+        cells = []
+        for i in range(2):
+            cell = self.ballAndStickGeometry(nsegs_method='lambda_f',
+                                             delete_sections=i == 0,
+                                             tstopms=10)
+            cell.set_pos(xpos=100 * i)
+            LFPy.StimIntElectrode(cell, idx=0, amp=i + 1., dur=5.,
+                                  delay=1., pptype='IClamp')
+            cells.append(cell)
+        self.assertEqual(len(cells[0].allsecnames), 2)
+        self.assertEqual(len(cells[1].allsecnames), 2)
+        
+        electrodeParams = {
+            'sigma' : 0.3,
+            'x' : np.array([50., 50.]),
+            'y' : np.array([10., 10.]),
+            'z' : np.array([0., 300.]),
+        }
+        LFPs = []
+        for cell in cells:
+            electrode = LFPy.RecExtElectrode(**electrodeParams)
+            cell.simulate(electrode=electrode, rec_imem=True)
+            LFPs.append(electrode.LFP)
+        somavs = [cell.somav for cell in cells]
+        imems = [cell.imem for cell in cells]
+        
+        electrode = LFPy.RecExtElectrode(**electrodeParams)
+        cells[0].simulate(electrode=electrode, rec_imem=True, cells=cells[1:],
+                          rec_current_dipole_moment=True)
+        np.testing.assert_allclose(electrode.LFP, LFPs[0] + LFPs[1])
+        for cell, somav, imem in zip(cells, somavs, imems):
+            np.testing.assert_allclose(cell.somav, somav)
+            np.testing.assert_allclose(cell.imem, imem)
+            P = np.dot(np.array([cell.xmid, cell.ymid, cell.zmid]), imem)
+            np.testing.assert_allclose(cell.current_dipole_moment, P,
+                                       atol=abs(P).max() * 1E-10)
+    
+    def test_cell_hoc_replaces_sections(self):
+        '''a .hoc morphology replacing the sections of another cell raises
+        an Exception'''
+        morphology = os.path.join(LFPy.__path__[0], 'stick.hoc')
+        cell = LFPy.Cell(morphology=morphology)
+        self.assertRaises(Exception, LFPy.Cell, morphology=morphology,
+                          delete_sections=False)
+    
+    def test_cell_run_trial(self):
+        '''repeated trials of one cell equal simulations of new cells'''
+        electrodeParams = {
+            'sigma' : 0.3,
+            'x' : np.array([100., 100.]),
+            'y' : np.zeros(2),
+            'z' : np.array([0., 500.]),
+        }
+        synapseParams = {
+            'idx' : 0,
+            'syntype' : 'ExpSyn',
+            'weight' : 0.01,
+            'record_current' : True,
+        }
+        spike_times = [[np.array([10., 40.])], [np.array([20.])]]
+        cell = self.ballAndStickGeometry(nsegs_method='lambda_f', tstopms=50)
+        synapse = LFPy.Synapse(cell, **synapseParams)
+        electrode = LFPy.RecExtElectrode(**electrodeParams)
+        trials = []
+        for sptimes in spike_times:
+            cell.run_trial(spike_times=sptimes, electrode=electrode,
+                           rec_isyn=True)
+            trials.append([electrode.LFP, cell.somav, synapse.i,
+                           cell._trial_coeffs])
+        self.assertTrue(trials[0][3] is trials[1][3])
+        
+        for sptimes, trial in zip(spike_times, trials):
+            cell = self.ballAndStickGeometry(delete_sections=False,
+                                             nsegs_method='lambda_f',
+                                             tstopms=50)
+            synapse = LFPy.Synapse(cell, **synapseParams)
+            synapse.set_spike_times(sptimes[0])
+            electrode = LFPy.RecExtElectrode(**electrodeParams)
+            cell.simulate(electrode=electrode, rec_isyn=True)
+            np.testing.assert_allclose(trial[0], electrode.LFP, atol=1E-12)
+            np.testing.assert_allclose(trial[1], cell.somav)
+            np.testing.assert_allclose(trial[2], synapse.i)
+    
+    def test_cell_delete_sections_synapses(self):
+        '''deleting the sections of an unreferenced cell with synapses does
+        not crash NEURON in the next simulation'''
+        #the cell and synapse of create() form a reference cycle, which is
+        #only freed by the garbage collector. NEURON crashes in a new
+        #process if this happens after the sections are deleted
+        script = '''
+import gc
+import sys
+import numpy as np
+import LFPy
+gc.disable()
+def create():
+    cell = LFPy.Cell(morphology=sys.argv[1], tstopms=20)
+    synapse = LFPy.Synapse(cell, idx=cell.totnsegs - 1, syntype='ExpSyn',
+                           weight=0.01, tau=2.)
+    synapse.set_spike_times(np.array([5.]))
+create()
+cell = LFPy.Cell(morphology=sys.argv[1], tstopms=20)
+cell.simulate()
+'''
+        tempdir = tempfile.mkdtemp()
+        try:
+            morphology = self.writeMorphology(tempdir)
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(
+                [os.path.dirname(LFPy.__path__[0])] + sys.path)
+            devnull = open(os.devnull, 'w')
+            try:
+                returncode = subprocess.call(
+                    [sys.executable, '-c', script, morphology], env=env,
+                    cwd=tempdir, stdout=devnull, stderr=devnull)
+            finally:
+                devnull.close()
+            self.assertEqual(returncode, 0)
+        finally:
+            shutil.rmtree(tempdir)
+    
+    def test_cell_simulate_warmup_cache(self):
+        '''simulations with saved and restored state at t = 0'''
+        cachedir = tempfile.mkdtemp()
+        try:
+            results = []
+            for cache in [None, cachedir, cachedir]:
+                cell = self.stickGeometry(tstartms=-100, tstopms=50,
+                                          v_init=-65, e_pas=-70)
+                LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=10.,
+                                      delay=10., pptype='IClamp')
+                electrode = LFPy.RecExtElectrode(sigma=0.3,
+                                                 x=np.array([100.]),
+                                                 y=np.zeros(1),
+                                                 z=np.array([0.]))
+                cell.simulate(electrode=electrode, rec_vmem=True,
+                              warmup_cache=cache)
+                results.append([electrode.LFP, cell.somav, cell.vmem])
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+        finally:
+            shutil.rmtree(cachedir)
+        
+        for result in results[1:]:
+            for x, y in zip(result, results[0]):
+                np.testing.assert_allclose(x, y, rtol=1E-6, atol=1E-12)
+    
+    def test_cell_simulate_resume_from(self):
+        '''simulation resumed from the last checkpoint of a simulation, with
+        the LFP in memory and in file'''
+        tempdir = tempfile.mkdtemp()
+        checkpoint_file = os.path.join(tempdir, 'checkpoint.npz')
+        file_name = os.path.join(tempdir, 'LFP.h5')
+        run_simulation = LFPy.backends.get_module('run_simulation')
+        try:
+            for to_file in [False, True]:
+                results = []
+                for kwargs in [dict(checkpoint_file=checkpoint_file,
+                                    checkpoint_interval=30.),
+                               dict(resume_from=checkpoint_file)]:
+                    cell = self.stickGeometry(tstartms=-10, tstopms=100)
+                    LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=50.,
+                                          delay=40., pptype='IClamp',
+                                          record_current=True)
+                    electrode = LFPy.RecExtElectrode(sigma=0.3,
+                                                     x=np.array([100.]),
+                                                     y=np.zeros(1),
+                                                     z=np.array([0.]))
+                    cell.simulate(electrode=electrode, rec_imem=True,
+                                  rec_istim=True, to_file=to_file,
+                                  file_name=file_name, **kwargs)
+                    results.append([electrode.LFP, cell.somav, cell.imem,
+                                    cell.pointprocesses[0].i])
+                
+                for x, y in zip(results[0], results[1]):
+                    np.testing.assert_equal(x, y)
+                #LFPs written to file are restored from there
+                self.assertEqual(os.path.isfile(checkpoint_file + '.lfp'),
+                                 not to_file)
+                os.remove(checkpoint_file + '.rec')
+                if not to_file:
+                    os.remove(checkpoint_file + '.lfp')
+            
+            #checkpoints append the samples since the previous checkpoint
+            a = np.random.rand(2, 10)
+            b = np.random.rand(1, 10)
+            samples_file = os.path.join(tempdir, 'samples')
+            for start, stop in [(0, 4), (4, 7), (6, 7)]:
+                self.assertEqual(run_simulation._append_samples(
+                    samples_file, [a, b], start, stop), stop)
+                self.assertEqual(os.path.getsize(samples_file),
+                                 3 * stop * 8)
+            np.testing.assert_equal(
+                run_simulation._read_samples(samples_file, 3, 7),
+                np.r_[a, b][:, :7])
+        finally:
+            shutil.rmtree(tempdir)
+    
+    def test_cell_simulate_iter(self):
+        '''chunks of simulate_iter equal results of simulate'''
+        results = []
+        for i in range(2):
+            cell = self.stickGeometry(tstopms=100)
+            LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=50., delay=20.,
+                                  pptype='IClamp')
+            electrode = LFPy.RecExtElectrode(sigma=0.3,
+                                             x=np.array([100., 50.]),
+                                             y=np.zeros(2),
+                                             z=np.array([0., 200.]))
+            if i == 0:
+                cell.simulate(electrode=electrode, rec_imem=True,
+                              rec_vmem=True)
+                results.append([cell.tvec, electrode.LFP, cell.imem,
+                                cell.vmem, cell.imem])
+            else:
+                #sparse dotprodcoeffs, the identity gives the currents
+                identity = sparse.identity(cell.totnsegs, format='csr')
+                chunks = [[chunk['tvec'].copy(), chunk['LFP'].copy(),
+                           chunk['imem'].copy(), chunk['vmem'].copy(),
+                           chunk['dotprodresults'][0].copy()]
+                          for chunk in cell.simulate_iter(chunk_ms=30,
+                                electrode=electrode, rec_imem=True,
+                                rec_vmem=True, dotprodcoeffs=[identity])]
+                self.assertEqual(len(chunks), 4)
+                results.append([np.concatenate(x, axis=-1)
+                                for x in zip(*chunks)])
+        
+        for x, y in zip(results[0], results[1]):
+            np.testing.assert_allclose(x, y, atol=1E-12)
+        
+        #the soma potential of the last chunk is kept in cell.somav
+        cell = self.stickGeometry(tstopms=100)
+        LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=50., delay=20.,
+                              pptype='IClamp')
+        cell.simulate()
+        somav = cell.somav
+        for chunk in cell.simulate_iter(chunk_ms=30):
+            pass
+        np.testing.assert_allclose(cell.somav, somav[-chunk['tvec'].size:])
+    
+    def test_cell_simulate_variable_dt(self):
+        '''LFP with variable timesteps is on the time axis of tvec'''
+        LFPs = []
+        for variable_dt in [False, True]:
+            cell = self.stickGeometry(tstopms=100, timeres_NEURON=2**-4,
+                                      timeres_python=2**-4)
+            LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=50., delay=20.,
+                                  pptype='IClamp')
+            electrode = LFPy.RecExtElectrode(sigma=0.3,
+                                             x=np.array([100., 50.]),
+                                             y=np.zeros(2),
+                                             z=np.array([0., 200.]))
+            cell.simulate(electrode=electrode, rec_imem=True,
+                          variable_dt=variable_dt, atol=1E-6)
+            self.assertEqual(electrode.LFP.shape, (2, cell.tvec.size))
+            LFPs.append(electrode.LFP)
+        
+        #same membrane currents as recorded in cell.imem
+        electrode.calc_lfp(cell=cell)
+        np.testing.assert_allclose(LFPs[1], electrode.LFP, atol=1E-12)
+        #solutions differ around the onset and offset of the current step
+        mask = (abs(cell.tvec - 20.) > 1.) & (abs(cell.tvec - 70.) > 1.)
+        np.testing.assert_allclose(LFPs[0][:, mask], LFPs[1][:, mask],
+                                   atol=abs(LFPs[0]).max() * 1E-2)
+    
+    def test_cell_simulate_fast_imem(self):
+        '''LFP from i_membrane_ equals LFP of the extracellular mechanism'''
+        LFPs = []
+        for extracellular in [True, False]:
+            cell = self.stickGeometry(tstopms=100, extracellular=extracellular)
+            LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=50., delay=20.,
+                                  pptype='IClamp')
+            electrode = LFPy.RecExtElectrode(sigma=0.3,
+                                             x=np.array([100., 50.]),
+                                             y=np.zeros(2),
+                                             z=np.array([0., 200.]))
+            cell.simulate(electrode=electrode, rec_imem=True)
+            LFPs.append(electrode.LFP)
+            np.testing.assert_allclose(electrode.LFP,
+                                       np.dot(electrode.electrodecoeff,
+                                              cell.imem), atol=1E-12)
+        
+        np.testing.assert_allclose(LFPs[0], LFPs[1],
+                                   atol=abs(LFPs[0]).max() * 1E-6)
+        self.assertRaises(ValueError, cell.simulate, rec_imem=True,
+                          threads=2)
+        self.assertEqual(neuron.h.ParallelContext().nthread(), 1)
+        self.assertFalse(neuron.h.CVode().use_fast_imem())
+    
+    def test_cell_simulate_threads(self):
+        '''somav and LFP with two threads equal those with one thread, and
+        the NEURON settings are restored after the simulations'''
+        #NEURON allows one thread only once the extracellular mechanism has
+        #been used by other tests, the simulations are run in a new process
+        script = '''
+import sys
+import os
+import numpy as np
+import neuron
+import LFPy
+results = {}
+for threads in [1, 2]:
+    cell = LFPy.Cell(morphology=os.path.join(LFPy.__path__[0], 'stick.hoc'),
+                     nsegs_method='lambda_f', tstopms=100,
+                     extracellular=False)
+    LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=50., delay=20.,
+                          pptype='IClamp')
+    electrode = LFPy.RecExtElectrode(sigma=0.3, x=np.array([100., 50.]),
+                                     y=np.zeros(2), z=np.array([0., 200.]))
+    cell.simulate(electrode=electrode, threads=threads)
+    results['somav%i' % threads] = cell.somav
+    results['LFP%i' % threads] = electrode.LFP
+    results['nthread%i' % threads] = neuron.h.ParallelContext().nthread()
+    results['fast_imem%i' % threads] = neuron.h.CVode().use_fast_imem()
+np.savez(sys.argv[1], **results)
+'''
+        tempdir = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(
+                [os.path.dirname(LFPy.__path__[0])] + sys.path)
+            results = os.path.join(tempdir, 'results.npz')
+            subprocess.check_call([sys.executable, '-c', script, results],
+                                  env=env, cwd=tempdir)
+            with np.load(results) as f:
+                np.testing.assert_allclose(f['somav2'], f['somav1'],
+                                           atol=1E-9)
+                np.testing.assert_allclose(f['LFP2'], f['LFP1'],
+                                           atol=abs(f['LFP1']).max() * 1E-9)
+                for threads in [1, 2]:
+                    self.assertEqual(f['nthread%i' % threads], 1)
+                    self.assertFalse(f['fast_imem%i' % threads])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_cell_simulate_current_dipole_moment(self):
+        '''current dipole moment equals sum of imem times midpoints'''
+        cell = self.stickGeometry(tstopms=100)
+        LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=50., delay=20.,
+                              pptype='IClamp')
+        cell.simulate(rec_imem=True, rec_current_dipole_moment=True)
+        self.assertEqual(cell.current_dipole_moment.shape,
+                         (3, cell.tvec.size))
+        self.assertEqual(cell.dotprodresults, [])
+        P = np.dot(np.array([cell.xmid, cell.ymid, cell.zmid]), cell.imem)
+        np.testing.assert_allclose(cell.current_dipole_moment, P,
+                                   atol=abs(P).max() * 1E-12)
+        
+        #one block diagonal sparse matrix for all cells
+        coeffs = cell._get_current_dipole_coeffs([cell, cell])
+        self.assertTrue(sparse.isspmatrix_csr(coeffs))
+        self.assertEqual(coeffs.shape, (6, 2 * cell.totnsegs))
+        self.assertTrue(coeffs.nnz <= 6 * cell.totnsegs)
+        imem = np.r_[cell.imem, 2 * cell.imem]
+        np.testing.assert_allclose(coeffs.dot(imem), np.r_[P, 2 * P],
+                                   atol=abs(P).max() * 1E-12)
+        
+        #independent of to_memory, after a simulation and on a new cell
+        for i in range(2):
+            if i == 1:
+                cell = self.stickGeometry(tstopms=100)
+                LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=50.,
+                                      delay=20., pptype='IClamp')
+            electrode = LFPy.RecExtElectrode(sigma=0.3, x=np.array([100.]),
+                                             y=np.zeros(1), z=np.zeros(1))
+            cell.simulate(electrode=electrode, to_memory=False,
+                          rec_current_dipole_moment=True)
+            np.testing.assert_allclose(cell.current_dipole_moment, P,
+                                       atol=abs(P).max() * 1E-12)
+    
+    def test_cell_axial_currents(self):
+        '''axial currents of a branched cell conserve the membrane currents
+        at the center of each segment'''
+        cell = self.ballAndStickGeometry(ball_and_sticks,
+                                         nsegs_method='lambda_f',
+                                         lambda_f=1000, tstopms=20,
+                                         extracellular=True)
+        synapse = LFPy.Synapse(cell, idx=cell.totnsegs - 1, syntype='ExpSyn',
+                               weight=0.01, tau=2.)
+        synapse.set_spike_times(np.array([5.]))
+        cell.simulate(rec_imem=True, rec_vmem=True)
+        G, rstart, rend = cell.get_axial_current_coeffs()
+        self.assertEqual(G.shape, (2 * cell.totnsegs, cell.totnsegs))
+        iaxial = G.dot(cell.vmem)
+
+        #the first segments of child sections draw current from the center
+        #of the parent segment they are connected to
+        firstidx = {}
+        i = 0
+        for sec in cell.allseclist:
+            firstidx[sec.name()] = i
+            i += sec.nseg
+        ichildren = np.zeros(cell.imem.shape)
+        for sec in cell.allseclist:
+            sref = neuron.h.SectionRef(sec=sec)
+            if sref.has_parent():
+                x = neuron.h.parent_connection(sec=sec)
+                parent = sref.parent
+                if 0 < x < 1:
+                    idx = firstidx[parent.name()] + int(x * parent.nseg)
+                    ichildren[idx] += iaxial[2 * firstidx[sec.name()]]
+        imem = iaxial[0::2] - iaxial[1::2] - ichildren
+        np.testing.assert_allclose(imem, cell.imem,
+                                   atol=abs(cell.imem).max() * 1E-6)
+        np.testing.assert_allclose(rstart[1::2], rend[0::2])
+    
+    def test_cell_simulate_magnetic_field(self):
+        '''magnetic field on every time step equals Biot-Savart field of the
+        axial currents, and that of a long wire'''
+        B = LFPy.eegmegcalc.get_biot_savart_coeffs([[0., 0., -1E7]],
+                                                   [[0., 0., 1E7]],
+                                                   [[10., 0., 0.]])
+        #mu0 I / (2 pi r) of 1 nA at 10 mum is 0.02 nT along y
+        np.testing.assert_allclose(B.flatten(), [0., 0.02, 0.], atol=1E-6)
+
+        cell = self.stickGeometry(tstopms=50, extracellular=False)
+        LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=20., delay=10.,
+                              pptype='IClamp')
+        r_sensors = np.array([[100., 0., 500.], [0., 0., 2000.],
+                              [-50., 200., 0.]])
+        cell.simulate(rec_vmem=True, rec_magnetic_field=r_sensors)
+        self.assertEqual(cell.magnetic_field.shape, (3, 3, cell.tvec.size))
+        G, rstart, rend = cell.get_axial_current_coeffs()
+        M = LFPy.eegmegcalc.get_biot_savart_coeffs(rstart, rend, r_sensors)
+        B = np.array([np.dot(M, G.dot(v)) for v in cell.vmem.T]).T
+        np.testing.assert_allclose(cell.magnetic_field.reshape(9, -1), B,
+                                   atol=abs(B).max() * 1E-9)
+        #no field along the axis of the stick
+        np.testing.assert_allclose(cell.magnetic_field[1], 0.,
+                                   atol=abs(B).max() * 1E-9)
+
+        #with the extracellular mechanism, from the intracellular potentials
+        cell = self.stickGeometry(tstopms=50, extracellular=True)
+        t_ext = np.arange(cell.tstopms / cell.timeres_NEURON + 1) * \
+            cell.timeres_NEURON
+        v_ext = np.outer(cell.zmid / 100., np.sin(2 * np.pi * t_ext / 20.))
+        cell.insert_v_ext(v_ext, t_ext)
+        vextrecs = []
+        for sec in cell.allseclist:
+            for seg in sec:
+                vextrecs.append(neuron.h.Vector())
+                vextrecs[-1].record(seg._ref_vext[0], cell.timeres_python)
+        cell.simulate(rec_vmem=True, rec_magnetic_field=r_sensors)
+        vext = np.array(vextrecs)
+        self.assertTrue(abs(vext).max() > 0.1)
+        vi = cell.vmem + vext
+        B = np.array([np.dot(M, G.dot(v)) for v in vi.T]).T
+        np.testing.assert_allclose(cell.magnetic_field.reshape(9, -1), B,
+                                   atol=abs(B).max() * 1E-9)
+
+    def test_cell_simulate_spike_window(self):
+        '''LFPs in windows around somatic spikes equal those of the full
+        LFP'''
+        cell = self.ballAndStickGeometry(ball_and_sticks,
+                                         nsegs_method='lambda_f',
+                                         tstopms=100, extracellular=False)
+        for sec in cell.allseclist:
+            sec.insert('hh')
+        LFPy.StimIntElectrode(cell, idx=0, amp=1., dur=90., delay=5.,
+                              pptype='IClamp')
+        electrodeParams = {
+            'sigma' : 0.3,
+            'x' : np.array([50., 30.]),
+            'y' : np.zeros(2),
+            'z' : np.array([0., 100.]),
+        }
+        electrode = LFPy.RecExtElectrode(**electrodeParams)
+        cell.simulate(electrode=electrode)
+        LFP = electrode.LFP
+
+        electrode = LFPy.RecExtElectrode(**electrodeParams)
+        self.assertRaises(ValueError, cell.simulate, electrode=electrode,
+                          spike_window=(1., 4.))
+        #a NetCon of the user watching the soma keeps its threshold, which
+        #is shared with the spike detector
+        for sec in cell.somalist:
+            netcon = neuron.h.NetCon(sec(0.5)._ref_v, None, sec=sec)
+            netcon.threshold = -20.
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            cell.simulate(electrode=electrode, to_memory=False,
+                          spike_window=(1., 4.), spike_threshold=0.)
+        self.assertEqual(netcon.threshold, -20.)
+        self.assertTrue(any('threshold' in str(x.message) for x in w))
+        self.assertFalse(hasattr(electrode, 'LFP'))
+        self.assertTrue(cell.snippet_times.size > 1)
+        self.assertEqual(electrode.spike_snippets.shape,
+                         (cell.snippet_times.size, 2, cell.snippet_tvec.size))
+        for snippet, tspike in zip(electrode.spike_snippets,
+                                   cell.snippet_times):
+            idx = np.round((tspike + cell.snippet_tvec) /
+                           cell.timeres_NEURON).astype(int)
+            np.testing.assert_allclose(snippet, LFP[:, idx])
+
+    def test_recextelectrode_calc_mapping(self):
+        '''mapping matrix times membrane currents equals calc_lfp, with one
+        and several threads'''
+        cell = self.stickGeometry()
+        cell.imem = np.random.randn(cell.totnsegs, 10)
+        x = np.linspace(0., 50., 17)
+        y = np.zeros(17)
+        z = np.linspace(-100., 1100., 17)
+        for method in ['linesource', 'som_as_point', 'pointsource']:
+            electrode = LFPy.RecExtElectrode(cell, x=x, y=y, z=z,
+                                             method=method)
+            electrode.calc_lfp()
+            for n_threads in [1, 3]:
+                electrode.n_threads = n_threads
+                mapping = electrode.calc_mapping()
+                self.assertEqual(mapping.shape, (17, cell.totnsegs))
+                np.testing.assert_allclose(np.dot(mapping, cell.imem),
+                                           electrode.LFP, rtol=1E-10,
+                                           atol=1E-12)
+
+    def test_recextelectrode_calc_lfp_blocks(self):
+        '''LFP of memory-mapped membrane currents in blocks of time steps,
+        written into a memory-mapped array, equals calc_lfp'''
+        cell = self.stickGeometry()
+        cell.imem = np.random.randn(cell.totnsegs, 25)
+        x = np.linspace(0., 50., 5)
+        y = np.zeros(5)
+        z = np.linspace(-100., 1100., 5)
+        electrode = LFPy.RecExtElectrode(cell, x=x, y=y, z=z)
+        electrode.calc_lfp()
+        LFP = electrode.LFP
+        t_indices = np.arange(2, 25, 3)
+        electrode.calc_lfp(t_indices=t_indices)
+        LFP_indices = electrode.LFP
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            imem = np.memmap(os.path.join(tempdir, 'imem.dat'),
+                             dtype=float, mode='w+', shape=cell.imem.shape)
+            imem[:] = cell.imem
+            cell.imem = imem
+            for n_threads in [1, 3]:
+                electrode.n_threads = n_threads
+                out = np.memmap(os.path.join(tempdir, 'LFP.dat'),
+                                dtype=float, mode='w+', shape=LFP.shape)
+                electrode.calc_lfp(block_size=4, out=out)
+                self.assertTrue(electrode.LFP is out)
+                np.testing.assert_allclose(out, LFP, rtol=1E-10, atol=1E-12)
+                electrode.calc_lfp(t_indices=t_indices, block_size=4)
+                np.testing.assert_allclose(electrode.LFP, LFP_indices,
+                                           rtol=1E-10, atol=1E-12)
+            self.assertRaises(ValueError, electrode.calc_lfp,
+                              out=np.empty((5, 24)))
+            del imem, out
+            cell.imem = np.array(cell.imem)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_recextelectrode_calc_lfp_lazy(self):
+        '''indexing a lazy LFP equals indexing the LFP of calc_lfp, with and
+        without cache'''
+        cell = self.stickGeometry()
+        cell.imem = np.random.randn(cell.totnsegs, 25)
+        x = np.linspace(0., 50., 5)
+        y = np.zeros(5)
+        z = np.linspace(-100., 1100., 5)
+        electrode = LFPy.RecExtElectrode(cell, x=x, y=y, z=z)
+        electrode.calc_lfp()
+        LFP = electrode.LFP
+        for cache_size in [0, 4]:
+            lazy = electrode.calc_lfp(lazy=True, block_size=4,
+                                      cache_size=cache_size)
+            self.assertTrue(isinstance(lazy, LFPy.LazyLFP))
+            self.assertEqual(lazy.shape, LFP.shape)
+            for key in [(1, 3), (slice(1, 3), slice(5, 15)), 2,
+                        (np.array([4, 0]), slice(None, None, -3)),
+                        (slice(None), 24), (slice(1, 4), [3, 17, 9])]:
+                np.testing.assert_allclose(lazy[key], LFP[key], rtol=1E-10,
+                                           atol=1E-12)
+            np.testing.assert_allclose(np.asarray(lazy), LFP, rtol=1E-10,
+                                       atol=1E-12)
+            self.assertTrue(len(lazy._cache) <= cache_size)
+        lazy = electrode.calc_lfp(t_indices=np.arange(2, 25, 3), lazy=True)
+        np.testing.assert_allclose(lazy[:, 1:6], LFP[:, 5:20:3],
+                                   rtol=1E-10, atol=1E-12)
+
+    def test_recextelectrode_clamped_segments(self):
+        '''segments closer than r_limit to a contact are reported per
+        contact by calc_lfp and calc_mapping with all backends'''
+        cell = self.stickGeometry()
+        cell.imem = np.random.randn(cell.totnsegs, 10)
+        x = np.array([0.5, 0.5, 100.])
+        y = np.zeros(3)
+        z = np.array([cell.zmid[0], cell.zmid[5], 500.])
+        backend = LFPy.get_backend()
+        try:
+            for name in LFPy.available_backends():
+                LFPy.set_backend(name)
+                for method in ['linesource', 'som_as_point', 'pointsource']:
+                    electrode = LFPy.RecExtElectrode(cell, x=x, y=y, z=z,
+                                                     method=method)
+                    electrode.calc_lfp()
+                    for clamped, expected in zip(electrode.clamped_segments,
+                                                 [[0], [5], []]):
+                        np.testing.assert_equal(clamped, expected)
+                    mapping = electrode.calc_mapping()
+                    for clamped, expected in zip(electrode.clamped_segments,
+                                                 [[0], [5], []]):
+                        np.testing.assert_equal(clamped, expected)
+                    np.testing.assert_allclose(np.dot(mapping, cell.imem),
+                                               electrode.LFP, rtol=1E-10)
+        finally:
+            LFPy.set_backend(backend)
+
+    def test_recextelectrode_sparse_mapping(self):
+        '''the sparse mapping keeps the exact coefficients of the segments
+        within cutoff, and the LFP is within the error bound of the dense
+        one, with all backends'''
+        cell = self.stickGeometry()
+        cell.imem = np.random.randn(cell.totnsegs, 10)
+        x = np.linspace(0., 50., 17)
+        y = np.zeros(17)
+        z = np.linspace(-500., 1500., 17)
+        backend = LFPy.get_backend()
+        try:
+            for name in LFPy.available_backends():
+                LFPy.set_backend(name)
+                for method in ['linesource', 'som_as_point', 'pointsource']:
+                    electrode = LFPy.RecExtElectrode(cell, x=x, y=y, z=z,
+                                                     method=method)
+                    dense = electrode.calc_mapping()
+                    electrode.calc_lfp()
+                    LFP = electrode.LFP
+                    electrode.cutoff = 200.
+                    electrode.n_threads = 2
+                    mapping = electrode.calc_mapping()
+                    self.assertTrue(sparse.isspmatrix_csr(mapping))
+                    self.assertTrue(mapping.nnz < dense.size)
+                    rows, cols = mapping.nonzero()
+                    np.testing.assert_allclose(mapping.data,
+                                               dense[rows, cols], rtol=1E-10)
+                    electrode.calc_lfp()
+                    self.assertTrue(np.all(abs(electrode.LFP - LFP).max(axis=1)
+                                    <= electrode.LFP_error_bound + 1E-12))
+                    self.assertTrue(np.all(electrode.LFP_error_bound[[0, 16]]
+                                           > 0))
+                    electrode.cutoff = 1E6
+                    np.testing.assert_allclose(electrode.calc_mapping().toarray(),
+                                               dense, rtol=1E-10)
+                    self.assertTrue(np.all(electrode.mapping_error_bound == 0))
+        finally:
+            LFPy.set_backend(backend)
+
+    def test_cell_simulate_sparse_mapping(self):
+        '''simulations with an electrode with a cutoff use its sparse
+        mapping'''
+        cell = self.stickGeometry(tstopms=20, extracellular=False)
+        LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=10., delay=5.,
+                              pptype='IClamp')
+        electrode = LFPy.RecExtElectrode(sigma=0.3, x=np.array([10., 10.]),
+                                         y=np.zeros(2),
+                                         z=np.array([0., 1500.]),
+                                         cutoff=300.)
+        cell.simulate(electrode=electrode, rec_imem=True)
+        self.assertTrue(sparse.isspmatrix_csr(electrode.electrodecoeff))
+        self.assertEqual(electrode.electrodecoeff[1].nnz, 0)
+        np.testing.assert_allclose(electrode.LFP,
+                                   electrode.electrodecoeff.dot(cell.imem),
+                                   rtol=1E-10, atol=1E-12)
+
+    def test_cell_simulate_stacked_coeffs(self):
+        '''the LFPs of dense and sparse coefficient matrices and electrodes
+        calculated together are row views of one buffer'''
+        cell = self.stickGeometry(tstopms=20, extracellular=False)
+        LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=10., delay=5.,
+                              pptype='IClamp')
+        dense = LFPy.RecExtElectrode(sigma=0.3, x=np.zeros(3) + 10.,
+                                     y=np.zeros(3), z=np.array([0., 500.,
+                                                                1000.]))
+        cutoff = LFPy.RecExtElectrode(sigma=0.3, x=np.array([10., 10.]),
+                                      y=np.zeros(2),
+                                      z=np.array([0., 1500.]), cutoff=300.)
+        coeffs = [np.random.randn(4, cell.totnsegs),
+                  sparse.random(2, cell.totnsegs, density=0.5, format='csr')]
+        cell.simulate(electrode=[dense, cutoff], dotprodcoeffs=coeffs,
+                      rec_imem=True)
+        for c, LFP in zip(coeffs + [dense.electrodecoeff,
+                                    cutoff.electrodecoeff],
+                          cell.dotprodresults + [dense.LFP, cutoff.LFP]):
+            np.testing.assert_allclose(LFP, c.dot(cell.imem), rtol=1E-10,
+                                       atol=1E-12)
+            self.assertTrue(LFP.base is dense.LFP.base)
+
+    def test_backends_set_backend(self):
+        '''backend selection and report'''
+        backend = LFPy.get_backend()
+        self.assertTrue('numpy' in LFPy.available_backends())
+        self.assertTrue(backend in LFPy.available_backends())
+        try:
+            LFPy.set_backend('numpy')
+            self.assertEqual(LFPy.get_backend(), 'numpy')
+            self.assertTrue(LFPy.backends.get_module('lfpcalc') is
+                            LFPy.lfpcalc)
+            self.assertRaises(ValueError, LFPy.set_backend, 'fortran')
+            self.assertEqual(LFPy.get_backend(), 'numpy')
+        finally:
+            LFPy.set_backend(backend)
+
+    def test_backends_lfpcalc_parity(self):
+        '''lfpcalc and alias_method of all available backends agree with the
+        numpy backend'''
+        cell = self.stickGeometry()
+        cell.imem = np.random.randn(cell.totnsegs, 10)
+        area = cell.area / cell.area.sum()
+        for backend in LFPy.available_backends():
+            lfpcalc = LFPy.backends.get_module('lfpcalc', backend)
+            for method in ['linesource', 'som_as_point', 'pointsource']:
+                for x, z in [(10., 0.), (0., 1200.), (1., 500.)]:
+                    kwargs = dict(x=x, y=0., z=z, sigma=0.3,
+                                  r_limit=cell.diam / 2)
+                    np.testing.assert_allclose(
+                        getattr(lfpcalc, 'calc_lfp_' + method)(cell,
+                                                               **kwargs),
+                        getattr(LFPy.lfpcalc, 'calc_lfp_' + method)(cell,
+                                                                    **kwargs),
+                        rtol=1E-10)
+                np.testing.assert_allclose(
+                    lfpcalc.calc_mapping(cell, x=[10., 0., 1.],
+                                         y=[0., 0., 0.],
+                                         z=[0., 1200., 500.], sigma=0.3,
+                                         r_limit=cell.diam / 2,
+                                         method=method, n_threads=2),
+                    LFPy.lfpcalc.calc_mapping(cell, x=[10., 0., 1.],
+                                              y=[0., 0., 0.],
+                                              z=[0., 1200., 500.], sigma=0.3,
+                                              r_limit=cell.diam / 2,
+                                              method=method),
+                    rtol=1E-10)
+            alias_method = LFPy.backends.get_module('alias_method', backend)
+            np.random.seed(1234)
+            idx = alias_method.alias_method(np.arange(cell.totnsegs), area,
+                                            100)
+            np.random.seed(1234)
+            np.testing.assert_equal(idx, LFPy.alias_method.alias_method(
+                np.arange(cell.totnsegs), area, 100))
+
+    def test_backends_h_calc(self):
+        '''projections of the contacts onto the segments of _h_calc of all
+        available backends equal the diagonal of the dense product'''
+        cell = self.stickGeometry()
+        cell.set_rotation(x=0.3, y=0.5)
+        deltaS = LFPy.lfpcalc._deltaS_calc(cell.xstart, cell.xend,
+                                           cell.ystart, cell.yend,
+                                           cell.zstart, cell.zend)
+        for x, y, z in [(10., 0., 0.), (0., 5., 1200.), (1., -2., 500.)]:
+            aa = np.array([x - cell.xend, y - cell.yend, z - cell.zend])
+            bb = np.array([cell.xend - cell.xstart, cell.yend - cell.ystart,
+                           cell.zend - cell.zstart])
+            h = np.dot(aa.T, bb).diagonal() / deltaS
+            for backend in LFPy.available_backends():
+                lfpcalc = LFPy.backends.get_module('lfpcalc', backend)
+                np.testing.assert_allclose(
+                    lfpcalc._h_calc(cell.xstart, cell.xend, cell.ystart,
+                                    cell.yend, cell.zstart, cell.zend, deltaS,
+                                    x, y, z), h, rtol=1E-10, atol=1E-10)
+
+    def test_backends_simulate_parity(self):
+        '''simulations with an electrode give the same results with all
+        available backends'''
+        backend = LFPy.get_backend()
+        cell = self.stickGeometry(tstopms=20, extracellular=False)
+        LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=10., delay=5.,
+                              pptype='IClamp')
+        results = []
+        try:
+            for name in LFPy.available_backends():
+                LFPy.set_backend(name)
+                electrode = LFPy.RecExtElectrode(sigma=0.3,
+                                                 x=np.array([10., 10.]),
+                                                 y=np.zeros(2),
+                                                 z=np.array([0., 500.]))
+                cell.simulate(electrode=electrode, rec_imem=True)
+                results.append((cell.somav, cell.imem, electrode.LFP))
+        finally:
+            LFPy.set_backend(backend)
+        for somav, imem, LFP in results[1:]:
+            np.testing.assert_allclose(somav, results[0][0])
+            np.testing.assert_allclose(imem, results[0][1], rtol=1E-10,
+                                       atol=1E-12)
+            np.testing.assert_allclose(LFP, results[0][2], rtol=1E-10,
+                                       atol=1E-12)
+
+    def test_four_sphere_homogeneous(self):
+        '''four-sphere potential with equal conductivities and large radii
+        equals potential of a dipole in an infinite medium'''
+        rz = np.array([0., 0., 1000.])
+        r_electrodes = np.array([[0., 0., 1500.], [300., 0., 1200.],
+                                 [-200., 400., 1100.], [0., 500., 900.]])
+        fs = LFPy.FourSphereVolumeConductor(radii=[1E6, 1.01E6, 1.02E6,
+                                                   1.03E6],
+                                            sigmas=[0.3, 0.3, 0.3, 0.3],
+                                            r_electrodes=r_electrodes)
+        p = np.array([[1., 0., 0.], [0., 1., 0.], [0., 0., 1.],
+                      [1., 2., 3.]]).T * 1E3
+        dr = r_electrodes - rz
+        phi = np.dot(dr, p) / (4 * np.pi * 0.3 *
+                               np.sqrt((dr**2).sum(axis=1))[:, np.newaxis]**3)
+        np.testing.assert_allclose(fs.calc_potential(p, rz), phi,
+                                   rtol=1E-6)
+    
+    def test_four_sphere_cells(self):
+        '''EEG of a population equals sum of EEGs of each cell'''
+        class DipoleCell(object):
+            pass
+        
+        r_electrodes = np.array([[0., 0., 90000.], [0., 30000., 84000.],
+                                 [40000., 0., 80000.]])
+        fs = LFPy.FourSphereVolumeConductor(r_electrodes=r_electrodes)
+        np.random.seed(1234)
+        cells = []
+        EEG = 0
+        for i in range(3):
+            cell = DipoleCell()
+            cell.somapos = np.array([0., 1000. * i, 78000.])
+            cell.current_dipole_moment = np.random.randn(3, 10) * 1E6
+            EEG = EEG + fs.calc_potential(cell.current_dipole_moment,
+                                          cell.somapos)
+            cells.append(cell)
+        np.testing.assert_allclose(fs.calc_potential_from_cells(cells), EEG)
+        self.assertEqual(len(fs._lead_fields), 3)
+    
+    def test_csdcalc_box_and_cylinder(self):
+        '''CSD from dotprodcoeffs equals volume-averaged membrane currents'''
+        cell = self.stickGeometry(tstopms=20)
+        LFPy.StimIntElectrode(cell, idx=0, amp=0.5, dur=10., delay=5.,
+                              pptype='IClamp')
+        x = np.linspace(-50., 50., 3)
+        y = np.linspace(-50., 50., 3)
+        z = np.linspace(cell.zstart.min(), cell.zend.max() + 1., 11)
+        box = LFPy.csdcalc.get_box_csd_coeffs(cell, x, y, z)
+        cylinder = LFPy.csdcalc.get_cylinder_csd_coeffs(
+            cell, np.c_[z[:-1], z[1:]], np.zeros(10) + 50.)
+        
+        #all of each segment is inside the grid
+        volume = np.diff(x)[0] * np.diff(y)[0] * np.diff(z)[0]
+        np.testing.assert_allclose(box.sum(axis=0) * volume,
+                                   np.ones(cell.totnsegs))
+        volume = np.pi * 50.**2 * np.diff(z)[0]
+        np.testing.assert_allclose(cylinder.sum(axis=0) * volume,
+                                   np.ones(cell.totnsegs))
+        
+        cell.simulate(rec_imem=True, dotprodcoeffs=[box, cylinder])
+        for coeffs, CSD in zip([box, cylinder], cell.dotprodresults):
+            np.testing.assert_allclose(CSD, np.dot(coeffs, cell.imem),
+                                       atol=1E-15)
+
+    def test_multipolecalc_population(self):
+        '''multipole LFP of a population equals sum of LFPs of each cell
+        within the error bound, exactly with tolerance 0'''
+        class StickCell(object):
+            pass
+
+        stick = self.stickGeometry()
+        x = np.linspace(-100., 100., 5)
+        y = np.zeros(5) + 5.
+        z = np.linspace(0., 1000., 5)
+        np.random.seed(1234)
+        cells = []
+        LFP = 0
+        for dx in np.linspace(-10000., 10000., 4):
+            for dy in np.linspace(-10000., 10000., 4):
+                cell = StickCell()
+                for attr in ['start', 'mid', 'end']:
+                    setattr(cell, 'x' + attr, getattr(stick, 'x' + attr) + dx)
+                    setattr(cell, 'y' + attr, getattr(stick, 'y' + attr) + dy)
+                    setattr(cell, 'z' + attr, getattr(stick, 'z' + attr))
+                cell.diam = stick.diam
+                cell.totnsegs = stick.totnsegs
+                cell.imem = np.random.randn(cell.totnsegs, 10)
+                cell.imem -= cell.imem.mean(axis=0)
+                LFP = LFP + np.array([
+                    LFPy.lfpcalc.calc_lfp_linesource(cell, x=x[i], y=y[i],
+                                                     z=z[i],
+                                                     r_limit=cell.diam / 2)
+                    for i in range(x.size)])
+                cells.append(cell)
+
+        multipole = LFPy.MultipoleLFP(cells, x, y, z, tolerance=0.)
+        np.testing.assert_allclose(multipole.calc_lfp(block_size=3), LFP,
+                                   rtol=1E-10, atol=1E-15)
+        self.assertEqual(multipole.n_expansions, 0)
+
+        multipole = LFPy.MultipoleLFP(cells, x, y, z, tolerance=1E-3,
+                                      leaf_size=4)
+        error = abs(multipole.calc_lfp() - LFP).max(axis=1)
+        self.assertTrue(multipole.n_expansions > 0)
+        self.assertTrue(np.all(error <= multipole.LFP_error_bound))
+
+    def test_lfptable_calc_mapping(self):
+        '''line-source mapping interpolated from a cached table equals
+        lfpcalc.calc_mapping within the tolerance'''
+        cell = self.stickGeometry()
+        np.random.seed(1234)
+        x = np.r_[np.random.uniform(-100., 100., 20), 0.2, 1., 3.]
+        y = np.r_[np.random.uniform(-100., 100., 20), 0., 0., 0.]
+        z = np.r_[np.random.uniform(-100., 1100., 20), 500., 0., 1200.]
+        tempdir = tempfile.mkdtemp()
+        try:
+            table = LFPy.LineSourceTable(tolerance=1E-3, cache_dir=tempdir)
+            self.assertTrue(table.error <= 1E-3)
+            self.assertTrue(os.path.isfile(table.cache_file))
+            cached = LFPy.LineSourceTable(tolerance=1E-3, cache_dir=tempdir)
+            np.testing.assert_equal(cached.table, table.table)
+        finally:
+            shutil.rmtree(tempdir)
+
+        mapping, clamped = LFPy.lfpcalc.calc_mapping(
+            cell, x, y, z, r_limit=cell.diam / 2, return_clamped=True)
+        for n_threads in [1, 2]:
+            approx, approx_clamped = cached.calc_mapping(
+                cell, x, y, z, r_limit=cell.diam / 2, n_threads=n_threads,
+                return_clamped=True, block_size=100)
+            np.testing.assert_allclose(approx, mapping, rtol=2E-3)
+            for a, b in zip(approx_clamped, clamped):
+                np.testing.assert_equal(a, b)
+
+        cell.imem = np.random.randn(cell.totnsegs, 10)
+        electrode = LFPy.RecExtElectrode(cell, x=x, y=y, z=z, table=cached)
+        np.testing.assert_equal(electrode.calc_mapping(), approx)
+    
+    def test_tools_atomic_savez(self):
+        '''files are replaced only by complete writes, and no temporary
+        files are left'''
+        tempdir = tempfile.mkdtemp()
+        fname = os.path.join(tempdir, 'sub', 'a.npz')
+        try:
+            LFPy.tools._atomic_savez(fname, a=np.arange(3))
+            def write(tmpfile):
+                with open(tmpfile, 'w') as f:
+                    f.write('incomplete')
+                raise IOError
+            self.assertRaises(IOError, LFPy.tools._atomic_write, fname,
+                              write)
+            self.assertEqual(os.listdir(os.path.dirname(fname)), ['a.npz'])
+            with np.load(fname) as f:
+                np.testing.assert_equal(f['a'], np.arange(3))
+        finally:
+            shutil.rmtree(tempdir)
+    
     ######## Functions used by tests: ##########################################
+    def stickGeometry(self, **kwargs):
+        stick = LFPy.Cell(morphology = os.path.join(LFPy.__path__[0], 'stick.hoc'),
+                          nsegs_method='lambda_f', **kwargs)
+        return stick
+    
+    def ballAndStickGeometry(self, swc=ball_and_stick, **kwargs):
+        '''Cell of the swc morphology written to a temporary file'''
+        tempdir = tempfile.mkdtemp()
+        try:
+            morphology = self.writeMorphology(tempdir, swc)
+            return LFPy.Cell(morphology=morphology, **kwargs)
+        finally:
+            shutil.rmtree(tempdir)
+    
+    def writeMorphology(self, dirname, swc=ball_and_stick):
+        '''Write the swc morphology to a file in dirname, returns its path'''
+        morphology = os.path.join(dirname, 'ball_and_stick.swc')
+        f = open(morphology, 'w')
+        f.write(swc)
+        f.close()
+        return morphology
+    
     def stickSimulationTesttvec(self, **kwargs):
         stick = LFPy.Cell(morphology = os.path.join(LFPy.__path__[0], 'stick.hoc'), verbose=True, **kwargs)
         stick.simulate(rec_imem=False)    
@@ -11,6 +11,8 @@ but WITHOUT ANY WARRANTY; without even the implied warranty of
 MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 GNU General Public License for more details.'''
 
+import os
+import tempfile
 import numpy as np
 import scipy.signal as ss
 
@@ -23,6 +25,30 @@ def load(filename):
     filen.close()
     return obj
 
+def _atomic_write(filename, write, suffix=''):
+    '''Call write(tmpfile) with the path of a new temporary file in the
+    folder of filename, created if needed, and rename it to filename. Other
+    processes thus never read an incomplete file, and a failing write never
+    destroys an existing file.'''
+    dirname = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmpfile = tempfile.mkstemp(suffix=suffix, dir=dirname)
+    os.close(fd)
+    try:
+        write(tmpfile)
+        os.rename(tmpfile, filename)
+    finally:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+
+def _atomic_savez(filename, **arrays):
+    '''np.savez of arrays to filename, written by _atomic_write'''
+    def write(tmpfile):
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, **arrays)
+    _atomic_write(filename, write, '.npz')
+
 def noise_brown(ncols, nrows=1, weight=1, filter=None, filterargs=None):
     '''Return 1/f^2 noise of shape(nrows, ncols obtained by taking 
     the cumulative sum of gaussian white noise, with rms weight.
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+'''
+Runtime of the geometry stage of the line-source and som_as_point methods,
+lfpcalc._h_calc, for the L5 pyramidal cell morphologies of Mainen &
+Sejnowski (1996) with a fine segmentation, compared with the former
+implementation keeping only the diagonal of a segments x segments matrix.
+Also the runtime of the line-source and som_as_point LFPs at 16 contacts,
+and of the mapping matrices of lfpcalc.calc_mapping for each backend, with
+one thread and one thread per CPU, and of the sparse mapping matrices of
+lfpcalc.calc_sparse_mapping and their products with membrane currents.
+Finally the runtime and largest relative error of line-source mappings
+interpolated from LFPy.LineSourceTable of different tolerances.
+
+Usage:
+    python benchmark_lfpcalc.py [maximum segment length (mum)]
+'''
+import sys
+import os
+import shutil
+import tempfile
+import multiprocessing
+from time import time
+import numpy as np
+import LFPy
+from LFPy import lfpcalc
+
+
+def h_calc_dense(xstart, xend, ystart, yend, zstart, zend, deltaS, x, y, z):
+    '''former implementation of lfpcalc._h_calc'''
+    aa = np.array([x - xend, y - yend, z-zend])
+    bb = np.array([xend - xstart, yend - ystart, zend - zstart])
+    cc = np.dot(aa.T, bb).diagonal()
+    hh = cc / deltaS
+    return hh
+
+
+if len(sys.argv) > 1:
+    max_nsegs_length = float(sys.argv[1])
+else:
+    max_nsegs_length = 2.
+
+#contacts along the apical dendrite
+x = np.zeros(16) + 50.
+y = np.zeros(16)
+z = np.linspace(-200., 1300., 16)
+
+for morphology in ['L5_Mainen96_LFPy.hoc', 'L5_Mainen96_wAxon_LFPy.hoc']:
+    cell = LFPy.Cell(morphology=os.path.join('morphologies', morphology),
+                     nsegs_method='fixed_length',
+                     max_nsegs_length=max_nsegs_length)
+    geometry = [cell.xstart, cell.xend, cell.ystart, cell.yend,
+                cell.zstart, cell.zend]
+    deltaS = lfpcalc._deltaS_calc(*geometry)
+    print('%s, %i segments' % (morphology, cell.totnsegs))
+
+    #one contact for the dense implementation, which is quadratic in the
+    #number of segments
+    t0 = time()
+    h_dense = h_calc_dense(*(geometry + [deltaS, x[0], y[0], z[0]]))
+    time_dense = time() - t0
+    t0 = time()
+    for i in range(x.size):
+        h = lfpcalc._h_calc(*(geometry + [deltaS, x[i], y[i], z[i]]))
+        if i == 0:
+            assert np.allclose(h, h_dense, rtol=1E-12, atol=1E-9)
+    time_rowwise = (time() - t0) / x.size
+    print('_h_calc per contact: dense %.4f s (%.0f MB), row-wise %.6f s, '
+          'speedup %.0f' % (time_dense, cell.totnsegs**2 * 8E-6,
+                            time_rowwise, time_dense / time_rowwise))
+
+    #LFPs of random membrane currents at 10 time steps
+    cell.imem = np.random.randn(cell.totnsegs, 10)
+    for method in ['linesource', 'som_as_point']:
+        calc_lfp = getattr(lfpcalc, 'calc_lfp_' + method)
+        t0 = time()
+        for i in range(x.size):
+            calc_lfp(cell, x=x[i], y=y[i], z=z[i], r_limit=cell.diam / 2)
+        print('calc_lfp_%s, %i contacts: %.4f s' % (method, x.size,
+                                                    time() - t0))
+
+    #mapping matrices, single- and multithreaded
+    for backend in LFPy.available_backends():
+        calc_mapping = LFPy.backends.get_module('lfpcalc', backend).calc_mapping
+        for method in ['linesource', 'som_as_point', 'pointsource']:
+            #warm up, numba compiles on first call
+            calc_mapping(cell, x[:1], y[:1], z[:1], r_limit=cell.diam / 2,
+                         method=method)
+            for n_threads in sorted(set([1, multiprocessing.cpu_count()])):
+                t0 = time()
+                calc_mapping(cell, x, y, z, r_limit=cell.diam / 2,
+                             method=method, n_threads=n_threads)
+                print('calc_mapping %s %s, %i contacts, %i threads: %.4f s'
+                      % (backend, method, x.size, n_threads, time() - t0))
+
+    #sparse mapping matrices of a 16 x 64 planar array, 100 time steps
+    X, Z = np.meshgrid(np.linspace(-300., 300., 16),
+                       np.linspace(-200., 1300., 64))
+    imem = np.random.randn(cell.totnsegs, 100)
+    kernels = LFPy.backends.get_module('lfpcalc')
+    t0 = time()
+    dense = kernels.calc_mapping(cell, X.flatten(), np.zeros(X.size) + 20.,
+                                  Z.flatten(), r_limit=cell.diam / 2)
+    time_dense = time() - t0
+    t0 = time()
+    dense.dot(imem)
+    print('calc_mapping %s, %i contacts: %.4f s, product %.4f s'
+          % (LFPy.get_backend(), X.size, time_dense, time() - t0))
+    for cutoff in [50., 100., 200.]:
+        t0 = time()
+        mapping, bound = kernels.calc_sparse_mapping(
+            cell, X.flatten(), np.zeros(X.size) + 20., Z.flatten(),
+            r_limit=cell.diam / 2, cutoff=cutoff)
+        time_sparse = time() - t0
+        t0 = time()
+        mapping.dot(imem)
+        print('calc_sparse_mapping %s, cutoff %g mum, density %.3f: %.4f s, '
+              'product %.4f s' % (LFPy.get_backend(), cutoff,
+                                  mapping.nnz / float(dense.size),
+                                  time_sparse, time() - t0))
+
+    #line-source mappings interpolated from tables cached on disk
+    cachedir = tempfile.mkdtemp()
+    for tolerance in [1E-2, 1E-3, 1E-4]:
+        t0 = time()
+        table = LFPy.LineSourceTable(tolerance=tolerance, cache_dir=cachedir)
+        time_build = time() - t0
+        t0 = time()
+        LFPy.LineSourceTable(tolerance=tolerance, cache_dir=cachedir)
+        time_load = time() - t0
+        t0 = time()
+        mapping = table.calc_mapping(cell, X.flatten(),
+                                     np.zeros(X.size) + 20., Z.flatten(),
+                                     r_limit=cell.diam / 2)
+        print('LineSourceTable tolerance %g, size %i: build %.4f s, load '
+              '%.4f s, calc_mapping %i contacts %.4f s (analytic %.4f s), '
+              'error %.2g' % (tolerance, table.size, time_build, time_load,
+                              X.size, time() - t0, time_dense,
+                              abs(mapping / dense - 1).max()))
+    shutil.rmtree(cachedir)
+    print('')
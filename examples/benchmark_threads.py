@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+'''
+Scaling of simulation time with the number of threads used by NEURON, for
+the L5 pyramidal cell morphologies of Mainen & Sejnowski (1996) with
+Hodgkin-Huxley channels in all sections, calculating the LFP at every
+time step.
+
+Usage:
+    python benchmark_threads.py [max number of threads]
+'''
+import sys
+import os
+from time import time
+import numpy as np
+import LFPy
+
+#the extracellular mechanism only allows one thread
+cellParameters = {
+    'rm' : 30000.,
+    'cm' : 1.0,
+    'Ra' : 150.,
+    'v_init' : -65.,
+    'passive' : True,
+    'nsegs_method' : 'lambda_f',
+    'lambda_f' : 500.,
+    'timeres_NEURON' : 2.**-5,
+    'timeres_python' : 2.**-5,
+    'tstartms' : 0.,
+    'tstopms' : 200.,
+    'extracellular' : False,
+}
+
+#grid of electrode contacts along the apical dendrite
+electrodeParameters = {
+    'sigma' : 0.3,
+    'x' : np.zeros(16) + 50.,
+    'y' : np.zeros(16),
+    'z' : np.linspace(-200., 1300., 16),
+}
+
+if len(sys.argv) > 1:
+    maxthreads = int(sys.argv[1])
+else:
+    maxthreads = 8
+threads = [2**i for i in range(int(np.log2(maxthreads)) + 1)]
+
+for morphology in ['L5_Mainen96_LFPy.hoc', 'L5_Mainen96_wAxon_LFPy.hoc']:
+    cell = LFPy.Cell(morphology=os.path.join('morphologies', morphology),
+                     **cellParameters)
+    for sec in cell.allseclist:
+        sec.insert('hh')
+    stimulus = LFPy.StimIntElectrode(cell, idx=0, amp=1., dur=180.,
+                                     delay=10., pptype='IClamp')
+    electrode = LFPy.RecExtElectrode(**electrodeParameters)
+
+    print('%s, %i segments' % (morphology, cell.totnsegs))
+    print('threads  time (s)  speedup')
+    for i, nthreads in enumerate(threads):
+        t0 = time()
+        cell.simulate(electrode=electrode, threads=nthreads)
+        simtime = time() - t0
+        if i == 0:
+            simtime0 = simtime
+            LFP = electrode.LFP
+        else:
+            #threads must not change the results
+            assert np.allclose(electrode.LFP, LFP, rtol=1E-9, atol=1E-12)
+        print('%7i  %8.2f  %7.2f' % (nthreads, simtime, simtime0 / simtime))
+    print('')
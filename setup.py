@@ -2,6 +2,7 @@
 '''LFPy setup.py file'''
 
 import os
+import sys
 import shutil
 try:
     from setuptools import setup, Extension
@@ -11,21 +12,28 @@ try:
     import numpy
     from Cython.Distutils import build_ext
     cmdclass = { 'build_ext' : build_ext}
+    #OpenMP threads for lfpcalc.calc_mapping, serial where not supported
+    if sys.platform.startswith('linux'):
+        openmp = ['-fopenmp']
+    else:
+        openmp = []
     ext_modules = [
-        Extension('LFPy.lfpcalc',
+        Extension('LFPy.cythonkernels.lfpcalc',
         ['LFPy/lfpcalc.pyx'],
-        include_dirs=[numpy.get_include()]),
-        Extension('LFPy.run_simulation',
+        include_dirs=[numpy.get_include()],
+        extra_compile_args=openmp, extra_link_args=openmp),
+        Extension('LFPy.cythonkernels.run_simulation',
         ['LFPy/run_simulation.pyx'],
         include_dirs=[numpy.get_include()]),
-        Extension('LFPy.alias_method',
+        Extension('LFPy.cythonkernels.alias_method',
         ['LFPy/alias_method.pyx'],
         include_dirs=[numpy.get_include()]),
         ]
 except ImportError as ie:
     print("'from Cython.Distutils import build_ext' or 'import numpy' failed!")
     print("Cython extensions will not be compiled, and")
-    print("simulations in LFPy may run slower")
+    print("simulations in LFPy may run slower, as only the 'numpy' and")
+    print("'numba' backends of LFPy.set_backend() are available")
     cmdclass = {}
     ext_modules = []
 
@@ -52,7 +60,7 @@ setup(
     version = "1.1.3",
     maintainer = "Espen Hagen",
     maintainer_email = 'espen.hagen@fys.uio.no',
-    packages = ['LFPy'],
+    packages = ['LFPy', 'LFPy.cythonkernels'],
     package_data = {'LFPy' : ['stick.hoc', 'sinsyn.mod',
                               os.path.join('i686', '*'),
                               os.path.join('i686', '.libs', '*'),